@@ -6,10 +6,31 @@ response or error message.
 """
 
 import commands
+import json
 
 from twisted.internet.protocol import Factory
 from twisted.protocols.amp import AMP
 
+# The number of torrents in a page of MsgTorrents by default and at most,
+# and in a batch of MsgAddMany or MsgStatusMany at most, keeping the
+# response well under the 65535 byte limit of an AMP value
+_PAGE_SIZE = 50
+
+
+def _keys(value):
+    # Returns the list of strings in a json formatted string or raises a
+    # MsgError
+    try:
+        keys = json.loads(value)
+    except ValueError:
+        keys = None
+    if (not isinstance(keys, list) or
+            not all(isinstance(key, basestring) for key in keys)):
+        raise commands.MsgError("Expected a json formatted list of strings")
+    if len(keys) > _PAGE_SIZE:
+        raise commands.MsgError("At most {} at a time".format(_PAGE_SIZE))
+    return [key.encode('utf-8') for key in keys]
+
 
 class AMPControlServer(AMP):
     def __init__(self, client):
@@ -26,6 +47,15 @@ class AMPControlServer(AMP):
         return (self._client.add_torrent(filename)
                 .addCallbacks(success, failure))
 
+    @commands.MsgAddMany.responder
+    def add_many(self, filenames):
+        def success(results):
+            return dict(results=json.dumps(
+                [dict(key=value[0]) if ok else dict(error=value)
+                 for ok, value in results]))
+
+        return self._client.add_torrents(_keys(filenames)).addCallback(success)
+
     @commands.MsgStatus.responder
     def get_status(self, key):
         try:
@@ -33,8 +63,73 @@ class AMPControlServer(AMP):
         except Exception as err:
             raise commands.MsgError(err.message)
 
+        status['peers'] = json.dumps(status['peers'])
         return status
 
+    @commands.MsgTorrents.responder
+    def get_torrents(self, offset=None, limit=None):
+        if offset is None:
+            offset = 0
+        if limit is None:
+            limit = _PAGE_SIZE
+        if offset < 0 or not 0 < limit <= _PAGE_SIZE:
+            raise commands.MsgError("Invalid page")
+
+        torrents = self._client.get_torrents()
+        page = dict((key, torrents[key])
+                    for key in sorted(torrents)[offset:offset + limit])
+        return dict(torrents=json.dumps(page), total=len(torrents))
+
+    @commands.MsgStatusMany.responder
+    def get_status_many(self, keys):
+        keys = _keys(keys)
+        torrents = self._client.get_torrents(keys)
+        return dict(torrents=json.dumps(torrents),
+                    unknown=json.dumps([key for key in keys
+                                        if key not in torrents]))
+
+    @commands.MsgPriority.responder
+    def set_priority(self, key, priority, file=None):
+        try:
+            self._client.set_priority(key, file, priority)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return dict()
+
+    @commands.MsgPause.responder
+    def pause(self, key):
+        try:
+            self._client.pause(key)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return dict()
+
+    @commands.MsgResume.responder
+    def resume(self, key):
+        def success(result):
+            return dict()
+
+        def failure(err):
+            raise commands.MsgError(err.value.message)
+
+        try:
+            d = self._client.resume(key)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return d.addCallbacks(success, failure)
+
+    @commands.MsgRemove.responder
+    def remove(self, key):
+        try:
+            self._client.remove(key)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return dict()
+
     @commands.MsgQuit.responder
     def quit(self):
         self._client.quit()
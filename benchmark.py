@@ -0,0 +1,627 @@
+"""
+benchmark measures how fast a TorrentMgr downloads a torrent from a swarm of
+seeders over the loopback interface, so that changes to how pieces are
+requested and peers are managed can be compared repeatably.
+
+Usage:
+python benchmark.py [-h] [-s MiB] [-p bytes] [-f files] [-n seeders]
+                    [-l ms] [-b KiB/s] [-c seconds] [-m seconds] [-r runs]
+                    [-t seconds] [--seed seed] [--log] [-o filename]
+
+Each run writes a torrent's worth of random data, split into the given
+number of files, and makes a metainfo file for it with make_torrent().  An
+HTTP tracker stand-in and the seeders are started in the same process and
+the torrent is downloaded by a TorrentMgr into a temporary directory, as it
+would be by the client, and then checked against the data.
+
+The seeders speak the peer wire protocol through a HandshakeTranslator and a
+PeerWireTranslator, as a PeerProxy does.  They have every piece, advertise
+no extensions, unchoke the client as soon as it is interested and serve
+blocks from the files as they are asked for.  Each seeder can be given a
+latency, added to everything it sends, and an upload rate, which its blocks
+queue for as if on a link of that bandwidth.  With churn, a connection to a
+seeder is closed every so many seconds, and the client has to connect to the
+seeder again.  The client forgets a peer whose connection has closed and
+only hears of it again from the tracker, which it can ask no more often than
+the minimum interval the tracker gives, set by -m.  The connections are
+picked by a random number generator seeded with --seed, so that runs with
+the same options churn alike.
+
+For each run the benchmark reports the download rate in MiB/s, the time
+until the first piece was verified, the tail, which is the time taken to
+download the last 5% of the torrent, the CPU time used for each MiB
+downloaded and the peak resident set size of the process.  The time is
+measured from when the TorrentMgr is initialized, including its announce to
+the tracker, until it has every piece.  The seeders and the tracker run in
+the client's process, so the CPU time and resident set size include theirs,
+although they do little next to the client's hashing and writing, and the
+peak resident set size is the highest reached by any run so far.  The
+median of each figure over the runs is reported at the end, and the figures
+of every run can be written to a file as json.
+
+The client's modules log at the warning level unless --log is given, in
+which case they log to bittorrent.log as they do in the client.
+"""
+
+import filecmp
+import json
+import logging
+import logging.config
+import os
+import random
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from collections import deque
+
+import bencoding
+from argparse import ArgumentParser
+from bitstring import BitArray
+from filemgr import extents
+from handshaketranslator import HandshakeTranslator, reserved_bytes
+from maketorrent import MakeTorrentError, make_torrent, piece_length_for
+from metainfo import Metainfo
+from peerwiretranslator import PeerWireTranslator
+from protocoladapter import ProtocolAdapter
+from torrentmgr import TorrentMgr, TorrentMgrError
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+logger = logging.getLogger('bt.benchmark')
+
+_HOST = '127.0.0.1'
+_PEER_ID = '-HS0001-000000000000'
+_SEEDER_ID = '-HSBNCH-000000000000'
+_PORT = 6881
+_MiB = 2**20
+_WRITE_SIZE = 2**20
+_PROBE_INTERVAL = 0.01
+_TAIL_PERCENT = 95
+_INTERVAL = 1800
+_FIGURES = ('rate', 'first_piece', 'tail', 'cpu_per_mib', 'peak_rss')
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class _Payload(object):
+    # The data of the torrent, which the seeders read from the files it was
+    # written to
+    def __init__(self, filenames, lengths):
+        self._files = [open(filename, 'rb') for filename in filenames]
+        self._lengths = lengths
+        self._offsets = []
+        offset = 0
+        for length in lengths:
+            self._offsets.append(offset)
+            offset += length
+
+    def read(self, begin, length):
+        parts = []
+        for index, offset, size in extents(self._offsets, self._lengths,
+                                           begin, length):
+            self._files[index].seek(offset)
+            parts.append(self._files[index].read(size))
+        return ''.join(parts)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+class _Uplink(object):
+    """
+    An _Uplink delays what a seeder sends by its latency and, if it has a
+    rate, by the time taken to send the bytes queued before it.  Everything
+    is sent in the order it was queued.
+    """
+    def __init__(self, reactor, latency, rate):
+        self._reactor = reactor
+        self._latency = latency
+        self._rate = rate
+        self._queue = deque()
+        self._free = 0
+        self._timer = None
+
+    def send(self, size, function, *args):
+        if not self._latency and not self._rate:
+            function(*args)
+            return
+
+        now = self._reactor.seconds()
+        due = now
+        if self._rate:
+            self._free = max(now, self._free) + size / self._rate
+            due = self._free
+        due += self._latency
+
+        self._queue.append((due, function, args))
+        if self._timer is None:
+            self._timer = self._reactor.callLater(due - now,
+                                                  self.timer_event)
+
+    def stop(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._queue.clear()
+
+    # Reactor callback
+
+    def timer_event(self):
+        self._timer = None
+        now = self._reactor.seconds()
+        while self._queue and self._queue[0][0] <= now:
+            _, function, args = self._queue.popleft()
+            function(*args)
+        if self._queue:
+            self._timer = self._reactor.callLater(self._queue[0][0] - now,
+                                                  self.timer_event)
+
+
+class _Connection(object):
+    """
+    A _Connection is one end of a connection from the client to a seeder,
+    the receiver for its translators.
+    """
+    def __init__(self, seeder):
+        self._seeder = seeder
+        self._protocol = None
+        self._translator = None
+
+    def drop(self):
+        if self._translator:
+            self._translator.unset_receiver()
+            self._translator.unset_readerwriter()
+            self._translator = None
+        if self._protocol:
+            self._protocol.stop()
+        self._seeder.disconnected(self)
+
+    def _reply(self):
+        # Complete the handshake, switch to the peer wire protocol and offer
+        # every piece
+        if not self._translator:
+            return
+        self._translator.tx_handshake(reserved_bytes(),
+                                      self._seeder.info_hash, _SEEDER_ID)
+        self._translator.unset_receiver()
+        self._translator.unset_readerwriter()
+        self._translator = PeerWireTranslator(self, self._protocol)
+        self._translator.tx_bitfield(self._seeder.bitfield)
+        self._seeder.connected(self)
+
+    def _unchoke(self):
+        if self._translator:
+            self._translator.tx_unchoke()
+
+    def _piece(self, index, begin, length):
+        if self._translator:
+            offset = index * self._seeder.piece_length + begin
+            self._translator.tx_piece(index, begin,
+                                      self._seeder.payload.read(offset,
+                                                                length))
+
+    # ProtocolAdapter callbacks
+
+    def connection_complete(self, protocol):
+        self._protocol = protocol
+        self._translator = HandshakeTranslator(self, protocol)
+
+    # Translator callbacks
+
+    def connection_lost(self):
+        self._translator = None
+        self._seeder.disconnected(self)
+
+    def rx_handshake(self, reserved, info_hash, peer_id):
+        if info_hash != self._seeder.info_hash:
+            self.drop()
+            return
+        self._seeder.uplink.send(0, self._reply)
+
+    def rx_non_handshake(self):
+        self.drop()
+
+    def rx_keep_alive(self):
+        pass
+
+    def rx_choke(self):
+        pass
+
+    def rx_unchoke(self):
+        pass
+
+    def rx_interested(self):
+        self._seeder.uplink.send(0, self._unchoke)
+
+    def rx_not_interested(self):
+        pass
+
+    def rx_have(self, index):
+        pass
+
+    def rx_bitfield(self, bitfield):
+        pass
+
+    def rx_request(self, index, begin, length):
+        if (not 0 <= index < self._seeder.num_pieces or
+                index * self._seeder.piece_length + begin + length >
+                self._seeder.total_length):
+            self.drop()
+            return
+        self._seeder.uplink.send(length, self._piece, index, begin, length)
+
+    def rx_piece(self, index, begin, buf):
+        pass
+
+    def rx_cancel(self, index, begin, length):
+        # Blocks are sent straight away, or queued on the uplink, so there
+        # is nothing to cancel
+        pass
+
+
+class _Seeder(Factory):
+    """
+    A _Seeder accepts connections from the client and serves every piece
+    of the torrent through its uplink.
+    """
+    def __init__(self, reactor, metainfo, payload, latency, rate):
+        self.info_hash = metainfo.info_hash
+        self.num_pieces = metainfo.num_pieces
+        self.piece_length = metainfo.piece_length
+        self.total_length = metainfo.total_length
+        self.bitfield = (BitArray(self.num_pieces * [1]) +
+                         BitArray((-self.num_pieces) % 8))
+        self.payload = payload
+        self.uplink = _Uplink(reactor, latency, rate)
+        self._connections = []
+        self._port = reactor.listenTCP(0, self, interface=_HOST)
+
+    def port(self):
+        return self._port.getHost().port
+
+    def connections(self):
+        return list(self._connections)
+
+    def connected(self, connection):
+        self._connections.append(connection)
+
+    def disconnected(self, connection):
+        if connection in self._connections:
+            self._connections.remove(connection)
+
+    def stop(self):
+        self.uplink.stop()
+        for connection in self.connections():
+            connection.drop()
+        return self._port.stopListening()
+
+    def buildProtocol(self, addr):
+        return ProtocolAdapter(_Connection(self))
+
+
+class _Tracker(Resource):
+    """
+    The _Tracker stands in for an HTTP tracker, answering every announce
+    with the addresses of all of the seeders.
+    """
+    isLeaf = True
+
+    def __init__(self, seeders, min_interval):
+        Resource.__init__(self)
+        self._seeders = seeders
+        self._min_interval = min_interval
+
+    def render_GET(self, request):
+        peers = ''.join(socket.inet_aton(_HOST) +
+                        struct.pack('>H', seeder.port())
+                        for seeder in self._seeders)
+        return bencoding.encode({'interval': _INTERVAL,
+                                 'min interval': self._min_interval,
+                                 'complete': len(self._seeders),
+                                 'incomplete': 1,
+                                 'peers': peers})
+
+
+def _write_payload(directory, size, files):
+    # Writes size bytes of random data split into files and returns the path
+    # to make a torrent of, the filenames and their lengths
+    if files == 1:
+        path = os.path.join(directory, 'payload')
+        filenames = [path]
+    else:
+        path = os.path.join(directory, 'payload')
+        os.mkdir(path)
+        filenames = [os.path.join(path, 'file{:04d}'.format(i))
+                     for i in range(files)]
+
+    lengths = [size // files + (1 if i < size % files else 0)
+               for i in range(files)]
+    for filename, length in zip(filenames, lengths):
+        with open(filename, 'wb') as f:
+            while length:
+                chunk = min(length, _WRITE_SIZE)
+                f.write(os.urandom(chunk))
+                length -= chunk
+    return path, filenames, lengths
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class _Run(object):
+    """
+    A _Run sets up the swarm, downloads the torrent and measures the
+    download.  start() returns a deferred which fires with a dictionary of
+    the figures, or fails with a BenchmarkError.
+    """
+    def __init__(self, reactor, options, rng):
+        self._reactor = reactor
+        self._options = options
+        self._rng = rng
+        self._seeders = []
+        self._tracker = None
+        self._payload = None
+        self._torrent = None
+        self._directory = None
+        self._cwd = os.getcwd()
+        self._probe = None
+        self._churn = None
+        self._timeout = None
+        self._deferred = Deferred()
+
+    def start(self):
+        options = self._options
+        self._directory = tempfile.mkdtemp(prefix='btbench')
+        seeds = os.path.join(self._directory, 'seed')
+        downloads = os.path.join(self._directory, 'download')
+        os.mkdir(seeds)
+        os.mkdir(downloads)
+
+        self._tracker = self._reactor.listenTCP(
+            0, Site(_Tracker(self._seeders, options.min_interval)),
+            interface=_HOST)
+        url = 'http://{}:{}/announce'.format(_HOST,
+                                             self._tracker.getHost().port)
+
+        size = int(options.size * _MiB)
+        path, filenames, lengths = _write_payload(seeds, size, options.files)
+        piece_length = options.piece_length or piece_length_for(size)
+        try:
+            contents = make_torrent(path, [[url]], piece_length)
+        except MakeTorrentError as err:
+            raise BenchmarkError(err.message)
+        filename = os.path.join(self._directory, 'benchmark.torrent')
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        metainfo = Metainfo(filename)
+
+        self._payload = _Payload(filenames, lengths)
+        rate = options.bandwidth * 1024.0
+        for _ in range(options.seeders):
+            self._seeders.append(_Seeder(self._reactor, metainfo,
+                                         self._payload,
+                                         options.latency / 1000.0, rate))
+
+        # The TorrentMgr downloads into the working directory
+        os.chdir(downloads)
+        self._compare = [(seed, os.path.join(downloads,
+                                             os.path.relpath(seed, seeds)))
+                         for seed in filenames]
+        self._torrent = TorrentMgr(filename, _PORT, _PEER_ID, self._reactor)
+
+        self._first_piece = None
+        self._tail_start = None
+        self._cpu = _cpu_seconds()
+        self._started = time.time()
+        self._timeout = self._reactor.callLater(options.timeout,
+                                                self._timed_out)
+        self._torrent.initialize().addCallbacks(self._initialized,
+                                                self._failed)
+        return self._deferred
+
+    def _initialized(self, _):
+        self._torrent.start()
+        self._probe = LoopingCall(self._check)
+        self._probe.start(_PROBE_INTERVAL)
+        if self._options.churn:
+            self._churn = LoopingCall(self._drop_connection)
+            self._churn.start(self._options.churn, now=False)
+
+    def _failed(self, failure):
+        self._finish(BenchmarkError(failure.value.message))
+
+    def _timed_out(self):
+        self._timeout = None
+        self._finish(BenchmarkError("Timed out at {:.1f}%"
+                                    .format(self._torrent.percent())))
+
+    def _drop_connection(self):
+        connections = [connection for seeder in self._seeders
+                       for connection in seeder.connections()]
+        if connections:
+            self._rng.choice(connections).drop()
+
+    def _check(self):
+        now = time.time()
+        percent = self._torrent.percent()
+        if self._first_piece is None and percent > 0:
+            self._first_piece = now - self._started
+        if self._tail_start is None and percent >= _TAIL_PERCENT:
+            self._tail_start = now
+        if not self._torrent.is_complete():
+            return
+
+        elapsed = now - self._started
+        mib = self._options.size
+        self._finish({'seconds': elapsed,
+                      'rate': mib / elapsed,
+                      'first_piece': self._first_piece,
+                      'tail': now - self._tail_start,
+                      'cpu_per_mib': (_cpu_seconds() - self._cpu) / mib,
+                      'peak_rss': _peak_rss()})
+
+    def _finish(self, result):
+        # Stop measuring, tell the tracker the torrent has stopped, shut the
+        # swarm down and check what was downloaded
+        for call in (self._probe, self._churn):
+            if call and call.running:
+                call.stop()
+        if self._timeout and self._timeout.active():
+            self._timeout.cancel()
+
+        def stopped(_):
+            for seeder in self._seeders:
+                seeder.stop()
+            self._tracker.stopListening()
+            self._payload.close()
+            os.chdir(self._cwd)
+
+            if not isinstance(result, Exception):
+                for seed, download in self._compare:
+                    if not filecmp.cmp(seed, download, shallow=False):
+                        self._cleanup()
+                        self._deferred.errback(BenchmarkError(
+                            "{} wasn't downloaded correctly"
+                            .format(os.path.basename(download))))
+                        return
+            self._cleanup()
+            if isinstance(result, Exception):
+                self._deferred.errback(result)
+            else:
+                self._deferred.callback(result)
+
+        try:
+            d = self._torrent.stop()
+        except TorrentMgrError:
+            # The torrent was never served
+            stopped(None)
+            return
+        d.addBoth(stopped)
+
+    def _cleanup(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _format(result):
+    return ("{rate:8.2f} MiB/s  first piece {first_piece:6.3f}s  "
+            "tail {tail:6.3f}s  {cpu_per_mib:6.3f} CPU s/MiB  "
+            "peak RSS {peak_rss:6.1f} MiB".format(**result))
+
+
+def main(args):
+    parser = ArgumentParser('benchmark')
+    parser.add_argument('-s', type=float, default=16, metavar='MiB',
+                        dest='size', help="size of the torrent")
+    parser.add_argument('-p', type=int, metavar='bytes', dest='piece_length',
+                        help="piece length, a power of two")
+    parser.add_argument('-f', type=int, default=1, metavar='files',
+                        dest='files', help="number of files")
+    parser.add_argument('-n', type=int, default=4, metavar='seeders',
+                        dest='seeders', help="number of seeders")
+    parser.add_argument('-l', type=float, default=0, metavar='ms',
+                        dest='latency', help="latency added by each seeder")
+    parser.add_argument('-b', type=float, default=0, metavar='KiB/s',
+                        dest='bandwidth',
+                        help="upload rate of each seeder, 0 for unlimited")
+    parser.add_argument('-c', type=float, default=0, metavar='seconds',
+                        dest='churn',
+                        help="interval between closing connections, 0 for "
+                             "none")
+    parser.add_argument('-m', type=int, default=60, metavar='seconds',
+                        dest='min_interval',
+                        help="minimum interval between announces")
+    parser.add_argument('-r', type=int, default=3, metavar='runs',
+                        dest='runs', help="number of runs")
+    parser.add_argument('-t', type=float, default=300, metavar='seconds',
+                        dest='timeout', help="time allowed for each run")
+    parser.add_argument('--seed', type=int, default=0, metavar='seed',
+                        help="seed for the choice of connections to close")
+    parser.add_argument('--log', action='store_true',
+                        help="log to bittorrent.log as the client does")
+    parser.add_argument('-o', metavar='filename', dest='output',
+                        help="file to write the figures to as json")
+    options = parser.parse_args(args)
+
+    if options.size <= 0 or options.files < 1 or options.seeders < 1:
+        parser.error("size, files and seeders must be positive")
+    if options.size * _MiB < options.files:
+        parser.error("each file needs at least a byte")
+    if options.runs < 1:
+        parser.error("there must be at least one run")
+
+    if options.log:
+        logging.config.fileConfig('logging.conf')
+    else:
+        logging.basicConfig(level=logging.WARNING,
+                            format='%(levelname)s-%(message)s')
+
+    rng = random.Random(options.seed)
+    results = []
+
+    def run():
+        if len(results) == options.runs:
+            reactor.stop()
+            return
+        try:
+            d = _Run(reactor, options, rng).start()
+        except BenchmarkError as err:
+            failed(err)
+            return
+        d.addCallbacks(succeeded, lambda failure: failed(failure.value))
+
+    def succeeded(result):
+        results.append(result)
+        print "run {}: {}".format(len(results), _format(result))
+        reactor.callLater(0, run)
+
+    def failed(err):
+        print >> sys.stderr, "run {} failed: {}".format(len(results) + 1,
+                                                        err)
+        reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+    if len(results) < options.runs:
+        return 1
+
+    median = dict((figure, _median([result[figure] for result in results]))
+                  for figure in _FIGURES)
+    print "median: {}".format(_format(median))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'runs': results,
+                       'median': median}, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,204 @@
+"""
+The bencoding module encodes and decodes bencoded data, the serialization
+format used for metainfo files, tracker responses, extension messages and
+the DHT.
+
+The decoder walks the input once, dispatching on the first character of
+each value and looking up the end of each integer and string length with
+str.index() rather than examining one character at a time.  decode()
+requires the input to hold exactly one value.  decode_prefix() decodes the
+value at the start of the input and also returns where it ended, for
+messages in which raw data follows a bencoded dictionary.
+
+decode_spans() also reports where the value of each key of the top level
+dictionary lies in the input.  Hashes which must be computed on the bytes of
+a dictionary exactly as they were received, such as the info hash of a
+metainfo file, can then be computed on the original bytes instead of on a
+re-encoding of the decoded dictionary, which differs whenever the original
+isn't in canonical form.
+
+Long strings which are only ever sliced, such as the piece hashes of a large
+torrent, can be decoded as memoryviews into the input instead of being
+copied.  Any dictionary value whose key is in the supplied views argument is
+decoded this way when it is a string.
+
+Malformed input raises a BencodeError, a kind of ValueError.
+"""
+
+
+class BencodeError(ValueError):
+    pass
+
+
+class _Views(object):
+    # Holds what is needed to decode the values of some keys as memoryviews
+    def __init__(self, data, keys):
+        self.keys = keys
+        self.view = memoryview(data)
+
+
+def _decode_int(data, i, views):
+    end = data.index('e', i)
+    digits = data[i+1:end]
+    if (digits[:2] == '-0' or
+            (digits[:1] == '0' and len(digits) > 1)):
+        raise BencodeError("Invalid integer")
+    return int(digits), end+1
+
+
+def _string_span(data, i):
+    colon = data.index(':', i)
+    if data[i] == '0' and colon != i+1:
+        raise BencodeError("Invalid string length")
+    start = colon+1
+    end = start + int(data[i:colon])
+    if end > len(data):
+        raise BencodeError("Truncated string")
+    return start, end
+
+
+def _decode_string(data, i, views):
+    start, end = _string_span(data, i)
+    return data[start:end], end
+
+
+def _decode_list(data, i, views):
+    result = []
+    i += 1
+    while data[i] != 'e':
+        value, i = _decoders[data[i]](data, i, views)
+        result.append(value)
+    return result, i+1
+
+
+def _decode_dict(data, i, views):
+    result = {}
+    i += 1
+    while data[i] != 'e':
+        key, i = _decode_string(data, i, views)
+        if views and key in views.keys and data[i].isdigit():
+            start, i = _string_span(data, i)
+            result[key] = views.view[start:i]
+        else:
+            result[key], i = _decoders[data[i]](data, i, views)
+    return result, i+1
+
+
+def _decode_value(data, i, views):
+    return _decoders[data[i]](data, i, views)
+
+
+_decoders = {'i': _decode_int, 'l': _decode_list, 'd': _decode_dict}
+_decoders.update((digit, _decode_string) for digit in '0123456789')
+
+
+def _bytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return str(data)
+
+
+def _run(function, *args):
+    # Deeply nested input exhausts the recursion limit, which is reported
+    # like any other malformed input
+    try:
+        return function(*args)
+    except BencodeError:
+        raise
+    except (IndexError, KeyError, ValueError, TypeError, RuntimeError):
+        raise BencodeError("Invalid bencoded data")
+
+
+def decode_prefix(data, views=()):
+    """
+    decode_prefix() returns a tuple of the value at the start of the data and
+    the index just past its end.
+    """
+    data = _bytes(data)
+    views = _Views(data, views) if views else None
+    return _run(_decode_value, data, 0, views)
+
+
+def decode(data, views=()):
+    """
+    decode() returns the value encoded by the data.
+    """
+    data = _bytes(data)
+    value, end = decode_prefix(data, views)
+    if end != len(data):
+        raise BencodeError("Trailing data")
+    return value
+
+
+def _decode_spans(data, views):
+    # Decodes a top level dictionary, recording the span of each value
+    if data[:1] != 'd':
+        raise BencodeError("Not a dictionary")
+    result = {}
+    spans = {}
+    i = 1
+    while data[i] != 'e':
+        key, i = _decode_string(data, i, views)
+        start = i
+        if views and key in views.keys and data[i].isdigit():
+            value_start, i = _string_span(data, i)
+            result[key] = views.view[value_start:i]
+        else:
+            result[key], i = _decoders[data[i]](data, i, views)
+        spans[key] = (start, i)
+    return result, spans, i+1
+
+
+def decode_spans(data, views=()):
+    """
+    decode_spans() decodes a dictionary and returns a tuple of it and a
+    dictionary mapping each of its keys to the (start, end) span of the
+    key's value in the data.
+    """
+    data = _bytes(data)
+    views = _Views(data, views) if views else None
+    value, spans, end = _run(_decode_spans, data, views)
+    if end != len(data):
+        raise BencodeError("Trailing data")
+    return value, spans
+
+
+def _encode(value, out):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, long)):
+        out.append('i{}e'.format(value))
+    elif isinstance(value, (str, buffer, memoryview)):
+        value = str(value) if isinstance(value, buffer) else value
+        out.append('{}:'.format(len(value)))
+        out.append(value.tobytes() if isinstance(value, memoryview)
+                   else value)
+    elif isinstance(value, unicode):
+        _encode(value.encode('utf-8'), out)
+    elif isinstance(value, (list, tuple)):
+        out.append('l')
+        for item in value:
+            _encode(item, out)
+        out.append('e')
+    elif isinstance(value, dict):
+        out.append('d')
+        for key in sorted(value):
+            if not isinstance(key, str):
+                raise BencodeError("Dictionary key {!r} is not a string"
+                                   .format(key))
+            _encode(key, out)
+            _encode(value[key], out)
+        out.append('e')
+    else:
+        raise BencodeError("Can't bencode {!r}".format(type(value)))
+
+
+def encode(value):
+    """
+    encode() returns the bencoding of the value, which may be built from
+    integers, strings, memoryviews, lists, tuples and dictionaries with
+    string keys.
+    """
+    out = []
+    _encode(value, out)
+    return ''.join(out)
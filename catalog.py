@@ -0,0 +1,172 @@
+"""
+The Catalog remembers every torrent the client serves so that the torrents
+can be served again when the client next starts without going back to their
+metainfo files.  It is kept in an SQLite database with one row per torrent,
+keyed by the info hash.
+
+Each row holds the name of the metainfo file the torrent was added from, the
+metainfo itself, the bitfield of pieces which had been downloaded, the peers
+last connected to, the priority of each of the torrent's files, one byte
+per file, and whether the torrent is paused.  A catalog made before
+priorities or pausing were kept is given columns for them when it is
+opened.  The peers are kept as a bencoded dictionary with
+compact 'peers' and 'peers6' lists, as in a tracker response, so that IPv4
+and IPv6 peers can be stored together.  The metainfo is kept as the
+original bencoded bytes.  Decoding it is cheap, and the expensive part of
+reading a metainfo file, hashing the info dictionary, is avoided by using
+the info hash stored alongside it.  The piece hashes come with the metainfo.
+
+entries() lists the torrents in the catalog without reading their metainfo,
+so that a client with thousands of torrents can start serving at once and
+open the torrents a few at a time afterwards.  load() reads everything known
+about a torrent, add() stores a new torrent and update() records the pieces
+downloaded, the peers connected to and the priorities of the files since it
+was added.  set_paused() records that a torrent has been paused or resumed
+and remove() forgets a torrent.  Writes are committed straight away, so
+nothing but the most recent updates is lost if the client stops
+unexpectedly.
+
+Problems with the database raise a CatalogError.
+"""
+
+import logging
+import sqlite3
+
+import bencoding
+import peeraddr
+
+logger = logging.getLogger('bt.catalog')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    info_hash BLOB PRIMARY KEY,
+    filename TEXT NOT NULL,
+    metainfo BLOB NOT NULL,
+    have BLOB,
+    peers BLOB,
+    priorities BLOB,
+    paused INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+# _ADDED_COLUMNS are the columns which catalogs made by earlier versions lack
+_ADDED_COLUMNS = [('priorities', 'BLOB'),
+                  ('paused', 'INTEGER NOT NULL DEFAULT 0')]
+
+
+class CatalogError(Exception):
+    pass
+
+
+class Catalog(object):
+    def __init__(self, path):
+        try:
+            self._db = sqlite3.connect(path)
+            self._db.text_factory = str
+            self._db.execute(_SCHEMA)
+            columns = [row[1] for row
+                       in self._db.execute("PRAGMA table_info(torrents)")]
+            for column, definition in _ADDED_COLUMNS:
+                if column not in columns:
+                    self._db.execute("ALTER TABLE torrents ADD COLUMN {} {}"
+                                     .format(column, definition))
+            self._db.commit()
+        except sqlite3.Error as err:
+            raise CatalogError("Can't open catalog {}: {}".format(path, err))
+
+    def close(self):
+        self._db.close()
+
+    def entries(self):
+        """
+        entries() returns a list of (info hash, filename, paused) tuples for
+        the torrents in the catalog, in the order they were added.
+        """
+        rows = self._execute("SELECT info_hash, filename, paused "
+                             "FROM torrents ORDER BY rowid").fetchall()
+        return [(str(info_hash), filename, bool(paused))
+                for info_hash, filename, paused in rows]
+
+    def load(self, info_hash):
+        """
+        load() returns a tuple of the metainfo, the bitfield of pieces
+        downloaded as bytes, or None if it hasn't been recorded, a list of
+        the records of the peers last connected to and a list of the
+        priorities of the files, or None if they haven't been recorded, for
+        the torrent with the given info hash.  load() returns None if the
+        torrent isn't in the catalog.
+        """
+        row = self._execute("SELECT metainfo, have, peers, priorities "
+                            "FROM torrents WHERE info_hash = ?",
+                            (buffer(info_hash),)).fetchone()
+        if row is None:
+            return None
+        metainfo, have, peers, priorities = row
+
+        records = []
+        if peers is not None:
+            try:
+                peers = bencoding.decode(str(peers))
+                records = (peeraddr.decode_peers(peers.get('peers', '')) +
+                           peeraddr.decode_peers6(peers.get('peers6', '')))
+            except (bencoding.BencodeError, AttributeError):
+                logger.warning("Ignoring invalid peers saved for {}"
+                               .format(info_hash.encode('hex')))
+
+        if priorities is not None:
+            priorities = [ord(c) for c in str(priorities)]
+
+        return (str(metainfo), str(have) if have is not None else None,
+                records, priorities)
+
+    def add(self, info_hash, filename, metainfo):
+        """
+        add() stores a torrent's metainfo, leaving a torrent which is
+        already in the catalog as it is.
+        """
+        self._write("INSERT OR IGNORE INTO torrents "
+                    "(info_hash, filename, metainfo) VALUES (?, ?, ?)",
+                    (buffer(info_hash), filename, buffer(metainfo)))
+
+    def update(self, info_hash, have, records, priorities):
+        """
+        update() records the bitfield of pieces downloaded, as bytes, the
+        records of the peers connected to and the priorities of the files
+        for a torrent in the catalog.
+        """
+        peers, peers6 = peeraddr.encode_peers(records)
+        peers = bencoding.encode({'peers': peers, 'peers6': peers6})
+        priorities = ''.join(chr(priority) for priority in priorities)
+        self._write("UPDATE torrents SET have = ?, peers = ?, priorities = ? "
+                    "WHERE info_hash = ?",
+                    (buffer(have), buffer(peers), buffer(priorities),
+                     buffer(info_hash)))
+
+    def set_paused(self, info_hash, paused):
+        """
+        set_paused() records whether a torrent in the catalog is paused.
+        """
+        self._write("UPDATE torrents SET paused = ? WHERE info_hash = ?",
+                    (int(paused), buffer(info_hash)))
+
+    def remove(self, info_hash):
+        """
+        remove() forgets a torrent.
+        """
+        self._write("DELETE FROM torrents WHERE info_hash = ?",
+                    (buffer(info_hash),))
+
+    def _execute(self, statement, parameters=()):
+        try:
+            return self._db.execute(statement, parameters)
+        except sqlite3.Error as err:
+            logger.error("Catalog error: {}".format(err))
+            raise CatalogError(str(err))
+
+    def _write(self, statement, parameters):
+        self._execute(statement, parameters)
+        try:
+            self._db.commit()
+        except sqlite3.Error as err:
+            logger.error("Catalog error: {}".format(err))
+            raise CatalogError(str(err))
@@ -4,40 +4,161 @@ reactor.  From there all other functions of the BitTorrent client are event
 driven and flow from calls from the Reactor.
 
 Initially, the client chooses a peer_id, creates an Acceptor for incoming
-connections (not implemented) and creates a control channel.  It sets up
-delayed calls to start serving the torrents specified on the command line
-and then starts the reactor.
+connections (not implemented), starts a DHT node and local peer discovery
+shared by all torrents and creates a control channel.  It sets up delayed
+calls to start serving the torrents specified on the command line and then
+starts the reactor.
+
+Torrents can be added by magnet link as well as by metainfo file.  For a
+magnet link, a MetadataMgr fetches the torrent's info dictionary from peers
+before the torrent is served.  An added torrent is loaded and handed to the
+Scheduler in the same way as the torrents in the catalog, so the add
+completes as soon as its metainfo has been read, and adding a torrent which
+is already being served fails straight away.  Many torrents can be added at
+once, each with its own result, and the metadata of magnet links added
+together is fetched a few at a time.
+
+Every torrent served is remembered in a Catalog along with its progress and
+peers.  When the client starts, the torrents in the catalog are served
+again.  They are loaded a few at a time once the reactor is running, so the
+client responds to its control channels straight away however many torrents
+it has, and handed to the Scheduler, which opens their files and contacts
+their trackers only as it starts them.
+
+The torrents are started and driven by a Scheduler, which shares the
+connection slots and download rate among them and queues torrents beyond
+the number allowed to download at once.  The limits can be set on the
+command line.  The trackers are scraped every so often, torrents sharing a
+tracker together, so that the Scheduler can weigh the swarms of torrents
+which haven't heard from their trackers by announcing.  Torrents have
+priorities, as their files do, which can be changed through the control
+channels.
+
+The files of a torrent can be read while the torrent downloads, so that a
+control channel can stream them.  Reads are passed to the torrent's
+TorrentMgr, which gives priority to the pieces around what is being read.
+The files of a multi-file torrent can also be given priorities, or skipped,
+while it is being served.
+
+A torrent can be paused, which releases its connections, files and timers
+and tells its trackers it has stopped, and resumed later.  Paused torrents
+are recorded in the catalog and are only loaded, not served, when the client
+starts.  A torrent can also be removed, which forgets it but leaves its files
+where they are.
+
+The client's metrics, which the modules doing the work keep as they go, are
+served by the HTTP control channel.  The client adds the number of peers in
+each state, gathered from the torrents when the metrics are collected, and
+measures how late the reactor runs its calls.
 """
 
 import logging
 import logging.config
-import sys
 import time
 
+import httptracker
+import metrics
+import udptracker
 from ampcontrolserver import AMPControlServerFactory
+from argparse import ArgumentParser
+from catalog import Catalog, CatalogError
 from commands import MsgError
+from dht import DHTNode
+from lpd import LocalPeerDiscovery
+from magnet import MagnetLink
+from metadatamgr import MetadataMgr
 from httpcontrolserver import HTTPControlServer
-from torrentmgr import TorrentMgr
+from scheduler import Scheduler, SchedulerError
+from torrentmgr import TorrentMgr, TorrentMgrError
 
+from twisted.internet.defer import (DeferredList, DeferredSemaphore, fail,
+                                    maybeDeferred)
 from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.error import CannotListenError
 from twisted.internet import reactor
 
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger('bt')
 
+_PEERS = metrics.Gauge('bt_peers', "Peers of all torrents by state",
+                       ('state',))
+
 _AMP_CONTROL_PORT = 1060
+_MAX_UDP_SCRAPE = 74
+_SCRAPE_DELAY = 10
+_SCRAPE_INTERVAL = 900
+_DHT_STATE_FILE = 'dht.dat'
+_CATALOG_FILE = 'catalog.db'
+_OPEN_BATCH = 20
+_FETCH_CONCURRENCY = 8
 
 
 class BitTorrentClient(object):
-    def __init__(self, reactor, filenames):
+    def __init__(self, reactor, filenames, scheduler=None,
+                 status_interval=None):
         self._reactor = reactor
 
+        # The scheduler starts the torrents and shares resources among them
+        self._scheduler = scheduler or Scheduler(reactor)
+        self._scheduler.start()
+
         self._peer_id = "-HS0001-"+str(int(time.time())).zfill(12)
         self._torrents = {}
 
+        # _paused maps the info hash of each paused torrent to the priority
+        # it is to be given when it is resumed, and _resuming is the set of
+        # paused torrents which are being initialized again
+        self._paused = {}
+        self._resuming = set()
+
+        # _fetching maps the info hash of each magnet link whose metadata is
+        # being fetched to its MetadataMgr
+        self._fetching = {}
+
+        # _fetch_slots limits how many magnet links added by add_torrents()
+        # have their metadata fetched at once
+        self._fetch_slots = DeferredSemaphore(_FETCH_CONCURRENCY)
+
+        _PEERS.set_collector(self._peer_states)
+        self._reactor_lag = metrics.ReactorLag(reactor)
+        self._reactor_lag.start()
+
         # Send a placeholder for now until the Acceptor is available
         self._port = 6881
 
+        # Run a DHT node on the same port number over UDP.  Torrents are
+        # served without it if the port can't be used.
+        self._dht = DHTNode(reactor, state_file=_DHT_STATE_FILE)
+        try:
+            self._dht.start(self._port)
+        except CannotListenError:
+            logger.warning("Cannot listen for DHT on UDP port {}"
+                           .format(self._port))
+            self._dht = None
+
+        # Look for peers serving the same torrents on the local network
+        self._lpd = LocalPeerDiscovery(reactor, self._port, self._local_peer)
+        try:
+            self._lpd.start()
+        except CannotListenError:
+            logger.warning("Cannot listen for local peer discovery")
+            self._lpd = None
+
+        # Serve the torrents in the catalog again, starting once the reactor
+        # is running
+        try:
+            self._catalog = Catalog(_CATALOG_FILE)
+            self._reactor.callLater(.01, self._open_catalog,
+                                    self._catalog.entries())
+        except CatalogError as err:
+            logger.warning("Torrents won't be remembered: {}".format(err))
+            self._catalog = None
+
+        # Scrape the trackers every so often so that the Scheduler knows
+        # how healthy the swarms of queued torrents are
+        self._scrape_timer = self._reactor.callLater(_SCRAPE_DELAY,
+                                                     self._scrape_event)
+
         # Set up an amp control channel
         d = (TCP4ServerEndpoint(reactor, _AMP_CONTROL_PORT, 5, 'localhost')
              .listen(AMPControlServerFactory(self)))
@@ -51,75 +172,471 @@ class BitTorrentClient(object):
 
         # Schedule any torrents named on the command line to be added after
         # the reactor is running
-        for filename in sys.argv[1:]:
+        for filename in filenames:
             self._reactor.callLater(.01, self.add_torrent, (filename))
 
         # The following call starts the reactor
-        HTTPControlServer(self).app.run('localhost', 8080)
+        HTTPControlServer(self, reactor,
+                          status_interval).app.run('localhost', 8080)
 
     # Control channel functions
 
-    def get_torrents(self):
+    def get_torrents(self, info_hashes=None):
         """
-        Returns a dictionary of information about torrents the client is
-        handling keyed by the info hash.
+        Returns a dictionary of the summary of each torrent the client is
+        handling keyed by the info hash, or of those given by info_hashes
+        which it is handling.  Each torrent's summary is worked out at most
+        once a second, so asking for every torrent doesn't cost more with
+        every peer.
         """
-        torrents = {}
-        for info_hash in self._torrents:
-            status = self.get_status(info_hash)
-            torrents[info_hash] = {'name': self._torrents[info_hash].name(),
-                                   'percent': status['percent']}
-        return torrents
+        if info_hashes is None:
+            info_hashes = self._torrents.keys()
+        return dict((info_hash, self._summary(info_hash,
+                                              self._torrents[info_hash]))
+                    for info_hash in info_hashes
+                    if info_hash in self._torrents)
+
+    def _summary(self, info_hash, torrent):
+        # Returns the summary of the torrent, giving its name, state,
+        # priority, percent downloaded, download and upload rates in bytes
+        # per second, bytes left, estimated seconds to completion, counts of
+        # its peers and the number of pieces being downloaded.  The state is
+        # one of 'paused', 'queued', 'downloading' or 'complete'.
+        if info_hash in self._paused:
+            state = 'paused'
+            priority = self._paused[info_hash]
+        else:
+            if self._scheduler.is_queued(torrent):
+                state = 'queued'
+            elif torrent.is_complete():
+                state = 'complete'
+            else:
+                state = 'downloading'
+            priority = self._scheduler.priority(torrent)
+        summary = dict(torrent.summary())
+        summary.update({
+            'name': torrent.name(),
+            'state': state,
+            'paused': state == 'paused',
+            'queued': state == 'queued',
+            'priority': priority,
+            'percent': "{0:1.4f}".format(summary['percent']),
+            'download_rate': int(summary['download_rate']),
+            'upload_rate': int(summary['upload_rate'])})
+        return summary
 
     def add_torrent(self, filename):
         """
         Returns a deferred which eventually fires with the info_hash and the
-        name of the torrent specified by the filename.  In case of failure,
-        a MsgError exception is raised.
+        name of the torrent specified by the filename, which may instead be
+        a magnet link.  In case of failure, a MsgError exception is raised.
         """
+        if filename.startswith('magnet:'):
+            return self._add_magnet(filename)
+
         torrent = TorrentMgr(filename, self._port, self._peer_id,
-                             self._reactor)
+                             self._reactor, self._dht, self._catalog)
+        return maybeDeferred(self._serve, torrent, filename)
 
-        def success(value):
-            info_hash = torrent.info_hash().encode('hex')
-            if info_hash in self._torrents:
-                logger.debug("Already serving {} (key: {})"
-                             .format(filename, info_hash))
-                raise MsgError("Already serving {} (key: {})"
-                               .format(filename, info_hash))
+    def add_torrents(self, filenames):
+        """
+        Returns a deferred which fires with a list of the results of adding
+        the torrents specified by the filenames, in the same order.  Each
+        result is a tuple of True and the info_hash and name of the torrent,
+        as add_torrent() gives them, or of False and an error message.  At
+        most a few magnet links have their metadata fetched at once, however
+        many are added.  Torrents added from metainfo files are queued
+        straight away.
+        """
+        def results(results):
+            return [(success, value if success else value.value.message)
+                    for success, value in results]
+
+        ds = [self._fetch_slots.run(self.add_torrent, filename)
+              if filename.startswith('magnet:')
+              else self.add_torrent(filename)
+              for filename in filenames]
+        return DeferredList(ds, consumeErrors=True).addCallback(results)
 
-            torrent.start()
+    def _add_magnet(self, uri):
+        # Fetch the info dictionary of the torrent the magnet link refers to
+        # and then serve it as if it had been added from a metainfo file
+        try:
+            link = MagnetLink(uri)
+        except ValueError as err:
+            return fail(MsgError(err.message))
 
-            self._torrents[info_hash] = torrent
+        info_hash = link.info_hash.encode('hex')
+        if info_hash in self._torrents or info_hash in self._fetching:
+            logger.debug("Already serving {} (key: {})"
+                         .format(uri, info_hash))
+            return fail(MsgError("Already serving {} (key: {})"
+                                 .format(uri, info_hash)))
 
-            return info_hash, torrent.name()
+        fetcher = MetadataMgr(link, self._port, self._peer_id,
+                              self._reactor, self._dht)
+        self._fetching[info_hash] = fetcher
+
+        def fetched(metainfo):
+            del self._fetching[info_hash]
+            torrent = TorrentMgr(uri, self._port, self._peer_id,
+                                 self._reactor, self._dht, self._catalog,
+                                 metainfo=metainfo, peers=fetcher.peers())
+            return self._serve(torrent, uri)
 
         def failure(failure):
+            self._fetching.pop(info_hash, None)
             raise MsgError(failure.value.message)
 
-        return torrent.initialize().addCallbacks(success, failure)
+        return fetcher.fetch().addCallbacks(fetched, failure)
+
+    def _open_catalog(self, entries, start=0):
+        # Load a batch of the torrents in the catalog and leave the rest for
+        # later turns of the reactor.  The torrents are only loaded, and
+        # those which aren't paused are initialized by the Scheduler when it
+        # starts them.
+        for info_hash, filename, paused in entries[start:start+_OPEN_BATCH]:
+            torrent = TorrentMgr(filename, self._port, self._peer_id,
+                                 self._reactor, self._dht, self._catalog,
+                                 info_hash)
+            try:
+                torrent.load()
+            except TorrentMgrError as err:
+                logger.warning("Can't load {} from the catalog: {}"
+                               .format(filename, err))
+                continue
+            key = info_hash.encode('hex')
+            self._torrents[key] = torrent
+            if paused:
+                self._paused[key] = 1
+                continue
+            self._scheduler.add(torrent, failed=self._not_served)
+            if self._lpd:
+                self._lpd.add_torrent(torrent.info_hash())
+        if start+_OPEN_BATCH < len(entries):
+            self._reactor.callLater(0, self._open_catalog, entries,
+                                    start+_OPEN_BATCH)
+
+    def _serve(self, torrent, filename):
+        # Load a TorrentMgr and hand it to the Scheduler unless its torrent
+        # is already being served.  Like the torrents in the catalog, it is
+        # only initialized when the Scheduler starts it, so that a queued
+        # torrent holds no files, trackers or peers.  It is remembered in
+        # the catalog straight away so that it is served again even if the
+        # client is restarted before it is started.
+        try:
+            torrent.load()
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+
+        info_hash = torrent.info_hash().encode('hex')
+        if info_hash in self._torrents or info_hash in self._fetching:
+            logger.debug("Already serving {} (key: {})"
+                         .format(filename, info_hash))
+            raise MsgError("Already serving {} (key: {})"
+                           .format(filename, info_hash))
+
+        torrent.remember()
+        self._torrents[info_hash] = torrent
+        self._scheduler.add(torrent, failed=self._not_served)
+        if self._lpd:
+            self._lpd.add_torrent(torrent.info_hash())
+        return info_hash, torrent.name()
+
+    def _not_served(self, torrent, failure):
+        # A torrent which couldn't be initialized when the Scheduler started
+        # it is dropped from _torrents but stays in the catalog, so that it
+        # is tried again the next time the client starts
+        info_hash = torrent.info_hash().encode('hex')
+        logger.warning("Can't serve {}: {}"
+                       .format(torrent.name(), failure.value))
+        if self._torrents.get(info_hash) is torrent:
+            del self._torrents[info_hash]
+            if self._lpd:
+                self._lpd.remove_torrent(torrent.info_hash())
 
     def get_status(self, info_hash):
         """
         Returns a dictionary of status items related to the torrent specified
-        by the supplied info_hash.  Raises a MsgError exception if the info
-        hash is invalid.
+        by the supplied info_hash: its summary, as get_torrents() gives it,
+        and the statistics of each of its peers under 'peers'.  Raises a
+        MsgError exception if the info hash is invalid.
         """
         if info_hash in self._torrents:
-            return {'percent': "{0:1.4f}"
-                               .format(self._torrents[info_hash].percent())}
+            torrent = self._torrents[info_hash]
+            status = self._summary(info_hash, torrent)
+            status['peers'] = torrent.peer_stats()
+            return status
         else:
             logger.debug("Invalid key: {}".format(info_hash))
             raise MsgError("Invalid key: {}".format(info_hash))
 
+    def get_file(self, info_hash, index):
+        """
+        Returns a tuple of the name and length of the file with the index in
+        the torrent specified by the supplied info_hash.  Raises a MsgError
+        exception if the info hash or index is invalid.
+        """
+        path, _, length = self._file_span(info_hash, index)
+        return '/'.join(path), length
+
+    def read(self, info_hash, index, begin, length):
+        """
+        Returns a deferred which fires with the bytes of the file with the
+        index in the torrent specified by the supplied info_hash in the range
+        starting at begin, once they have been downloaded.  Raises a MsgError
+        exception if the info hash or index is invalid.
+        """
+        _, offset, file_length = self._file_span(info_hash, index)
+        return self._torrents[info_hash].read(offset + begin, length,
+                                              offset + file_length)
+
+    def get_files(self, info_hash):
+        """
+        Returns a list of dictionaries describing the files of the torrent
+        specified by the supplied info_hash, each with its index, name,
+        length, priority and percent downloaded.  Raises a MsgError exception
+        if the info hash is invalid.
+        """
+        return self._torrent(info_hash).files()
+
+    def set_priority(self, info_hash, index, priority):
+        """
+        Sets the priority of the file with the index in the torrent specified
+        by the supplied info_hash.  A priority of zero skips the file.  With
+        no index, sets the priority of the torrent itself, from one to seven.
+        Raises a MsgError exception if the info hash, index or priority is
+        invalid.
+        """
+        torrent = self._torrent(info_hash)
+        if index is None:
+            if info_hash in self._paused:
+                raise MsgError("Can't change the priority of paused torrent "
+                               "{}".format(info_hash))
+            try:
+                self._scheduler.set_priority(torrent, priority)
+            except SchedulerError as err:
+                raise MsgError(err.message)
+            return
+
+        priorities = torrent.priorities()
+        if not 0 <= index < len(priorities):
+            raise MsgError("Invalid file: {}".format(index))
+        priorities[index] = priority
+        try:
+            torrent.set_priorities(priorities)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+
+    def pause(self, info_hash):
+        """
+        Pauses the torrent specified by the supplied info_hash, releasing its
+        connections, files and timers and telling its trackers it has
+        stopped.  The torrent stays paused when the client is restarted.
+        Raises a MsgError exception if the info hash is invalid, the torrent
+        is already paused or it is being initialized to be started.
+        """
+        torrent = self._torrent(info_hash)
+        if info_hash in self._paused:
+            raise MsgError("Already paused: {}".format(info_hash))
+        if self._scheduler.is_initializing(torrent):
+            raise MsgError("Still starting: {}".format(info_hash))
+
+        self._paused[info_hash] = self._scheduler.priority(torrent)
+        self._scheduler.remove(torrent)
+        if self._lpd:
+            self._lpd.remove_torrent(torrent.info_hash())
+        if not torrent.is_stopped():
+            torrent.stop()
+        self._set_paused(torrent, True)
+
+    def resume(self, info_hash):
+        """
+        Returns a deferred which fires once the paused torrent specified by
+        the supplied info_hash is being served again, or queued to be.
+        Raises a MsgError exception if the info hash is invalid or the
+        torrent isn't paused, and the deferred fails with a MsgError if the
+        torrent can't be served.
+        """
+        torrent = self._torrent(info_hash)
+        if info_hash not in self._paused:
+            raise MsgError("Not paused: {}".format(info_hash))
+        if info_hash in self._resuming:
+            raise MsgError("Already resuming: {}".format(info_hash))
+        self._resuming.add(info_hash)
+
+        def success(value):
+            self._resuming.discard(info_hash)
+            if info_hash not in self._paused:
+                # The torrent was removed while it was being resumed
+                torrent.stop()
+                return
+            self._scheduler.add(torrent, self._paused.pop(info_hash))
+            if self._lpd:
+                self._lpd.add_torrent(torrent.info_hash())
+            self._set_paused(torrent, False)
+
+        def failure(failure):
+            self._resuming.discard(info_hash)
+            raise MsgError(failure.value.message)
+
+        return torrent.initialize().addCallbacks(success, failure)
+
+    def remove(self, info_hash):
+        """
+        Stops serving the torrent specified by the supplied info_hash and
+        forgets it, leaving its files where they are.  Raises a MsgError
+        exception if the info hash is invalid.
+        """
+        torrent = self._torrent(info_hash)
+        if info_hash not in self._paused:
+            self._scheduler.remove(torrent)
+            if self._lpd:
+                self._lpd.remove_torrent(torrent.info_hash())
+            # A torrent loaded from the catalog which is still queued, or
+            # being initialized, isn't being served yet
+            if not torrent.is_stopped():
+                torrent.stop()
+        torrent.forget()
+        del self._torrents[info_hash]
+        self._paused.pop(info_hash, None)
+        if self._catalog:
+            try:
+                self._catalog.remove(torrent.info_hash())
+            except CatalogError as err:
+                logger.warning("Can't remove {} from the catalog: {}"
+                               .format(torrent.name(), err))
+
+    def _set_paused(self, torrent, paused):
+        if self._catalog:
+            try:
+                self._catalog.set_paused(torrent.info_hash(), paused)
+            except CatalogError as err:
+                logger.warning("Can't record {} as paused: {}"
+                               .format(torrent.name(), err))
+
+    def _peer_states(self):
+        # Count the peers of all the torrents in each state for the metrics
+        states = {}
+        for torrent in self._torrents.values():
+            for state, count in torrent.peer_states().items():
+                states[(state,)] = states.get((state,), 0) + count
+        return states
+
+    def _torrent(self, info_hash):
+        if info_hash not in self._torrents:
+            logger.debug("Invalid key: {}".format(info_hash))
+            raise MsgError("Invalid key: {}".format(info_hash))
+        return self._torrents[info_hash]
+
+    def _file_span(self, info_hash, index):
+        try:
+            return self._torrent(info_hash).file_span(index)
+        except IndexError:
+            raise MsgError("Invalid file: {}".format(index))
+
+    def scrape(self):
+        """
+        Returns a deferred which fires with a dictionary of the swarm
+        statistics reported by the trackers, keyed by info hash.  Torrents
+        sharing a tracker are scraped together in as few requests as
+        possible.  Torrents whose tracker can't be scraped or fails to
+        respond are left out.
+        """
+        by_url = {}
+        for info_hash, torrent in self._torrents.items():
+            if info_hash in self._paused:
+                continue
+            url = torrent.scrape_url()
+            if url:
+                by_url.setdefault(url, []).append(info_hash.decode('hex'))
+
+        ds = []
+        for url, info_hashes in by_url.items():
+            if url.startswith('udp://'):
+                client = udptracker.shared_client(self._reactor)
+                ds.extend(client.scrape(url, info_hashes[i:i+_MAX_UDP_SCRAPE])
+                          for i in xrange(0, len(info_hashes),
+                                          _MAX_UDP_SCRAPE))
+            else:
+                client = httptracker.shared_client(self._reactor)
+                ds.append(client.scrape(url, info_hashes))
+
+        def combine(results):
+            stats = {}
+            for success, result in results:
+                if success:
+                    stats.update((info_hash.encode('hex'), counts)
+                                 for info_hash, counts in result.items())
+                else:
+                    logger.info("Scrape failed: {}".format(result.value))
+            return stats
+
+        return DeferredList(ds, consumeErrors=True).addCallback(combine)
+
+    def _scrape_event(self):
+        self._scrape_timer = self._reactor.callLater(_SCRAPE_INTERVAL,
+                                                     self._scrape_event)
+
+        def scraped(stats):
+            for info_hash, counts in stats.items():
+                torrent = self._torrents.get(info_hash)
+                if torrent:
+                    torrent.scraped(counts)
+
+        self.scrape().addCallback(scraped)
+
+    def _local_peer(self, info_hash, record):
+        torrent = self._torrents.get(info_hash.encode('hex'))
+        if torrent:
+            torrent.add_local_peer(record)
+
     def quit(self):
         """
         Stop the client by shutting down the reactor.
         """
         logger.info("Quitting BitTorrent Client")
+        for fetcher in self._fetching.values():
+            fetcher.stop()
+        self._scheduler.stop()
+        self._reactor_lag.stop()
+        if self._scrape_timer.active():
+            self._scrape_timer.cancel()
+        for info_hash, torrent in self._torrents.items():
+            if info_hash not in self._paused:
+                torrent.save()
+        if self._catalog:
+            self._catalog.close()
+        if self._dht:
+            self._dht.stop()
+        if self._lpd:
+            self._lpd.stop()
         self._reactor.stop()
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description="BitTorrent client")
+    parser.add_argument('filenames', nargs='*', metavar='filename',
+                        help="metainfo filename or magnet link")
+    parser.add_argument('-a', '--active', type=int, dest='active_limit',
+                        metavar='torrents',
+                        help="most torrents downloading at once")
+    parser.add_argument('-c', '--connections', type=int,
+                        dest='max_connections', metavar='connections',
+                        help="most peer connections in all")
+    parser.add_argument('-d', '--download-rate', type=int,
+                        dest='download_rate', metavar='bytes',
+                        help="download rate limit in bytes per second")
+    parser.add_argument('-u', '--update-interval', type=float,
+                        dest='status_interval', metavar='seconds',
+                        help="interval between status updates pushed to "
+                        "browsers")
+    args = vars(parser.parse_args())
+    filenames = args.pop('filenames')
+    status_interval = args.pop('status_interval')
+    limits = dict((name, value) for name, value in args.items()
+                  if value is not None)
+
     logger.info("Starting BitTorrent Client")
 
-    BitTorrentClient(reactor, sys.argv)
+    BitTorrentClient(reactor, filenames, Scheduler(reactor, **limits),
+                     status_interval)
@@ -15,9 +15,77 @@ class MsgAdd(amp.Command):
     errors = {MsgError: "MsgError"}
 
 
+# Adds many torrents at once.  The filenames are a json formatted list and
+# the results a json formatted list of the key or error message of each, in
+# the same order.
+class MsgAddMany(amp.Command):
+    arguments = [("filenames", amp.String())]
+    response = [("results", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
 class MsgStatus(amp.Command):
     arguments = [("key", amp.String())]
-    response = [("percent", amp.String())]
+    response = [("percent", amp.String()),
+                ("state", amp.String()),
+                ("priority", amp.Integer()),
+                ("download_rate", amp.Integer()),
+                ("upload_rate", amp.Integer()),
+                ("left", amp.Integer()),
+                ("eta", amp.Integer(optional=True)),
+                ("peer_count", amp.Integer()),
+                ("connected", amp.Integer()),
+                ("interested", amp.Integer()),
+                ("unchoked", amp.Integer()),
+                ("pieces_in_flight", amp.Integer()),
+                ("peers", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+# The status of a page of the torrents, as a json formatted string keyed by
+# info hash, and the number of torrents.  A page is limited so that the
+# string fits in an AMP value.
+class MsgTorrents(amp.Command):
+    arguments = [("offset", amp.Integer(optional=True)),
+                 ("limit", amp.Integer(optional=True))]
+    response = [("torrents", amp.String()),
+                ("total", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+# The status of the torrents with the keys in a json formatted list, as a
+# json formatted string keyed by info hash, and a json formatted list of the
+# keys which the client isn't handling.
+class MsgStatusMany(amp.Command):
+    arguments = [("keys", amp.String())]
+    response = [("torrents", amp.String()),
+                ("unknown", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgPriority(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("file", amp.Integer(optional=True)),
+                 ("priority", amp.Integer())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgPause(amp.Command):
+    arguments = [("key", amp.String())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgResume(amp.Command):
+    arguments = [("key", amp.String())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgRemove(amp.Command):
+    arguments = [("key", amp.String())]
+    response = []
     errors = {MsgError: "MsgError"}
 
 
@@ -5,10 +5,18 @@ using AMP messages over the control channel on localhost:1060.
 
 User commands:
 add [-h] [-n nickname] filename
-status [-h] key
+addmany [-h] filename [filename ...]
+status [-h] [-p] key
+statusmany [-h] key [key ...]
+list [-h]
+priority [-h] key file priority
+pause [-h] key
+resume [-h] key
+remove [-h] key
 quit
 """
 
+import json
 import sys
 
 from ampy import ampy
@@ -28,9 +36,68 @@ class MsgAdd(ampy.Command):
     errors = {MsgError: "MsgError"}
 
 
+class MsgAddMany(ampy.Command):
+    arguments = [("filenames", ampy.String())]
+    response = [("results", ampy.String())]
+    errors = {MsgError: "MsgError"}
+
+
 class MsgStatus(ampy.Command):
     arguments = [("key", ampy.String())]
-    response = [("percent", ampy.String())]
+    response = [("percent", ampy.String()),
+                ("state", ampy.String()),
+                ("priority", ampy.Integer()),
+                ("download_rate", ampy.Integer()),
+                ("upload_rate", ampy.Integer()),
+                ("left", ampy.Integer()),
+                ("eta", ampy.Integer()),
+                ("peer_count", ampy.Integer()),
+                ("connected", ampy.Integer()),
+                ("interested", ampy.Integer()),
+                ("unchoked", ampy.Integer()),
+                ("pieces_in_flight", ampy.Integer()),
+                ("peers", ampy.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgStatusMany(ampy.Command):
+    arguments = [("keys", ampy.String())]
+    response = [("torrents", ampy.String()),
+                ("unknown", ampy.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgTorrents(ampy.Command):
+    arguments = [("offset", ampy.Integer()),
+                 ("limit", ampy.Integer())]
+    response = [("torrents", ampy.String()),
+                ("total", ampy.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgPriority(ampy.Command):
+    arguments = [("key", ampy.String()),
+                 ("file", ampy.Integer()),
+                 ("priority", ampy.Integer())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgPause(ampy.Command):
+    arguments = [("key", ampy.String())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgResume(ampy.Command):
+    arguments = [("key", ampy.String())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgRemove(ampy.Command):
+    arguments = [("key", ampy.String())]
+    response = []
     errors = {MsgError: "MsgError"}
 
 
@@ -38,6 +105,23 @@ class MsgQuit(ampy.Command):
     arguments = []
 
 
+# The number of torrents asked for or added at a time by the list, addmany
+# and statusmany commands
+_PAGE_SIZE = 50
+
+
+def _rate(rate):
+    return "{:.1f} KB/s".format(rate / 1024.0)
+
+
+def _eta(eta):
+    if eta is None:
+        return "unknown"
+    minutes, seconds = divmod(eta, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
 class Console(Cmd):
     prompt = "BT Console: "
     intro = "BitTorrent Console"
@@ -47,13 +131,49 @@ class Console(Cmd):
 
         self.addparser = ArgumentParser('add')
         self.addparser.add_argument('filename', action='store',
-                                    help="metainfo filename")
+                                    help="metainfo filename or magnet link")
         self.addparser.add_argument('-n', action='store',
                                     help="nickname", metavar="nickname")
 
+        self.addmanyparser = ArgumentParser('addmany')
+        self.addmanyparser.add_argument('filenames', action='store',
+                                        nargs='+', metavar='filename',
+                                        help="metainfo filename or magnet "
+                                             "link")
+
         self.statusparser = ArgumentParser('status')
         self.statusparser.add_argument('key', action='store',
                                        help="key or nickname")
+        self.statusparser.add_argument('-p', action='store_true',
+                                       help="list the peers")
+
+        self.statusmanyparser = ArgumentParser('statusmany')
+        self.statusmanyparser.add_argument('keys', action='store', nargs='+',
+                                           metavar='key',
+                                           help="key or nickname")
+
+        self.listparser = ArgumentParser('list')
+
+        self.priorityparser = ArgumentParser('priority')
+        self.priorityparser.add_argument('key', action='store',
+                                         help="key or nickname")
+        self.priorityparser.add_argument('file', action='store', type=int,
+                                         help="file index")
+        self.priorityparser.add_argument('priority', action='store',
+                                         type=int,
+                                         help="priority from 0 (skip) to 7")
+
+        self.pauseparser = ArgumentParser('pause')
+        self.pauseparser.add_argument('key', action='store',
+                                      help="key or nickname")
+
+        self.resumeparser = ArgumentParser('resume')
+        self.resumeparser.add_argument('key', action='store',
+                                       help="key or nickname")
+
+        self.removeparser = ArgumentParser('remove')
+        self.removeparser.add_argument('key', action='store',
+                                       help="key or nickname")
 
         self.nicknames = {}
 
@@ -88,6 +208,29 @@ class Console(Cmd):
 
         print "Adding {} (key: {})".format(filename, result['key'])
 
+    def do_addmany(self, args):
+        try:
+            filenames = self.addmanyparser.parse_args(args.split()).filenames
+        except:
+            return
+
+        # Add the torrents a batch at a time, since the server limits how
+        # many are added in one message
+        for start in range(0, len(filenames), _PAGE_SIZE):
+            batch = filenames[start:start + _PAGE_SIZE]
+            try:
+                result = self.proxy.callRemote(MsgAddMany,
+                                               filenames=json.dumps(batch))
+            except Exception as err:
+                print err.message
+                return
+
+            for filename, item in zip(batch, json.loads(result['results'])):
+                if 'key' in item:
+                    print "Adding {} (key: {})".format(filename, item['key'])
+                else:
+                    print "Can't add {}: {}".format(filename, item['error'])
+
     def do_status(self, args):
         try:
             result = vars(self.statusparser.parse_args(args.split()))
@@ -99,12 +242,159 @@ class Console(Cmd):
             key = self.nicknames[key]
 
         try:
-            result = self.proxy.callRemote(MsgStatus, key=key)
+            status = self.proxy.callRemote(MsgStatus, key=key)
         except Exception as err:
             print err.message
             return
 
-        print result['percent'] + "% downloaded"
+        print "{}% downloaded, {}, priority {}".format(
+            status['percent'], status['state'], status['priority'])
+        print "down {}, up {}, {} bytes left, eta {}".format(
+            _rate(status['download_rate']), _rate(status['upload_rate']),
+            status['left'], _eta(status.get('eta')))
+        print ("{} peers, {} connected, {} interested, {} unchoked, "
+               "{} pieces in flight".format(
+                   status['peer_count'], status['connected'],
+                   status['interested'], status['unchoked'],
+                   status['pieces_in_flight']))
+
+        if result['p']:
+            for peer in json.loads(status['peers']):
+                print "  {:21} {:12} down {:>12} up {:>12} piece {}".format(
+                    peer['addr'], peer['state'],
+                    _rate(peer['download_rate']),
+                    _rate(peer['upload_rate']), peer['piece'])
+
+    def do_statusmany(self, args):
+        try:
+            keys = self.statusmanyparser.parse_args(args.split()).keys
+        except:
+            return
+
+        keys = [self.nicknames.get(key, key) for key in keys]
+        torrents = {}
+        for start in range(0, len(keys), _PAGE_SIZE):
+            try:
+                result = self.proxy.callRemote(
+                    MsgStatusMany,
+                    keys=json.dumps(keys[start:start + _PAGE_SIZE]))
+            except Exception as err:
+                print err.message
+                return
+
+            torrents.update(json.loads(result['torrents']))
+            for key in json.loads(result['unknown']):
+                print "Invalid key: {}".format(key)
+
+        self._print_torrents(torrents)
+
+    def do_list(self, args):
+        try:
+            self.listparser.parse_args(args.split())
+        except:
+            return
+
+        # Ask for the torrents a page at a time, since the status of every
+        # torrent mightn't fit in one message
+        torrents = {}
+        offset = 0
+        while True:
+            try:
+                result = self.proxy.callRemote(MsgTorrents, offset=offset,
+                                               limit=_PAGE_SIZE)
+            except Exception as err:
+                print err.message
+                return
+            torrents.update(json.loads(result['torrents']))
+            offset += _PAGE_SIZE
+            if offset >= result['total']:
+                break
+
+        self._print_torrents(torrents)
+
+    def _print_torrents(self, torrents):
+        # Print a line summarizing each of the torrents, keyed by info hash
+        nicknames = dict((key, nickname)
+                         for nickname, key in self.nicknames.items())
+        for key, status in sorted(torrents.items()):
+            print "{} {:>9}% {:11} down {:>12} up {:>12} eta {:>9} {}".format(
+                nicknames.get(key, key[:8]), status['percent'],
+                status['state'], _rate(status['download_rate']),
+                _rate(status['upload_rate']), _eta(status['eta']),
+                status['name'])
+
+    def do_priority(self, args):
+        try:
+            result = vars(self.priorityparser.parse_args(args.split()))
+        except:
+            return
+
+        key = result['key']
+        if key in self.nicknames:
+            key = self.nicknames[key]
+
+        try:
+            self.proxy.callRemote(MsgPriority, key=key, file=result['file'],
+                                  priority=result['priority'])
+        except Exception as err:
+            print err.message
+            return
+
+        print "File {} priority set to {}".format(result['file'],
+                                                  result['priority'])
+
+    def do_pause(self, args):
+        key = self._key(self.pauseparser, args)
+        if key is None:
+            return
+
+        try:
+            self.proxy.callRemote(MsgPause, key=key)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Paused {}".format(key)
+
+    def do_resume(self, args):
+        key = self._key(self.resumeparser, args)
+        if key is None:
+            return
+
+        try:
+            self.proxy.callRemote(MsgResume, key=key)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Resumed {}".format(key)
+
+    def do_remove(self, args):
+        key = self._key(self.removeparser, args)
+        if key is None:
+            return
+
+        try:
+            self.proxy.callRemote(MsgRemove, key=key)
+        except Exception as err:
+            print err.message
+            return
+
+        for nickname, value in self.nicknames.items():
+            if value == key:
+                del self.nicknames[nickname]
+        print "Removed {}".format(key)
+
+    def _key(self, parser, args):
+        # Returns the key given by the arguments, which may be a nickname,
+        # or None if the arguments can't be parsed
+        try:
+            result = vars(parser.parse_args(args.split()))
+        except:
+            return None
+
+        key = result['key']
+        return self.nicknames.get(key, key)
 
     def do_quit(self, args):
         self.proxy.callRemoteNoAnswer(MsgQuit)
@@ -116,9 +406,30 @@ class Console(Cmd):
     def help_add(self):
         self.addparser.print_help()
 
+    def help_addmany(self):
+        self.addmanyparser.print_help()
+
+    def help_statusmany(self):
+        self.statusmanyparser.print_help()
+
     def help_status(self):
         self.statusparser.print_help()
 
+    def help_list(self):
+        self.listparser.print_help()
+
+    def help_priority(self):
+        self.priorityparser.print_help()
+
+    def help_pause(self):
+        self.pauseparser.print_help()
+
+    def help_resume(self):
+        self.resumeparser.print_help()
+
+    def help_remove(self):
+        self.removeparser.print_help()
+
     def postloop(self):
         print
 
@@ -0,0 +1,647 @@
+"""
+The DHTNode takes part in the Mainline DHT (BEP 5), a Kademlia distributed
+hash table in which BitTorrent clients store and look up the addresses of
+peers for torrents without a tracker.  A single node, listening on one UDP
+port, serves every torrent in the process.
+
+Every node has a random 160 bit id, and the distance between two ids is their
+exclusive or.  The RoutingTable keeps contacts sorted into buckets by
+distance, each holding at most K nodes.  Only the bucket covering the node's
+own id is ever split, so the table knows many nodes close to itself and a few
+far away.  A contact which fails to respond to several queries in a row is
+dropped, and one which has failed to respond at all makes way for a new
+contact when its bucket is full.  Buckets which haven't changed in fifteen
+minutes are refreshed by looking up a random id in their range.
+
+Nodes talk using KRPC, bencoded dictionaries sent in single datagrams.  The
+node answers ping, find_node, get_peers and announce_peer queries from other
+nodes.  To find peers for a torrent, it performs an iterative lookup,
+querying the nodes closest to the info hash it knows about, a few at a time,
+and moving on to the closer nodes they return until no closer node turns up.
+Nodes along the way may return peers.  Responses to get_peers carry a token
+which the querying node must present to announce itself as a peer.  Tokens
+are derived from the querier's IP address and a secret which changes every
+five minutes, and tokens made with the current or previous secret are
+accepted.  Announced peers are forgotten after thirty minutes unless
+announced again.
+
+The routing table is saved to the state file, if one is given, when the node
+stops and periodically while it runs, so that the next start can bootstrap
+from known contacts rather than only the well known bootstrap nodes.  The
+bootstrap nodes, the interface and the port can all be specified, so that
+many nodes can run in one process and talk to each other over loopback.
+
+get_peers() and announce() return deferreds which fire with lists of peers as
+compact records (see peeraddr).
+"""
+
+import hashlib
+import logging
+import os
+import random
+import struct
+
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.defer import Deferred, DeferredList, fail
+from twisted.internet.protocol import DatagramProtocol
+
+import bencoding
+import peeraddr
+
+logger = logging.getLogger('bt.dht')
+
+K = 8
+
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881),
+                   ('router.utorrent.com', 6881),
+                   ('dht.transmissionbt.com', 6881)]
+
+_ALPHA = 3
+_QUERY_TIMEOUT = 10
+_MAX_FAILURES = 3
+_BUCKET_REFRESH = 15 * 60
+_TOKEN_ROTATION = 5 * 60
+_PEER_LIFETIME = 30 * 60
+_MAX_TORRENTS = 2000
+_MAX_PEERS_PER_TORRENT = 500
+_MAX_VALUES = 50
+_SAVE_INTERVAL = 10 * 60
+_TIMER_INTERVAL = 60
+
+_ID_LENGTH = 20
+_NODE_LENGTH = _ID_LENGTH + peeraddr.IPV4_LENGTH
+_TOKEN_LENGTH = 8
+
+_GENERIC_ERROR = 201
+_PROTOCOL_ERROR = 203
+_METHOD_UNKNOWN = 204
+
+
+class DHTError(Exception):
+    pass
+
+
+def _to_int(node_id):
+    return long(node_id.encode('hex'), 16)
+
+
+def _from_int(value):
+    return ('{:040x}'.format(value)).decode('hex')
+
+
+def _encode_nodes(nodes):
+    compact = []
+    for node in nodes:
+        record = peeraddr.from_addr(node.addr)
+        if record and not peeraddr.is_ipv6(record):
+            compact.append(node.node_id + record)
+    return ''.join(compact)
+
+
+def _decode_nodes(compact):
+    # Returns a list of (node_id, addr) tuples from compact node info
+    compact = str(compact)
+    nodes = []
+    for offset in xrange(0, len(compact) - len(compact) % _NODE_LENGTH,
+                         _NODE_LENGTH):
+        node_id = compact[offset:offset+_ID_LENGTH]
+        record = compact[offset+_ID_LENGTH:offset+_NODE_LENGTH]
+        nodes.append((node_id, peeraddr.to_addr(record)))
+    return nodes
+
+
+class _Node(object):
+    def __init__(self, node_id, addr, last_seen):
+        self.node_id = node_id
+        self.addr = addr
+        self.last_seen = last_seen
+        self.failures = 0
+
+
+class _Bucket(object):
+    def __init__(self, low, high, now):
+        # The bucket holds the nodes whose ids fall in [low, high).  nodes
+        # maps node ids to nodes and order lists the ids from least to most
+        # recently seen.
+        self.low = low
+        self.high = high
+        self.nodes = {}
+        self.order = []
+        self.last_changed = now
+
+    def covers(self, value):
+        return self.low <= value < self.high
+
+    def touch(self, node_id):
+        self.order.remove(node_id)
+        self.order.append(node_id)
+
+
+class RoutingTable(object):
+    def __init__(self, own_id, now, k=K):
+        self._own = _to_int(own_id)
+        self._k = k
+        self._buckets = [_Bucket(0, 2**160, now)]
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self._buckets)
+
+    def _bucket(self, value):
+        for bucket in self._buckets:
+            if bucket.covers(value):
+                return bucket
+
+    def update(self, node_id, addr, now):
+        """
+        update() records that a node has been heard from, adding it to the
+        table if there is room.
+        """
+        value = _to_int(node_id)
+        if value == self._own:
+            return
+
+        bucket = self._bucket(value)
+        node = bucket.nodes.get(node_id)
+        if node:
+            node.addr = addr
+            node.last_seen = now
+            node.failures = 0
+            bucket.touch(node_id)
+            bucket.last_changed = now
+            return
+
+        # A full bucket is split if it covers this node's id.  Otherwise,
+        # the least recently seen node which has failed to respond makes
+        # way for the new node, and if there is no such node the new node
+        # is ignored.
+        while len(bucket.nodes) >= self._k:
+            if not bucket.covers(self._own):
+                failing = [old_id for old_id in bucket.order
+                           if bucket.nodes[old_id].failures]
+                if not failing:
+                    return
+                del bucket.nodes[failing[0]]
+                bucket.order.remove(failing[0])
+                break
+            self._split(bucket)
+            bucket = self._bucket(value)
+
+        bucket.nodes[node_id] = _Node(node_id, addr, now)
+        bucket.order.append(node_id)
+        bucket.last_changed = now
+
+    def _split(self, bucket):
+        middle = (bucket.low + bucket.high) / 2
+        upper = _Bucket(middle, bucket.high, bucket.last_changed)
+        bucket.high = middle
+        for node_id in list(bucket.order):
+            if not bucket.covers(_to_int(node_id)):
+                upper.nodes[node_id] = bucket.nodes.pop(node_id)
+                bucket.order.remove(node_id)
+                upper.order.append(node_id)
+        self._buckets.insert(self._buckets.index(bucket) + 1, upper)
+
+    def failed(self, node_id):
+        """
+        failed() records that a node didn't respond to a query.  A node
+        which has failed too many times in a row is removed.
+        """
+        bucket = self._bucket(_to_int(node_id))
+        node = bucket.nodes.get(node_id)
+        if node:
+            node.failures += 1
+            if node.failures >= _MAX_FAILURES:
+                del bucket.nodes[node_id]
+                bucket.order.remove(node_id)
+
+    def closest(self, target, n):
+        """
+        closest() returns up to n nodes closest to the target id.
+        """
+        value = _to_int(target)
+        nodes = [node for bucket in self._buckets
+                 for node in bucket.nodes.values()]
+        nodes.sort(key=lambda node: _to_int(node.node_id) ^ value)
+        return nodes[:n]
+
+    def nodes(self):
+        return [node for bucket in self._buckets
+                for node in bucket.nodes.values()]
+
+    def stale(self, now):
+        """
+        stale() returns a random id in the range of each bucket which hasn't
+        changed within the refresh interval.
+        """
+        ids = []
+        for bucket in self._buckets:
+            if now - bucket.last_changed >= _BUCKET_REFRESH:
+                bucket.last_changed = now
+                ids.append(_from_int(random.randrange(bucket.low,
+                                                      bucket.high)))
+        return ids
+
+
+class DHTNode(DatagramProtocol):
+    def __init__(self, reactor, node_id=None, state_file=None,
+                 bootstrap=BOOTSTRAP_NODES):
+        self._reactor = reactor
+        self._state_file = state_file
+        self._bootstrap = bootstrap
+
+        saved_nodes = []
+        if state_file:
+            saved_id, saved_nodes = self._load()
+            node_id = node_id or saved_id
+
+        self._id = node_id or os.urandom(_ID_LENGTH)
+        now = reactor.seconds()
+        self._table = RoutingTable(self._id, now)
+        for saved_id, addr in saved_nodes:
+            self._table.update(saved_id, addr, now)
+
+        # _transactions maps the transaction id of each outstanding query to
+        # a tuple of the deferred to fire with the response, the timer for
+        # the query's timeout, the address queried and the id of the node
+        # queried if known
+        self._transactions = {}
+        self._next_transaction = random.getrandbits(16)
+
+        # _peers maps each info hash which peers have announced to a
+        # dictionary mapping the record of each peer to the time it expires
+        self._peers = {}
+
+        self._secret = os.urandom(20)
+        self._previous_secret = self._secret
+        self._next_rotation = now + _TOKEN_ROTATION
+        self._next_save = now + _SAVE_INTERVAL
+
+        self._port = None
+        self._timer = None
+
+    def node_id(self):
+        return self._id
+
+    def port(self):
+        return self._port.getHost().port if self._port else None
+
+    def routing_table(self):
+        return self._table
+
+    def start(self, port=0, interface=''):
+        """
+        start() starts listening on the UDP port and bootstraps the routing
+        table.  It returns a deferred which fires when bootstrapping is
+        done.  It raises a CannotListenError if the port is not available.
+        """
+        self._port = self._reactor.listenUDP(port, self, interface=interface)
+        self._timer = self._reactor.callLater(_TIMER_INTERVAL,
+                                              self._timer_event)
+        return self.bootstrap()
+
+    def stop(self):
+        """
+        stop() saves the routing table, fails any outstanding queries and
+        stops listening.
+        """
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._save()
+
+        # The port is forgotten first so that lookups which go on to query
+        # other nodes when their queries fail are refused straight away
+        port, self._port = self._port, None
+        transactions, self._transactions = self._transactions, {}
+        for d, timer, _, _ in transactions.values():
+            timer.cancel()
+            d.errback(DHTError("DHT node stopped"))
+
+        if port:
+            return port.stopListening()
+
+    def bootstrap(self):
+        """
+        bootstrap() asks the bootstrap nodes for nodes close to this one and
+        then looks up this node's own id to fill the routing table.
+        """
+        def query(ip, port):
+            return self._query((ip, port), 'find_node', {'target': self._id})
+
+        ds = []
+        for host, port in self._bootstrap:
+            if isIPAddress(host):
+                d = query(host, port)
+            else:
+                d = (self._reactor.resolve(host)
+                     .addCallback(query, port))
+            ds.append(d.addErrback(lambda failure: None))
+
+        return (DeferredList(ds)
+                .addCallback(lambda _: self._lookup(self._id, 'find_node'))
+                .addCallback(lambda _: None))
+
+    def get_peers(self, info_hash):
+        """
+        get_peers() returns a deferred which fires with a list of the
+        records of peers which have announced the torrent.
+        """
+        return (self._lookup(info_hash, 'get_peers')
+                .addCallback(lambda (nodes, peers): peers))
+
+    def announce(self, info_hash, port):
+        """
+        announce() looks up peers for the torrent and then announces this
+        client as a peer listening on the port to the closest nodes.  It
+        returns a deferred which fires with the list of peers found.
+        """
+        def found((nodes, peers)):
+            for node_id, addr, token in nodes:
+                (self._query(addr, 'announce_peer',
+                             {'info_hash': info_hash, 'port': port,
+                              'token': token}, node_id)
+                 .addErrback(lambda failure: None))
+            return peers
+
+        return self._lookup(info_hash, 'get_peers').addCallback(found)
+
+    def _lookup(self, target, method):
+        # Performs an iterative lookup of the target.  Returns a deferred
+        # which fires with a tuple of a list of (node_id, addr, token)
+        # tuples of the closest nodes which responded and a list of the
+        # peers returned along the way.
+        d = Deferred()
+        value = _to_int(target)
+        candidates = {node.node_id: node.addr
+                      for node in self._table.closest(target, K)}
+        queried = set()
+        responded = {}
+        peers = set()
+        if method == 'get_peers':
+            peers.update(self._stored_peers(target))
+        pending = [0]
+        argument = 'target' if method == 'find_node' else 'info_hash'
+
+        def distance(node_id):
+            return _to_int(node_id) ^ value
+
+        def response(r, node_id):
+            pending[0] -= 1
+            responded[node_id] = r.get('token')
+            for other_id, addr in self._response_nodes(r):
+                if other_id != self._id:
+                    candidates.setdefault(other_id, addr)
+            values = r.get('values', [])
+            if isinstance(values, list):
+                peers.update(v for v in values if isinstance(v, str)
+                             and len(v) == peeraddr.IPV4_LENGTH)
+            step()
+
+        def failure(failure, node_id):
+            pending[0] -= 1
+            candidates.pop(node_id, None)
+            step()
+
+        def step():
+            if d.called:
+                return
+            closest = sorted(candidates, key=distance)[:K]
+            todo = [node_id for node_id in closest if node_id not in queried]
+            if not todo and pending[0] == 0:
+                nodes = [(node_id, candidates[node_id], responded[node_id])
+                         for node_id in sorted(responded, key=distance)
+                         if node_id in candidates][:K]
+                d.callback(([n for n in nodes if isinstance(n[2], str)],
+                            list(peers)))
+                return
+            for node_id in todo[:max(0, _ALPHA - pending[0])]:
+                queried.add(node_id)
+                pending[0] += 1
+                (self._query(candidates[node_id], method,
+                             {argument: target}, node_id)
+                 .addCallbacks(response, failure,
+                               callbackArgs=(node_id,),
+                               errbackArgs=(node_id,)))
+
+        step()
+        return d
+
+    def _response_nodes(self, r):
+        # Returns the nodes in a response.  They are only added to the
+        # routing table once they respond to a query themselves.
+        try:
+            return _decode_nodes(r.get('nodes', ''))
+        except (TypeError, ValueError):
+            return []
+
+    def _new_transaction_id(self):
+        self._next_transaction = (self._next_transaction + 1) % 2**16
+        return struct.pack('>H', self._next_transaction)
+
+    def _query(self, addr, method, args, node_id=None):
+        # Sends a query and returns a deferred which fires with the response
+        # dictionary or fails with a DHTError
+        if not self._port:
+            return fail(DHTError("DHT node not started"))
+
+        transaction_id = self._new_transaction_id()
+        args = dict(args, id=self._id)
+        message = {'t': transaction_id, 'y': 'q', 'q': method, 'a': args}
+
+        d = Deferred()
+
+        def expire():
+            del self._transactions[transaction_id]
+            if node_id:
+                self._table.failed(node_id)
+            d.errback(DHTError("No response from {}:{}".format(*addr)))
+
+        timer = self._reactor.callLater(_QUERY_TIMEOUT, expire)
+        self._transactions[transaction_id] = (d, timer, addr, node_id)
+        self._send(message, addr)
+        return d
+
+    def _send(self, message, addr):
+        try:
+            self.transport.write(bencoding.encode(message), addr)
+        except Exception as err:
+            logger.debug("Can't send to {}:{}: {}".format(addr[0], addr[1],
+                                                         err))
+
+    def datagramReceived(self, data, addr):
+        try:
+            message = bencoding.decode(data)
+        except Exception:
+            return
+        if not isinstance(message, dict) or 't' not in message:
+            return
+
+        kind = message.get('y')
+        if kind == 'q':
+            self._handle_query(message, addr)
+        elif kind in ('r', 'e'):
+            self._handle_response(message, addr)
+
+    def _handle_response(self, message, addr):
+        transaction_id = message['t']
+        if transaction_id not in self._transactions:
+            return
+        d, timer, expected_addr, node_id = self._transactions[transaction_id]
+        if addr != expected_addr:
+            return
+        del self._transactions[transaction_id]
+        timer.cancel()
+
+        r = message.get('r')
+        if (message['y'] == 'e' or not isinstance(r, dict) or
+                not isinstance(r.get('id'), str) or
+                len(r['id']) != _ID_LENGTH):
+            if node_id:
+                self._table.failed(node_id)
+            d.errback(DHTError("Error response from {}:{}: {}"
+                               .format(addr[0], addr[1], message.get('e'))))
+            return
+
+        self._table.update(r['id'], addr, self._reactor.seconds())
+        d.callback(r)
+
+    def _handle_query(self, message, addr):
+        method = message.get('q')
+        args = message.get('a')
+        if (not isinstance(args, dict) or
+                not isinstance(args.get('id'), str) or
+                len(args['id']) != _ID_LENGTH):
+            self._error(message, addr, _PROTOCOL_ERROR, "Invalid arguments")
+            return
+
+        self._table.update(args['id'], addr, self._reactor.seconds())
+
+        handler = {'ping': self._rx_ping,
+                   'find_node': self._rx_find_node,
+                   'get_peers': self._rx_get_peers,
+                   'announce_peer': self._rx_announce_peer}.get(method)
+        if not handler:
+            self._error(message, addr, _METHOD_UNKNOWN, "Method Unknown")
+            return
+
+        try:
+            r = handler(args, addr)
+        except (KeyError, TypeError, ValueError):
+            self._error(message, addr, _PROTOCOL_ERROR, "Invalid arguments")
+            return
+        if isinstance(r, tuple):
+            self._error(message, addr, *r)
+            return
+
+        r['id'] = self._id
+        self._send({'t': message['t'], 'y': 'r', 'r': r}, addr)
+
+    def _error(self, message, addr, code, text):
+        self._send({'t': message['t'], 'y': 'e', 'e': [code, text]}, addr)
+
+    def _target(self, args, name):
+        target = args[name]
+        if not isinstance(target, str) or len(target) != _ID_LENGTH:
+            raise ValueError("Invalid {}".format(name))
+        return target
+
+    def _closest_nodes(self, target):
+        return _encode_nodes(self._table.closest(target, K))
+
+    def _rx_ping(self, args, addr):
+        return {}
+
+    def _rx_find_node(self, args, addr):
+        return {'nodes': self._closest_nodes(self._target(args, 'target'))}
+
+    def _rx_get_peers(self, args, addr):
+        info_hash = self._target(args, 'info_hash')
+        r = {'token': self._token(addr[0], self._secret),
+             'nodes': self._closest_nodes(info_hash)}
+        peers = self._stored_peers(info_hash)
+        if peers:
+            r['values'] = random.sample(peers, min(len(peers), _MAX_VALUES))
+        return r
+
+    def _rx_announce_peer(self, args, addr):
+        info_hash = self._target(args, 'info_hash')
+        token = args['token']
+        if token not in (self._token(addr[0], self._secret),
+                         self._token(addr[0], self._previous_secret)):
+            return (_PROTOCOL_ERROR, "Bad token")
+
+        port = addr[1] if args.get('implied_port') else args['port']
+        record = peeraddr.from_addr((addr[0], port))
+        if not record:
+            return (_PROTOCOL_ERROR, "Invalid port")
+
+        if info_hash not in self._peers and len(self._peers) >= _MAX_TORRENTS:
+            return (_GENERIC_ERROR, "Too many torrents")
+        peers = self._peers.setdefault(info_hash, {})
+        if record in peers or len(peers) < _MAX_PEERS_PER_TORRENT:
+            peers[record] = self._reactor.seconds() + _PEER_LIFETIME
+        return {}
+
+    def _token(self, ip, secret):
+        return hashlib.sha1(secret + ip).digest()[:_TOKEN_LENGTH]
+
+    def _stored_peers(self, info_hash):
+        return list(self._peers.get(info_hash, {}))
+
+    def _expire_peers(self, now):
+        for info_hash, peers in self._peers.items():
+            for record, expires in peers.items():
+                if expires <= now:
+                    del peers[record]
+            if not peers:
+                del self._peers[info_hash]
+
+    def _timer_event(self):
+        self._timer = self._reactor.callLater(_TIMER_INTERVAL,
+                                              self._timer_event)
+        now = self._reactor.seconds()
+
+        if now >= self._next_rotation:
+            self._next_rotation = now + _TOKEN_ROTATION
+            self._previous_secret = self._secret
+            self._secret = os.urandom(20)
+
+        self._expire_peers(now)
+
+        for target in self._table.stale(now):
+            self._lookup(target, 'find_node')
+
+        if now >= self._next_save:
+            self._next_save = now + _SAVE_INTERVAL
+            self._save()
+
+    def _load(self):
+        # Returns a tuple of the saved node id and a list of (node_id, addr)
+        # tuples of the saved contacts
+        if not os.path.exists(self._state_file):
+            return None, []
+        try:
+            with open(self._state_file, 'rb') as f:
+                state = bencoding.decode(f.read())
+            node_id = state['id']
+            if not isinstance(node_id, str) or len(node_id) != _ID_LENGTH:
+                raise ValueError("Invalid node id")
+            return node_id, _decode_nodes(state.get('nodes', ''))
+        except Exception as err:
+            logger.warning("Ignoring DHT state file {}: {}"
+                           .format(self._state_file, err))
+            return None, []
+
+    def _save(self):
+        if not self._state_file:
+            return
+        state = {'id': self._id,
+                 'nodes': _encode_nodes(self._table.nodes())}
+        temporary = self._state_file + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(bencoding.encode(state))
+            os.rename(temporary, self._state_file)
+        except (IOError, OSError) as err:
+            logger.warning("Can't save DHT state file {}: {}"
+                           .format(self._state_file, err))
@@ -0,0 +1,111 @@
+"""
+The estimators measure how a connection is performing so that the TorrentMgr
+can make decisions based on observed behavior rather than fixed constants.
+
+A RateEstimator measures throughput over a sliding window of recent seconds.
+The window is kept as a ring of one second buckets so that recording a
+transfer and reading the rate are both cheap regardless of how many transfers
+have occurred.  The caller supplies the current time on each call which keeps
+the estimator independent of the reactor and easy to drive from a test.
+
+An RTTEstimator smooths round trip time samples using the method TCP uses
+for its retransmission timer (RFC 6298).  It keeps a smoothed round trip time
+and a smoothed mean deviation and derives a timeout from them.  Until the
+first sample arrives, a conservative initial timeout is used.
+"""
+
+_WINDOW = 20
+
+_INITIAL_TIMEOUT = 20.0
+_MIN_TIMEOUT = 2.0
+_MAX_TIMEOUT = 60.0
+_ALPHA = 0.125
+_BETA = 0.25
+_K = 4
+
+
+class RateEstimator(object):
+    def __init__(self, window=_WINDOW):
+        self._window = window
+        self._buckets = [0] * window
+        self._second = None
+        self._start = None
+        self._in_window = 0
+        self._total = 0
+
+    def _advance(self, now):
+        # Move the window forward to the current second, clearing the buckets
+        # for any seconds that passed without a transfer
+        second = int(now)
+        if self._second is None:
+            self._second = second
+            self._start = now
+            return
+
+        elapsed = second - self._second
+        if elapsed <= 0:
+            return
+
+        if elapsed >= self._window:
+            self._buckets = [0] * self._window
+            self._in_window = 0
+        else:
+            for s in xrange(self._second+1, second+1):
+                i = s % self._window
+                self._in_window -= self._buckets[i]
+                self._buckets[i] = 0
+        self._second = second
+
+    def update(self, nbytes, now):
+        self._advance(now)
+        self._buckets[self._second % self._window] += nbytes
+        self._in_window += nbytes
+        self._total += nbytes
+
+    def rate(self, now):
+        """
+        rate() returns the average number of bytes per second over the
+        window, or over the time since the first update if that is shorter.
+        """
+        if self._second is None:
+            return 0.0
+        self._advance(now)
+        span = min(self._window, max(now - self._start, 1.0))
+        return self._in_window / span
+
+    @property
+    def total(self):
+        return self._total
+
+
+class RTTEstimator(object):
+    def __init__(self):
+        self._srtt = None
+        self._rttvar = None
+
+    def sample(self, rtt):
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2.0
+        else:
+            self._rttvar = ((1 - _BETA) * self._rttvar +
+                            _BETA * abs(self._srtt - rtt))
+            self._srtt = (1 - _ALPHA) * self._srtt + _ALPHA * rtt
+
+    @property
+    def srtt(self):
+        return self._srtt
+
+    @property
+    def rttvar(self):
+        return self._rttvar
+
+    def timeout(self):
+        """
+        timeout() returns the number of seconds to wait for a response
+        before considering a request lost.
+        """
+        if self._srtt is None:
+            return _INITIAL_TIMEOUT
+        return min(_MAX_TIMEOUT,
+                   max(_MIN_TIMEOUT, self._srtt + _K * self._rttvar))
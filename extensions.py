@@ -0,0 +1,144 @@
+"""
+The extensions module encodes and decodes the payloads of messages carried by
+the extension protocol (BEP 10).  An extended message consists of a one byte
+extended message id followed by a payload.  An id of zero identifies the
+extended handshake, a bencoded dictionary whose 'm' entry maps the name of
+each extension the sender supports to the id the sender wants to receive
+that extension's messages on.  Messages are therefore sent using the ids
+from the remote end's handshake and received using the ids in LOCAL_IDS.
+
+Peer exchange (ut_pex) lets connected peers tell each other about peers
+they have connected to or disconnected from.  Its payload is a bencoded
+dictionary containing compact peer lists, separate ones for IPv4 and IPv6
+peers.  Peers are passed to and from the pex functions as compact records
+(see peeraddr).
+
+Metadata exchange (ut_metadata, BEP 9) lets a client which knows only a
+torrent's info hash, from a magnet link, download the info dictionary from
+its peers.  A peer which has the info dictionary gives its size in the
+metadata_size entry of its extended handshake.  The dictionary is exchanged
+in pieces of 16 KiB, each asked for with a request message and answered
+with a data message or a reject message.  The payload of each message is a
+bencoded dictionary giving the message type and the piece, and a data
+message has the bytes of the piece appended after the dictionary.
+
+Each decode function raises a ValueError when the payload is malformed.
+"""
+
+import bencoding
+import peeraddr
+
+EXTENDED_HANDSHAKE = 0
+UT_PEX = 'ut_pex'
+UT_METADATA = 'ut_metadata'
+
+LOCAL_IDS = {UT_PEX: 1, UT_METADATA: 2}
+
+METADATA_PIECE_SIZE = 2**14
+(METADATA_REQUEST, METADATA_DATA, METADATA_REJECT) = range(3)
+
+_CLIENT_VERSION = 'HS 0.0.1'
+
+# Flag for a peer in a pex message indicating that it accepts incoming
+# connections
+_PEX_REACHABLE = 0x10
+
+
+def encode_handshake(port, metadata_size=None):
+    handshake = {'m': LOCAL_IDS,
+                 'p': port,
+                 'v': _CLIENT_VERSION}
+    if metadata_size:
+        handshake['metadata_size'] = metadata_size
+    return bencoding.encode(handshake)
+
+
+def decode_handshake(payload):
+    try:
+        handshake = bencoding.decode(payload)
+    except bencoding.BencodeError:
+        raise ValueError("Invalid extended handshake")
+
+    if (not isinstance(handshake, dict) or
+            not isinstance(handshake.get('m', {}), dict)):
+        raise ValueError("Invalid extended handshake")
+
+    # Keep only the extensions with a usable message id.  An id of zero
+    # means the extension is disabled.
+    handshake['m'] = {name: extended_id for name, extended_id
+                      in handshake.get('m', {}).items()
+                      if isinstance(extended_id, int)
+                      and 0 < extended_id < 256}
+    return handshake
+
+
+def encode_pex(added, dropped):
+    """
+    encode_pex() takes lists of the records of peers which have been
+    connected to and disconnected from since the last pex message and
+    returns the payload of a ut_pex message.
+    """
+    added4, added6 = peeraddr.encode_peers(added)
+    dropped4, dropped6 = peeraddr.encode_peers(dropped)
+    message = {'added': added4,
+               'added.f': chr(_PEX_REACHABLE) * (len(added4) /
+                                                 peeraddr.IPV4_LENGTH),
+               'dropped': dropped4}
+    if added6 or dropped6:
+        message['added6'] = added6
+        message['added6.f'] = chr(_PEX_REACHABLE) * (len(added6) /
+                                                     peeraddr.IPV6_LENGTH)
+        message['dropped6'] = dropped6
+    return bencoding.encode(message)
+
+
+def decode_pex(payload):
+    """
+    decode_pex() returns a tuple of two lists of records, the peers added
+    and the peers dropped.
+    """
+    try:
+        pex = bencoding.decode(payload)
+        return (peeraddr.decode_peers(pex.get('added', '')) +
+                peeraddr.decode_peers6(pex.get('added6', '')),
+                peeraddr.decode_peers(pex.get('dropped', '')) +
+                peeraddr.decode_peers6(pex.get('dropped6', '')))
+    except (bencoding.BencodeError, AttributeError, TypeError):
+        raise ValueError("Invalid pex message")
+
+
+def encode_metadata(msg_type, piece, total_size=None, data=''):
+    """
+    encode_metadata() returns the payload of a ut_metadata message.  A data
+    message gives the total size of the info dictionary along with the data
+    of the piece.
+    """
+    message = {'msg_type': msg_type, 'piece': piece}
+    if msg_type == METADATA_DATA:
+        message['total_size'] = total_size
+    return bencoding.encode(message) + data
+
+
+def decode_metadata(payload):
+    """
+    decode_metadata() returns a tuple of the message type, the piece, the
+    total size of the info dictionary and the data of a ut_metadata
+    message.  The total size is None and the data is empty except in a data
+    message.
+    """
+    try:
+        message, end = bencoding.decode_prefix(payload)
+        msg_type = message['msg_type']
+        piece = message['piece']
+        if (msg_type not in (METADATA_REQUEST, METADATA_DATA,
+                             METADATA_REJECT) or
+                not isinstance(piece, (int, long)) or piece < 0):
+            raise ValueError("Invalid metadata message")
+        if msg_type != METADATA_DATA:
+            return msg_type, piece, None, ''
+        total_size = message['total_size']
+        if not isinstance(total_size, (int, long)) or total_size <= 0:
+            raise ValueError("Invalid metadata message")
+        return msg_type, piece, total_size, str(payload[end:])
+    except (bencoding.BencodeError, KeyError, TypeError):
+        raise ValueError("Invalid metadata message")
@@ -4,95 +4,285 @@ opens them and creates a bitfield to reflect which pieces are present (not
 implemented).  If not, it creates the files.  The FileMgr maps locations
 in the set of pieces to where they appear in the files and vice versa.
 
+The FileMgr can be given the bitfield of pieces which were on disk when the
+torrent was last served, saved in the Catalog.  The bitfield is trusted only
+if every file of the torrent already exists.  Otherwise the files have been
+moved or deleted since, and no pieces are considered present.
+
+Padding files, which hybrid and v2 torrents use to start each file on a
+piece boundary, are never created.  Whatever is written to them is dropped.
+
+Each file has a priority, and a file whose priority is zero is skipped and
+isn't created either.  The pieces which such a file shares with a file that
+isn't skipped are still downloaded, and the parts of them which belong to
+the skipped file are kept in a part file alongside the torrent's files
+rather than in the file itself.  The part file is a series of slots, each
+holding the index of a piece followed by room for the whole piece, so that
+which pieces it holds can be found by reading it.  When a skipped file is
+no longer skipped, it is created and given what the part file holds of it.
+A file which already exists is used even if it is skipped.
+
 Files are flushed after every write.  Otherwise, received blocks which have
-been written might be lost on premature termination of the program.
+been written might be lost on premature termination of the program.  It also
+means that what has been written can be read back straight away, which
+read() does for anything consuming the torrent's data while it downloads.
+How long each block takes to write, flush included, is recorded for the
+client's metrics.
+
+Where a file lies within the torrent and which files a range of the torrent
+covers are worked out by file_path() and extents(), which can be used by
+anything else that reads or writes a torrent's files, such as maketorrent.
 
 Right now, the FileMgr keeps every file in the torrent open.  This may present
 a problem if the client is serving many torrents.  It might be better to keep
-open only those files that are actively being downloaded or uploaded.
+open only those files that are actively being downloaded or uploaded.  A
+torrent which isn't being served, such as a paused one, closes its files with
+close(), and the FileMgr can't be used after that.
 """
 
+import bisect
 import errno
 import logging
+import metrics
 import os
+import struct
+import time
 from bitstring import BitArray
 
 logger = logging.getLogger('bt.filemgr')
 
+_SLOT_HEADER = struct.Struct('>I')
+
+_WRITE_SECONDS = metrics.Histogram('bt_disk_write_seconds',
+                                   "Time taken to write and flush a block")
+
+
+def file_path(directory, path):
+    """
+    file_path() returns the name of the file with the path, a list of path
+    components from the metainfo, within the torrent's directory, which is
+    empty for a single file torrent.
+    """
+    return os.path.join(directory, *path)
+
+
+def extents(offsets, lengths, begin, length):
+    """
+    extents() takes the offsets within the torrent and the lengths of the
+    torrent's files and returns a list of (file index, offset in file,
+    length) tuples giving the parts of the files which make up the range of
+    the torrent starting at begin, in order.
+    """
+    result = []
+    index = max(bisect.bisect_right(offsets, begin) - 1, 0)
+    while length > 0 and index < len(offsets):
+        offset_in_file = begin - offsets[index]
+        in_file = min(length, lengths[index] - offset_in_file)
+        if in_file > 0:
+            result.append((index, offset_in_file, in_file))
+            begin += in_file
+            length -= in_file
+        index += 1
+    return result
+
 
 class FileMgr(object):
-    def __init__(self, metainfo):
+    def __init__(self, metainfo, have=None, priorities=None):
         self._metainfo = metainfo
         self._have = BitArray(self._metainfo.num_pieces)
+        self._piece_length = metainfo.piece_length
 
-        directory = metainfo.directory
-        if directory != '':
-            try:
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-            except OSError as err:
-                if err.errno != errno.EEXIST:
-                    raise
+        self._directory = metainfo.directory
+        if self._directory != '':
+            self._makedirs(self._directory)
 
         files = metainfo.files
+        if priorities is None:
+            priorities = [1] * len(files)
+        self._priorities = list(priorities)
 
         # _files is a list of files in the torrent.  Each entry is a
-        # tuple containing the file descriptor, length of the file and
-        # offset of the file within the torrent
+        # tuple containing the file descriptor, which is None for a padding
+        # file or a skipped file which hasn't been created, length of the
+        # file and offset of the file within the torrent.  _offsets and
+        # _lengths hold the offsets and lengths alone.
         self._files = []
 
         offset = 0
-        subdirs = []
-        for path, length in files:
-            dirname = directory+"/".join(path[0:-1])
-
-            if dirname != '' and dirname not in subdirs:
-                subdirs.append(dirname)
-                try:
-                    if not os.path.exists(dirname):
-                        os.makedirs(dirname)
-                except OSError as err:
-                    if err.errno != errno.EEXIST:
-                        raise
-
-            if dirname == '':
-                filename = path[-1]
-            else:
-                filename = dirname+"/"+path[-1]
-
-            try:
-                open(filename, 'a').close()
-                fd = open(filename, 'rb+')
-            except IOError:
-                logger.critical("Unable to open file {}".format(filename))
-                raise
+        all_exist = True
+        for i, (path, length) in enumerate(files):
+            fd = None
+            if i not in metainfo.padding:
+                filename = file_path(self._directory, path)
+                exists = os.path.isfile(filename)
+                if self._priorities[i] or exists:
+                    all_exist = all_exist and exists
+                    fd = self._open(filename)
 
             self._files.append((fd, length, offset))
             offset += length
 
-    def _file_index(self, offset):
-        for i, (fd, length, begin) in enumerate(self._files):
-            if offset >= begin and offset < begin + length:
-                return i
+        self._offsets = [begin for _, _, begin in self._files]
+        self._lengths = [length for _, length, _ in self._files]
+
+        # _parts is the part file, once it has been opened, and _slots maps
+        # the index of each piece in it to its slot
+        self._parts_name = file_path(self._directory,
+                                     ['.{}.parts'.format(metainfo.name)])
+        self._parts = None
+        self._slots = {}
+        if os.path.isfile(self._parts_name):
+            self._open_parts()
+            size = os.path.getsize(self._parts_name)
+            for slot in xrange(0, -(-size // self._slot_size())):
+                self._parts.seek(slot * self._slot_size())
+                header = self._parts.read(_SLOT_HEADER.size)
+                if len(header) == _SLOT_HEADER.size:
+                    self._slots[_SLOT_HEADER.unpack(header)[0]] = slot
+
+        if have is not None and all_exist:
+            self._have = have.copy()
+
+    def _makedirs(self, dirname):
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def _open(self, filename):
+        dirname = os.path.dirname(filename)
+        if dirname != '':
+            self._makedirs(dirname)
+        try:
+            open(filename, 'a').close()
+            return open(filename, 'rb+')
+        except IOError:
+            logger.critical("Unable to open file {}".format(filename))
+            raise
+
+    def _open_parts(self):
+        self._parts = self._open(self._parts_name)
+
+    def _slot_size(self):
+        return _SLOT_HEADER.size + self._piece_length
+
+    def _slot(self, index, create=False):
+        # Returns the slot holding the piece in the part file, adding one if
+        # asked to, or None
+        if index in self._slots or not create:
+            return self._slots.get(index)
+        if self._parts is None:
+            self._open_parts()
+        slot = len(self._slots)
+        self._slots[index] = slot
+        self._parts.seek(slot * self._slot_size())
+        self._parts.write(_SLOT_HEADER.pack(index))
+        return slot
+
+    def _parts_io(self, begin, length, buf=None):
+        # Writes buf to the range of the torrent starting at begin in the
+        # part file or, without buf, returns what the part file holds of
+        # the range, piece by piece
+        parts = []
+        done = 0
+        while done < length:
+            index, offset = divmod(begin + done, self._piece_length)
+            size = min(length - done, self._piece_length - offset)
+            slot = self._slot(index, create=buf is not None)
+            if slot is None:
+                parts.append('\x00' * size)
+            else:
+                self._parts.seek(slot * self._slot_size() +
+                                 _SLOT_HEADER.size + offset)
+                if buf is None:
+                    part = self._parts.read(size)
+                    parts.append(part + '\x00' * (size - len(part)))
+                else:
+                    self._parts.write(buf[done:done+size])
+            done += size
+        if buf is not None:
+            self._parts.flush()
+        return ''.join(parts)
 
     def have(self):
         return self._have.copy()
 
-    def write_block(self, piece_index, offset_in_piece, buf, file_index=None):
-        offset_in_torrent = (piece_index * self._metainfo.piece_length +
-                             offset_in_piece)
+    def close(self):
+        for fd, _, _ in self._files:
+            if fd is not None:
+                fd.close()
+        self._files = [(None, length, offset)
+                       for _, length, offset in self._files]
+        if self._parts is not None:
+            self._parts.close()
+            self._parts = None
 
-        if not file_index:
-            file_index = self._file_index(offset_in_torrent)
-        fd, file_length, file_offset_in_torrent = self._files[file_index]
-        offset_in_file = offset_in_torrent - file_offset_in_torrent
-        fd.seek(offset_in_file)
-        if len(buf) <= file_length - offset_in_file:
-            fd.write(buf)
-            fd.flush()
-        else:
-            to_write = file_length - offset_in_file
-            fd.write(buf[:to_write])
+    def priorities(self):
+        return list(self._priorities)
+
+    def set_priorities(self, priorities):
+        """
+        set_priorities() sets the priority of each file.  A skipped file
+        whose priority is raised is created and given whatever the part
+        file holds of it.
+        """
+        for i, priority in enumerate(priorities):
+            fd, length, offset = self._files[i]
+            if (not priority or fd is not None or
+                    i in self._metainfo.padding):
+                continue
+
+            path, _ = self._metainfo.files[i]
+            fd = self._open(file_path(self._directory, path))
+            self._files[i] = (fd, length, offset)
+
+            for index in sorted(self._slots):
+                begin = max(offset, index * self._piece_length)
+                end = min(offset + length, (index+1) * self._piece_length)
+                if begin < end:
+                    fd.seek(begin - offset)
+                    fd.write(self._parts_io(begin, end - begin))
             fd.flush()
-            self.write_block(piece_index, offset_in_piece + to_write,
-                             buf[to_write:], file_index+1)
+
+        self._priorities = list(priorities)
+
+    def write_block(self, piece_index, offset_in_piece, buf):
+        start = time.time()
+        offset_in_torrent = (piece_index * self._piece_length +
+                             offset_in_piece)
+
+        # A block which crosses the end of a file continues in the next
+        written = 0
+        for file_index, offset_in_file, length in extents(
+                self._offsets, self._lengths, offset_in_torrent, len(buf)):
+            fd = self._files[file_index][0]
+            if fd is not None:
+                fd.seek(offset_in_file)
+                fd.write(buf[written:written+length])
+                fd.flush()
+            elif file_index not in self._metainfo.padding:
+                self._parts_io(self._offsets[file_index] + offset_in_file,
+                               length, buf[written:written+length])
+            written += length
+        _WRITE_SECONDS.observe(time.time() - start)
+
+    def read(self, begin, length):
+        """
+        read() returns the bytes of the torrent in the range starting at
+        begin.  Padding files read as zeros.
+        """
+        parts = []
+        for file_index, offset_in_file, in_file in extents(
+                self._offsets, self._lengths, begin, length):
+            fd = self._files[file_index][0]
+            if fd is not None:
+                fd.seek(offset_in_file)
+                parts.append(fd.read(in_file))
+            elif file_index not in self._metainfo.padding:
+                parts.append(self._parts_io(self._offsets[file_index] +
+                                            offset_in_file, in_file))
+            else:
+                parts.append('\x00' * in_file)
+        return ''.join(parts)
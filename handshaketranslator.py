@@ -26,6 +26,12 @@ next part of the message expected.
 
 A readerwriter must implement set_receiver(), unset_receiver() and tx_bytes()
 
+The eight reserved bytes of the handshake advertise the protocol extensions a
+peer supports.  Each extension is identified by the index of the reserved
+byte holding its bit and a mask for the bit.  reserved_bytes() builds the
+reserved bytes advertising a set of extensions and has_extension() tests
+whether received reserved bytes advertise an extension.
+
 Right now, the HandshakeTranslor reports the handshake after it has received
 the peer_id but documentation seems to indicate it should do this right after
 receiving the info_hash.
@@ -39,6 +45,23 @@ logger = logging.getLogger('bt.handshaketranslator')
 _BUFFER_SIZE = 48
 _LENGTH_LEN = 1
 _REST_LEN = 48
+_RESERVED_LEN = 8
+
+EXTENSION_PROTOCOL = (5, 0x10)
+FAST_EXTENSION = (7, 0x04)
+V2_PROTOCOL = (7, 0x10)
+
+
+def reserved_bytes(*extensions):
+    reserved = bytearray(_RESERVED_LEN)
+    for index, mask in extensions:
+        reserved[index] |= mask
+    return str(reserved)
+
+
+def has_extension(reserved, extension):
+    index, mask = extension
+    return bool(ord(reserved[index]) & mask)
 
 
 class HandshakeTranslator(object):
@@ -121,6 +144,6 @@ class HandshakeTranslator(object):
         if self._readerwriter:
             bp = list('BitTorrent protocol')
             self._readerwriter.tx_bytes(struct.pack('B19c', 19, *bp))
-            self._readerwriter.tx_bytes(struct.pack('8B', *([0]*8)))
+            self._readerwriter.tx_bytes(struct.pack('8s', reserved))
             self._readerwriter.tx_bytes(info_hash)
             self._readerwriter.tx_bytes(peer_id)
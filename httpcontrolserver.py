@@ -3,20 +3,147 @@ The HTTPControlServer manages an HTTP control channel for a client.  It
 implements HTTP route handlers using the Klein microframework.  It handles
 incoming messages by passing them off to the client for processing and then
 sending the appropriate HTTP response.
+
+The files of a torrent can be streamed, with support for range requests so
+that a media player can seek within a file.  The response is written as the
+pieces holding the file's data arrive, a chunk at a time.  A _Stream acts as
+a producer for the response so that it reads the next chunk only when the
+previous one has been taken by the connection, and it abandons the read it is
+waiting on if the connection is lost.
+
+Rather than polling /torrents, a browser can subscribe to /events to have the
+status of the torrents pushed to it as server-sent events by a StatusFeed.
+The client's metrics are served at /metrics in the Prometheus text format.
 """
 
 import json
+import mimetypes
+import re
 
 from commands import MsgError
 from klein import Klein
+from metrics import REGISTRY
+from statusfeed import StatusFeed
+from twisted.internet.defer import CancelledError
+from twisted.internet.interfaces import IPushProducer
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.static import File
+from zope.interface import implementer
+
+_CHUNK_SIZE = 2**18
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def _parse_range(header, length):
+    # Returns the (begin, end) of the range of a file of the given length
+    # that a Range header asks for, None if it can't be satisfied or the
+    # whole file if the header isn't understood.  Only the first of several
+    # ranges is served.
+    match = _RANGE.match(header.split(',')[0].strip())
+    if not match or match.groups() == ('', ''):
+        return 0, length
+    first, last = match.groups()
+    if first == '':
+        begin, end = max(0, length - int(last)), length
+    else:
+        begin = int(first)
+        end = min(length, int(last) + 1) if last else length
+    if begin >= end:
+        return None
+    return begin, end
+
+
+@implementer(IPushProducer)
+class _Stream(Resource):
+    isLeaf = True
+
+    def __init__(self, client, key, index, begin, end):
+        Resource.__init__(self)
+        self._client = client
+        self._key = key
+        self._index = index
+        self._begin = begin
+        self._end = end
+        self._request = None
+        self._reading = None
+        self._paused = False
+        self._stopped = False
+
+    def render_GET(self, request):
+        self._request = request
+        request.registerProducer(self, True)
+        request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        self._next()
+        return NOT_DONE_YET
+
+    def _next(self):
+        if self._paused or self._stopped or self._reading:
+            return
+        if self._begin >= self._end:
+            self._stopped = True
+            self._request.unregisterProducer()
+            self._request.finish()
+            return
+
+        # The torrent may have been removed since the stream began
+        length = min(_CHUNK_SIZE, self._end - self._begin)
+        try:
+            self._reading = self._client.read(self._key, self._index,
+                                              self._begin, length)
+        except MsgError:
+            self._failed(Failure())
+            return
+        self._reading.addCallbacks(self._write, self._failed)
+
+    def _write(self, data):
+        self._reading = None
+        self._begin += len(data)
+        self._request.write(data)
+        self._next()
+
+    def _failed(self, failure):
+        self._reading = None
+        if not failure.check(CancelledError) and not self._stopped:
+            self._stopped = True
+            self._request.unregisterProducer()
+            self._request.transport.loseConnection()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._next()
+
+    def stopProducing(self):
+        self._stopped = True
+        if self._reading:
+            self._reading.cancel()
+
+
+class _Subscription(Resource):
+    isLeaf = True
+
+    def __init__(self, feed):
+        Resource.__init__(self)
+        self._feed = feed
+
+    def render_GET(self, request):
+        self._feed.subscribe(request)
+        return NOT_DONE_YET
 
 
 class HTTPControlServer(object):
     app = Klein()
 
-    def __init__(self, client):
+    def __init__(self, client, reactor, status_interval=None):
         self._client = client
+        if status_interval is None:
+            self._feed = StatusFeed(client, reactor)
+        else:
+            self._feed = StatusFeed(client, reactor, status_interval)
 
     @app.route('/', branch=True)
     def static(self, request):
@@ -33,10 +160,33 @@ class HTTPControlServer(object):
         """
         The route handler for get requests to /torrents responds with a json
         formatted string which represents a dictionary containing information
-        about torrents which the client is handling keyed by info hash.
+        about torrents which the client is handling keyed by info hash: the
+        name, state, priority, percent downloaded, download and upload rates,
+        bytes left, estimated seconds to completion, counts of peers and
+        number of pieces being downloaded of each.
         """
         return json.dumps(self._client.get_torrents())
 
+    @app.route('/events')
+    def events(self, request):
+        """
+        The route handler for get requests to /events holds the response
+        open and sends it the status of the torrents as server-sent events,
+        first a snapshot event with the same dictionary that /torrents
+        responds with and then a delta event whenever the status of the
+        torrents changes.
+        """
+        return _Subscription(self._feed)
+
+    @app.route('/metrics')
+    def metrics(self, request):
+        """
+        The route handler for get requests to /metrics responds with the
+        client's metrics in the Prometheus text format.
+        """
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return REGISTRY.expose()
+
     @app.route('/add', methods=['POST'])
     def add(self, request):
         """
@@ -72,9 +222,12 @@ class HTTPControlServer(object):
         The route handler for get requests to /status asks the client for the
         status of the torrent with the supplied key.  It responds with a json
         formatted string which represents status information about the torrent,
-        currently only the percent downloaded.  If the client is not handling
-        a torrent with the specified key, it responds with a 400 status code
-        along with a json formatted string containing the error message.
+        including what /torrents responds with for it and the state, rates,
+        round trip time, snubbed, interested and unchoked states, outstanding
+        requests and piece being downloaded of each peer.  If the
+        client is not handling a torrent with the specified key, it responds
+        with a 400 status code along with a json formatted string containing
+        the error message.
         """
         key = request.args.get('key', [""])[0]
         request.setHeader('Content-Type', 'application/json')
@@ -87,6 +240,163 @@ class HTTPControlServer(object):
 
         return json.dumps(status)
 
+    @app.route('/files')
+    def files(self, request):
+        """
+        The route handler for get requests to /files responds with a json
+        formatted list of the files of the torrent with the supplied key,
+        giving the index, name, length, priority and percent downloaded of
+        each.  If the client is not handling a torrent with the specified
+        key, it responds with a 400 status code along with a json formatted
+        string containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            files = self._client.get_files(key)
+        except MsgError as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.message))
+
+        return json.dumps(files)
+
+    @app.route('/priority', methods=['POST'])
+    def priority(self, request):
+        """
+        The route handler for post requests to /priority sets the priority of
+        the file with the supplied index in the torrent with the supplied
+        key.  Priorities run from 0, which skips the file, to 7, and files
+        have priority 1 unless it is changed.  Without a file index, it sets
+        the priority of the torrent itself, from 1 to 7.  If the key, file
+        index or priority is invalid, it responds with a 400 status code
+        along with a json formatted string containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            index = request.args.get('file', [None])[0]
+            if index is not None:
+                index = int(index)
+            priority = int(request.args.get('priority', [''])[0])
+            self._client.set_priority(key, index, priority)
+        except (ValueError, MsgError) as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return json.dumps(dict(key=key, file=index, priority=priority))
+
+    @app.route('/pause', methods=['POST'])
+    def pause(self, request):
+        """
+        The route handler for post requests to /pause pauses the torrent with
+        the supplied key, closing its connections and files until it is
+        resumed.  If the key is invalid or the torrent is already paused, it
+        responds with a 400 status code along with a json formatted string
+        containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            self._client.pause(key)
+        except MsgError as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.message))
+
+        return json.dumps(dict(key=key, paused=True))
+
+    @app.route('/resume', methods=['POST'])
+    def resume(self, request):
+        """
+        The route handler for post requests to /resume resumes the paused
+        torrent with the supplied key.  It responds once the torrent is being
+        served again or has been queued.  If the key is invalid, the torrent
+        isn't paused or it can't be resumed, it responds with a 400 status
+        code along with a json formatted string containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        def success(result):
+            return json.dumps(dict(key=key, paused=False))
+
+        def failure(failure):
+            request.setResponseCode(400)
+            return json.dumps(dict(message=failure.value.message))
+
+        try:
+            d = self._client.resume(key)
+        except MsgError as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.message))
+
+        return d.addCallbacks(success, failure)
+
+    @app.route('/remove', methods=['POST'])
+    def remove(self, request):
+        """
+        The route handler for post requests to /remove stops serving the
+        torrent with the supplied key and forgets it, leaving its files in
+        place.  If the key is invalid, it responds with a 400 status code
+        along with a json formatted string containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            self._client.remove(key)
+        except MsgError as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.message))
+
+        return json.dumps(dict(key=key, removed=True))
+
+    @app.route('/stream')
+    def stream(self, request):
+        """
+        The route handler for get requests to /stream responds with the
+        contents of the file with the supplied index, the first by default,
+        of the torrent with the supplied key.  A request with a Range header
+        for a range of bytes is given that range with a 206 status code.  The
+        response is sent as the file's pieces are downloaded, those being
+        read taking priority over others.  If the key or file index is
+        invalid, it responds with a 400 status code along with a json
+        formatted string containing the error message, and if the range lies
+        outside the file, it responds with a 416 status code.
+        """
+        key = request.args.get('key', [""])[0]
+
+        try:
+            index = int(request.args.get('file', ['0'])[0])
+            name, length = self._client.get_file(key, index)
+        except (ValueError, MsgError) as err:
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps(dict(message=str(err)))
+
+        begin, end = 0, length
+        header = request.getHeader('range')
+        if header:
+            span = _parse_range(header, length)
+            if span is None:
+                request.setResponseCode(416)
+                request.setHeader('Content-Range',
+                                  'bytes */{}'.format(length))
+                return ''
+            begin, end = span
+            if (begin, end) != (0, length):
+                request.setResponseCode(206)
+                request.setHeader('Content-Range', 'bytes {}-{}/{}'
+                                  .format(begin, end - 1, length))
+
+        request.setHeader('Accept-Ranges', 'bytes')
+        request.setHeader('Content-Length', str(end - begin))
+        request.setHeader('Content-Type', mimetypes.guess_type(name)[0] or
+                          'application/octet-stream')
+        return _Stream(self._client, key, index, begin, end)
+
     @app.route('/quit', methods=['POST'])
     def quit(self, request):
         """
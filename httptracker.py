@@ -0,0 +1,263 @@
+"""
+The HTTPTrackerClient makes the HTTP requests for every TrackerProxy which
+uses an HTTP tracker.  A single client serves the whole process so that
+torrents announcing to the same tracker host can reuse each other's
+connections.  It is normally obtained with shared_client().
+
+Requests are made with an Agent whose connection pool keeps a few persistent
+connections to each host open between requests.  The number of requests in
+progress at once is limited, and requests beyond the limit wait their turn,
+so that a client serving thousands of torrents doesn't open thousands of
+connections at the same moment.  A request which hasn't completed within the
+timeout fails and its connection is closed.
+
+get() fetches the body of an announce url.  scrape() asks a tracker about the
+swarms of many torrents at once by putting several info hashes in each
+scrape request.  It fires with a dictionary mapping each info hash that the
+tracker knows about to a dictionary with 'complete', 'downloaded' and
+'incomplete' counts.  Both fail with an HTTPTrackerError if the tracker
+can't be reached, doesn't respond in time or responds with something
+unexpected.
+"""
+
+import logging
+import urllib
+
+from twisted.internet.defer import (Deferred, DeferredList, DeferredSemaphore,
+                                    fail)
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+import bencoding
+
+logger = logging.getLogger('bt.httptracker')
+
+_MAX_CONCURRENT = 20
+_MAX_PERSISTENT_PER_HOST = 4
+_CACHED_CONNECTION_TIMEOUT = 120
+_TIMEOUT = 30
+_MAX_SCRAPE = 50
+_USER_AGENT = 'HS/0.0.1'
+
+_client = None
+
+
+class HTTPTrackerError(Exception):
+    pass
+
+
+def shared_client(reactor):
+    """
+    shared_client() returns the process-wide HTTPTrackerClient, creating it
+    on first use.
+    """
+    global _client
+    if _client is None:
+        _client = HTTPTrackerClient(reactor)
+    return _client
+
+
+def scrape_url(announce_url):
+    """
+    scrape_url() returns the scrape url which corresponds to the announce
+    url by convention, or None if the tracker doesn't support scraping.
+    """
+    path, sep, query = announce_url.partition('?')
+    head, slash, tail = path.rpartition('/')
+    if not slash or not tail.startswith('announce'):
+        return None
+    return head + slash + 'scrape' + tail[len('announce'):] + sep + query
+
+
+class _BodyCollector(Protocol):
+    def __init__(self, finished):
+        self._finished = finished
+        self._data = []
+
+    def dataReceived(self, data):
+        self._data.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self._finished.callback(''.join(self._data))
+        else:
+            self._finished.errback(reason)
+
+
+class _RequestPool(object):
+    # Hands out connections from the shared pool for a single request and
+    # keeps hold of them, so that the request can be abandoned by closing
+    # its connections
+    def __init__(self, pool):
+        self._pool = pool
+        self._protocols = set()
+        self._abandoned = False
+        self.persistent = pool.persistent
+
+    def getConnection(self, key, endpoint):
+        # New connections, including those the pool makes to retry a
+        # request on a cached connection which had been closed, are seen as
+        # the endpoint makes them.  Cached connections come wrapped so that
+        # the request can be retried.
+        def connected(connection):
+            self.track(getattr(connection, '_clientProtocol', connection))
+            return connection
+        return (self._pool.getConnection(key, _RequestEndpoint(endpoint, self))
+                .addCallback(connected))
+
+    def track(self, protocol):
+        self._protocols.add(protocol)
+        if self._abandoned:
+            protocol.transport.abortConnection()
+
+    def abandon(self):
+        self._abandoned = True
+        for protocol in self._protocols:
+            protocol.transport.abortConnection()
+
+
+class _RequestEndpoint(object):
+    def __init__(self, endpoint, pool):
+        self._endpoint = endpoint
+        self._pool = pool
+
+    def connect(self, factory):
+        def connected(protocol):
+            self._pool.track(protocol)
+            return protocol
+        return self._endpoint.connect(factory).addCallback(connected)
+
+
+class HTTPTrackerClient(object):
+    def __init__(self, reactor, max_concurrent=_MAX_CONCURRENT,
+                 timeout=_TIMEOUT):
+        self._reactor = reactor
+        self._timeout = timeout
+
+        self._pool = HTTPConnectionPool(reactor)
+        self._pool.maxPersistentPerHost = _MAX_PERSISTENT_PER_HOST
+        self._pool.cachedConnectionTimeout = _CACHED_CONNECTION_TIMEOUT
+
+        self._semaphore = DeferredSemaphore(max_concurrent)
+
+    def get(self, url):
+        """
+        get() returns a deferred which fires with the body of the response
+        to a GET request for the url.
+        """
+        d = Deferred()
+        self._semaphore.acquire().addCallback(self._fetch, url, d)
+        return d
+
+    def _fetch(self, _, url, d):
+        # A request holds its place in the limit until the Agent is done
+        # with it rather than until d fires, so that requests which time out
+        # or are cancelled can't leave more connections open than the limit
+        if d.called:
+            self._semaphore.release()
+            return
+
+        # The Agent can't cancel a request, so a request which times out is
+        # failed here and abandoned by closing its connection, whether or
+        # not the response has started to arrive
+        pool = _RequestPool(self._pool)
+        agent = Agent(self._reactor, connectTimeout=self._timeout, pool=pool)
+        where = url.partition('?')[0]
+
+        def expire():
+            pool.abandon()
+            if not d.called:
+                d.errback(HTTPTrackerError("No response from {} in time"
+                                           .format(where)))
+
+        timer = self._reactor.callLater(self._timeout, expire)
+
+        def received(response):
+            finished = Deferred()
+            response.deliverBody(_BodyCollector(finished))
+            return finished.addCallback(check, response.code)
+
+        def check(body, code):
+            if code != 200:
+                raise HTTPTrackerError("HTTP status {} from {}"
+                                       .format(code, where))
+            return body
+
+        def done(body):
+            if timer.active():
+                timer.cancel()
+            if not d.called:
+                d.callback(body)
+
+        def failed(failure):
+            if timer.active():
+                timer.cancel()
+            if not d.called:
+                if failure.check(HTTPTrackerError):
+                    d.errback(failure)
+                else:
+                    d.errback(HTTPTrackerError("Can't connect to {}"
+                                               .format(where)))
+
+        def settled(_):
+            self._semaphore.release()
+
+        headers = Headers({'User-Agent': [_USER_AGENT]})
+        (agent.request('GET', url, headers)
+         .addCallback(received)
+         .addCallbacks(done, failed)
+         .addBoth(settled))
+
+    def scrape(self, url, info_hashes):
+        """
+        scrape() takes the scrape url of a tracker and a list of info hashes
+        and returns a deferred which fires with the tracker's statistics for
+        each torrent.  The info hashes are split into as few requests as
+        possible.  Statistics from requests which succeed are reported even
+        if others fail, and the deferred fails only if every request does.
+        """
+        if not info_hashes:
+            return fail(HTTPTrackerError("No info hashes to scrape"))
+
+        separator = '&' if '?' in url else '?'
+        ds = []
+        for i in xrange(0, len(info_hashes), _MAX_SCRAPE):
+            batch = info_hashes[i:i+_MAX_SCRAPE]
+            query = urllib.urlencode([('info_hash', info_hash)
+                                      for info_hash in batch])
+            ds.append(self.get(url + separator + query)
+                      .addCallback(self._decode_scrape))
+
+        def combine(results):
+            stats = {}
+            failures = []
+            for success, result in results:
+                if success:
+                    stats.update(result)
+                else:
+                    failures.append(result)
+            if failures and not stats:
+                return failures[0]
+            return stats
+
+        return DeferredList(ds, consumeErrors=True).addCallback(combine)
+
+    def _decode_scrape(self, content):
+        try:
+            response = bencoding.decode(content)
+        except bencoding.BencodeError:
+            raise HTTPTrackerError("Invalid scrape response")
+
+        if 'failure reason' in response:
+            raise HTTPTrackerError("Failure reason: {}"
+                                   .format(response['failure reason']))
+
+        try:
+            return {info_hash: {'complete': stats['complete'],
+                                'downloaded': stats['downloaded'],
+                                'incomplete': stats['incomplete']}
+                    for info_hash, stats in response['files'].items()}
+        except (KeyError, AttributeError, TypeError):
+            raise HTTPTrackerError("Invalid scrape response")
@@ -0,0 +1,217 @@
+"""
+LocalPeerDiscovery finds peers on the local network using Local Peer
+Discovery (BEP 14).  Clients announce the torrents they are serving by
+sending BT-SEARCH messages, laid out like HTTP requests, to a well known
+multicast group.  Every client listening on the group hears the announces
+and learns that the sender, at the address the message came from and the
+port in the message, serves the torrents listed.
+
+A single LocalPeerDiscovery serves every torrent in the process.  Torrents
+are added with add_torrent() and are announced shortly afterwards, and then
+again every five minutes.  When an announce for a torrent we serve is heard
+from a peer not heard from since the last periodic announce, our own
+announce for that torrent is sent soon after, so that both ends learn of
+each other within seconds rather than at the next periodic announce.
+
+Announces are rate limited.  At most one message is sent each second, each
+holding the info hashes of several torrents, and no torrent is announced
+more than once every two seconds.  Messages from a sender arriving faster
+than one a second are ignored.  Each message carries a random cookie so
+that our own messages, which come back to us through multicast loopback,
+are ignored.
+
+Peers heard about are passed to the function supplied on creation as the
+info hash and the peer's compact record (see peeraddr).  The multicast group
+and port and the interface used can be given on creation so that several
+instances can talk to each other over loopback on a single host.
+"""
+
+import logging
+import os
+
+from twisted.internet.protocol import DatagramProtocol
+
+import peeraddr
+
+logger = logging.getLogger('bt.lpd')
+
+GROUP = '239.192.152.143'
+GROUP_PORT = 6771
+
+_ANNOUNCE_INTERVAL = 5 * 60
+_MIN_ANNOUNCE_INTERVAL = 2
+_SEND_INTERVAL = 1
+_MIN_RECEIVE_INTERVAL = 1
+_MAX_INFO_HASHES = 20
+_MAX_MESSAGE = 1400
+
+
+class LocalPeerDiscovery(DatagramProtocol):
+    def __init__(self, reactor, port, on_peer, group=GROUP,
+                 group_port=GROUP_PORT, interface=''):
+        self._reactor = reactor
+        self._port = port
+        self._on_peer = on_peer
+        self._group = group
+        self._group_port = group_port
+        self._interface = interface
+        self._cookie = os.urandom(8).encode('hex')
+
+        # _torrents maps the info hash of each torrent served to the time it
+        # was last announced.  _queued is a list of the info hashes waiting
+        # to be announced.
+        self._torrents = {}
+        self._queued = []
+
+        # _last_heard maps a sender's record to when a message from it was
+        # last accepted.  _known is the set of (info hash, record) pairs
+        # heard since the last periodic announce.
+        self._last_heard = {}
+        self._known = set()
+
+        self._listening = None
+        self._timer = None
+        self._next_periodic = 0
+
+    def start(self):
+        """
+        start() joins the multicast group and starts announcing.  It raises
+        a CannotListenError if the group port is not available.
+        """
+        self._listening = self._reactor.listenMulticast(self._group_port,
+                                                        self,
+                                                        listenMultiple=True)
+        self._next_periodic = self._reactor.seconds() + _ANNOUNCE_INTERVAL
+        self._timer = self._reactor.callLater(_SEND_INTERVAL,
+                                              self._timer_event)
+
+    def stop(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._listening:
+            listening, self._listening = self._listening, None
+            return listening.stopListening()
+
+    def startProtocol(self):
+        self.transport.setTTL(1)
+        self.transport.setLoopbackMode(True)
+        if self._interface:
+            self.transport.setOutgoingInterface(self._interface)
+        d = self.transport.joinGroup(self._group, self._interface or '')
+        d.addErrback(lambda failure: logger.warning(
+            "Can't join multicast group {}: {}"
+            .format(self._group, failure.value)))
+
+    def add_torrent(self, info_hash):
+        """
+        add_torrent() starts announcing the torrent with the given info hash.
+        """
+        if info_hash not in self._torrents:
+            self._torrents[info_hash] = None
+            self._queue(info_hash)
+
+    def remove_torrent(self, info_hash):
+        self._torrents.pop(info_hash, None)
+        if info_hash in self._queued:
+            self._queued.remove(info_hash)
+
+    def _queue(self, info_hash):
+        if info_hash not in self._queued:
+            self._queued.append(info_hash)
+
+    def _timer_event(self):
+        self._timer = self._reactor.callLater(_SEND_INTERVAL,
+                                              self._timer_event)
+        now = self._reactor.seconds()
+
+        if now >= self._next_periodic:
+            self._next_periodic = now + _ANNOUNCE_INTERVAL
+            self._known.clear()
+            for info_hash in self._torrents:
+                self._queue(info_hash)
+
+        # Send one message with as many of the queued torrents as may be
+        # announced now.  Torrents announced too recently stay queued.
+        ready = [info_hash for info_hash in self._queued
+                 if self._torrents.get(info_hash) is None or
+                 now - self._torrents[info_hash] >= _MIN_ANNOUNCE_INTERVAL]
+        ready = ready[:_MAX_INFO_HASHES]
+        if ready:
+            for info_hash in ready:
+                self._queued.remove(info_hash)
+                self._torrents[info_hash] = now
+            self._send(ready)
+
+        for record, heard in self._last_heard.items():
+            if now - heard >= _MIN_RECEIVE_INTERVAL:
+                del self._last_heard[record]
+
+    def _send(self, info_hashes):
+        lines = ["BT-SEARCH * HTTP/1.1",
+                 "Host: {}:{}".format(self._group, self._group_port),
+                 "Port: {}".format(self._port)]
+        lines.extend("Infohash: {}".format(info_hash.encode('hex'))
+                     for info_hash in info_hashes)
+        lines.append("cookie: {}".format(self._cookie))
+        message = "\r\n".join(lines) + "\r\n\r\n\r\n"
+        try:
+            self.transport.write(message, (self._group, self._group_port))
+        except Exception as err:
+            logger.debug("Can't send local peer announce: {}".format(err))
+
+    def datagramReceived(self, data, addr):
+        if len(data) > _MAX_MESSAGE:
+            return
+
+        announce = _parse(data)
+        if not announce:
+            return
+        port, info_hashes, cookie = announce
+        if cookie == self._cookie:
+            return
+
+        # Senders are told apart by the address they announce, since every
+        # client on a host sends from the same multicast port
+        record = peeraddr.from_addr((addr[0], port))
+        if not record or record in self._last_heard:
+            return
+        self._last_heard[record] = self._reactor.seconds()
+
+        for info_hash in info_hashes:
+            if (info_hash in self._torrents and
+                    (info_hash, record) not in self._known):
+                logger.debug("Local peer {}:{} serves {}"
+                             .format(addr[0], port, info_hash.encode('hex')))
+                self._known.add((info_hash, record))
+                self._on_peer(info_hash, record)
+                self._queue(info_hash)
+
+
+def _parse(data):
+    # Returns a tuple of the port, the list of info hashes and the cookie in
+    # a BT-SEARCH message, or None if the message is invalid
+    lines = data.split("\r\n")
+    if lines[0] != "BT-SEARCH * HTTP/1.1":
+        return None
+
+    port = None
+    info_hashes = []
+    cookie = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == 'port':
+                port = int(value)
+            elif name == 'infohash' and len(value) == 40:
+                info_hashes.append(value.decode('hex'))
+            elif name == 'cookie':
+                cookie = value
+        except (ValueError, TypeError):
+            return None
+
+    if port is None or not 0 < port < 65536 or not info_hashes:
+        return None
+    return port, info_hashes, cookie
@@ -0,0 +1,98 @@
+"""
+The MagnetLink parses a magnet URI (BEP 9) and makes the information in it
+available via properties, much as the Metainfo does for a metainfo file.  A
+magnet link identifies a torrent by its info hash, given in the xt parameter
+as urn:btih: followed by the hash in hex or base32.  It may also give a name
+for the torrent (dn), the urls of trackers (tr) and the addresses of peers
+(x.pe).  Upon initialization, MagnetLink raises a ValueError if the URI is
+not a magnet link or has no usable info hash.
+
+The trackers are presented as a single tier of an announce-list so that a
+TrackerProxy announces to all of them at once, since a magnet link says
+nothing about which trackers to prefer.  Peers are kept as compact records
+(see peeraddr), and addresses which aren't literal IP addresses are ignored.
+"""
+
+import base64
+import binascii
+import urlparse
+
+import peeraddr
+
+_BTIH = 'urn:btih:'
+
+
+class MagnetLink(object):
+    def __init__(self, uri):
+        scheme, _, query = uri.partition(':?')
+        if scheme.lower() != 'magnet':
+            raise ValueError("Not a magnet link")
+
+        self._info_hash = None
+        self._name = None
+        self._trackers = []
+        self._peers = []
+
+        for key, value in urlparse.parse_qsl(query):
+            if key == 'xt' and value.lower().startswith(_BTIH):
+                if self._info_hash is None:
+                    self._info_hash = _decode_hash(value[len(_BTIH):])
+            elif key == 'dn':
+                self._name = value
+            elif key == 'tr':
+                if value not in self._trackers:
+                    self._trackers.append(value)
+            elif key == 'x.pe':
+                record = _decode_peer(value)
+                if record and record not in self._peers:
+                    self._peers.append(record)
+
+        if self._info_hash is None:
+            raise ValueError("Magnet link has no valid info hash")
+
+    @property
+    def info_hash(self):
+        return self._info_hash
+
+    @property
+    def name(self):
+        return self._name or self._info_hash.encode('hex')
+
+    @property
+    def trackers(self):
+        return self._trackers
+
+    @property
+    def announce(self):
+        return self._trackers[0] if self._trackers else None
+
+    @property
+    def announce_list(self):
+        return [self._trackers] if self._trackers else None
+
+    @property
+    def peers(self):
+        return self._peers
+
+
+def _decode_hash(value):
+    # Returns the info hash in hex or base32, or None if it is invalid
+    try:
+        if len(value) == 40:
+            return binascii.unhexlify(value)
+        if len(value) == 32:
+            return base64.b32decode(value.upper())
+    except (TypeError, binascii.Error):
+        pass
+    return None
+
+
+def _decode_peer(value):
+    # Returns the record of a host:port or [host]:port address, or None if
+    # it is invalid
+    host, _, port = value.rpartition(':')
+    host = host.strip('[]')
+    try:
+        return peeraddr.from_addr((host, int(port)))
+    except ValueError:
+        return None
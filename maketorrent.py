@@ -0,0 +1,252 @@
+"""
+maketorrent creates a metainfo file for a file or a directory of files so
+that they can be served as a torrent.
+
+Usage:
+python maketorrent.py [-h] [-a url[,url...]] [-p bytes] [-c comment]
+                      [--private] [-j processes] [-o filename] path
+
+Each -a option gives a tier of trackers, the urls within a tier separated by
+commas.  The first tracker becomes the announce url and, when there is more
+than one, the tiers make up the announce-list.  A torrent made without
+trackers can be found through the DHT.  The metainfo is laid out as the
+Metainfo reads it, and the files of a directory are found in the same way as
+the FileMgr finds them, using file_path() and extents().
+
+Unless given, the piece length is chosen from the total size of the files as
+the smallest power of two from 16 KiB to 16 MiB which keeps the number of
+pieces to about two thousand.
+
+Hashing the pieces is by far the most expensive part of making a torrent,
+and it is spread over a pool of processes, one for each core unless told
+otherwise.  The pieces are divided into runs of consecutive pieces, each
+hashed by one process reading the files sequentially in reads of several
+MiB, so that each process makes large reads and a piece which crosses the
+boundary between two files is read as one.  There are several runs for each
+process so that the processes finish at about the same time.
+
+make_torrent() does the work for other modules and raises a MakeTorrentError
+if the files can't be read.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+
+import bencoding
+from argparse import ArgumentParser
+from filemgr import extents, file_path
+from metainfo import Metainfo
+
+_MIN_PIECE_LENGTH = 2**14
+_MAX_PIECE_LENGTH = 2**24
+_TARGET_PIECES = 2000
+_READ_SIZE = 2**22
+_MAX_RUN = 2**26
+_RUNS_PER_PROCESS = 4
+_CREATED_BY = 'HS 0.0.1'
+
+# _job holds what a hashing process needs to know about the files, set once
+# when the process starts rather than sent with each run
+_job = None
+
+
+class MakeTorrentError(Exception):
+    pass
+
+
+def piece_length_for(total_length):
+    """
+    piece_length_for() returns the piece length to use for a torrent of the
+    given total length.
+    """
+    piece_length = _MIN_PIECE_LENGTH
+    while (piece_length < _MAX_PIECE_LENGTH and
+           total_length > piece_length * _TARGET_PIECES):
+        piece_length *= 2
+    return piece_length
+
+
+def _scan(path):
+    # Returns a list of (path components, length) tuples for the files
+    # making up the torrent, in the order they appear in the torrent
+    if os.path.isfile(path):
+        return [([os.path.basename(path)], os.path.getsize(path))]
+
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            filename = os.path.join(root, name)
+            if os.path.isfile(filename):
+                relative = os.path.relpath(filename, path)
+                files.append((relative.split(os.sep),
+                              os.path.getsize(filename)))
+    files.sort()
+    return files
+
+
+def _init_process(job):
+    global _job
+    _job = job
+
+
+def _hash_run(run):
+    # Returns the concatenated hashes of a run of consecutive pieces
+    filenames, offsets, lengths, piece_length, total_length = _job
+    first, count = run
+    begin = first * piece_length
+    end = min(total_length, (first+count) * piece_length)
+    read_size = piece_length * max(1, _READ_SIZE / piece_length)
+
+    digests = []
+    fds = {}
+    try:
+        while begin < end:
+            size = min(read_size, end - begin)
+            parts = []
+            for index, offset, length in extents(offsets, lengths, begin,
+                                                 size):
+                if index not in fds:
+                    fds[index] = open(filenames[index], 'rb')
+                fds[index].seek(offset)
+                part = fds[index].read(length)
+                if len(part) != length:
+                    raise MakeTorrentError("{} changed while being read"
+                                           .format(filenames[index]))
+                parts.append(part)
+            data = ''.join(parts)
+            for i in xrange(0, len(data), piece_length):
+                digests.append(hashlib.sha1(buffer(data, i, piece_length))
+                               .digest())
+            begin += size
+    except IOError as err:
+        raise MakeTorrentError(str(err))
+    finally:
+        for fd in fds.values():
+            fd.close()
+    return ''.join(digests)
+
+
+def _hash_pieces(job, num_pieces, processes):
+    # Returns the concatenated hashes of all the pieces, hashed by a pool of
+    # processes
+    piece_length = job[3]
+    run = max(1, min(_MAX_RUN / piece_length,
+                     -(-num_pieces // (processes * _RUNS_PER_PROCESS))))
+    runs = [(first, min(run, num_pieces - first))
+            for first in xrange(0, num_pieces, run)]
+
+    if processes == 1 or len(runs) == 1:
+        _init_process(job)
+        return ''.join(_hash_run(r) for r in runs)
+
+    pool = multiprocessing.Pool(processes, _init_process, (job,))
+    try:
+        return ''.join(pool.imap(_hash_run, runs))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def make_torrent(path, tiers=(), piece_length=None, comment=None,
+                 private=False, processes=None):
+    """
+    make_torrent() returns the contents of a metainfo file for the file or
+    directory at the path.  The trackers are given as a list of tiers, each
+    a list of announce urls.
+    """
+    path = os.path.normpath(path)
+    if not os.path.exists(path):
+        raise MakeTorrentError("{} doesn't exist".format(path))
+
+    files = _scan(path)
+    total_length = sum(length for _, length in files)
+    if total_length == 0:
+        raise MakeTorrentError("{} holds no data".format(path))
+
+    piece_length = piece_length or piece_length_for(total_length)
+    num_pieces = -(-total_length // piece_length)
+    processes = processes or multiprocessing.cpu_count()
+
+    if os.path.isfile(path):
+        filenames = [path]
+    else:
+        filenames = [file_path(path, components) for components, _ in files]
+    lengths = [length for _, length in files]
+    offsets = []
+    offset = 0
+    for length in lengths:
+        offsets.append(offset)
+        offset += length
+
+    job = (filenames, offsets, lengths, piece_length, total_length)
+    pieces = _hash_pieces(job, num_pieces, processes)
+
+    info = {'name': os.path.basename(path),
+            'piece length': piece_length,
+            'pieces': pieces}
+    if os.path.isdir(path):
+        info['files'] = [{'length': length, 'path': components}
+                         for components, length in files]
+    else:
+        info['length'] = total_length
+    if private:
+        info['private'] = 1
+
+    metainfo = {'info': info,
+                'created by': _CREATED_BY,
+                'creation date': int(time.time())}
+    tiers = [list(tier) for tier in tiers if tier]
+    if tiers:
+        metainfo['announce'] = tiers[0][0]
+        if len(tiers) > 1 or len(tiers[0]) > 1:
+            metainfo['announce-list'] = tiers
+    if comment:
+        metainfo['comment'] = comment
+    return bencoding.encode(metainfo)
+
+
+def main(args):
+    parser = ArgumentParser('maketorrent')
+    parser.add_argument('path', help="file or directory to make a torrent of")
+    parser.add_argument('-a', action='append', default=[], metavar='url',
+                        help="tier of tracker urls separated by commas")
+    parser.add_argument('-p', type=int, metavar='bytes',
+                        help="piece length, a power of two")
+    parser.add_argument('-c', metavar='comment', help="comment")
+    parser.add_argument('--private', action='store_true',
+                        help="use only the trackers to find peers")
+    parser.add_argument('-j', type=int, metavar='processes',
+                        help="number of hashing processes")
+    parser.add_argument('-o', metavar='filename', help="metainfo filename")
+    result = parser.parse_args(args)
+
+    if result.p is not None and (result.p < _MIN_PIECE_LENGTH or
+                                 result.p & (result.p - 1)):
+        parser.error("piece length must be a power of two of at least {}"
+                     .format(_MIN_PIECE_LENGTH))
+
+    tiers = [[url for url in tier.split(',') if url] for tier in result.a]
+    output = (result.o or
+              os.path.basename(os.path.normpath(result.path)) + '.torrent')
+
+    start = time.time()
+    try:
+        contents = make_torrent(result.path, tiers, result.p, result.c,
+                                result.private, result.j)
+    except MakeTorrentError as err:
+        print >> sys.stderr, err
+        return 1
+
+    with open(output, 'wb') as metafile:
+        metafile.write(contents)
+
+    metainfo = Metainfo(output)
+    print "Created {} in {:.1f}s (key: {})".format(
+        output, time.time() - start, metainfo.info_hash.encode('hex'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
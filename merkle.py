@@ -0,0 +1,117 @@
+"""
+The merkle module computes the SHA-256 merkle trees by which BitTorrent v2
+(BEP 52) torrents identify their data.  Each file is divided into blocks of
+16 KiB and the leaves of the file's tree are the hashes of those blocks, the
+last of which may be shorter.  The leaves are padded with hashes of zeros to
+a power of two, and each node above them is the hash of its two children.
+The root of a file's tree is its pieces root.
+
+A piece covers a fixed number of blocks, its width, which is the piece
+length divided by the block size.  The node of a file's tree covering a
+piece is found in the torrent's piece layers, except for a file of no more
+than one piece, whose only piece is covered by the pieces root and whose
+tree is only as wide as it needs to be.
+
+root() computes the root of a tree from a layer of hashes, padding the layer
+with the hashes of empty subtrees rather than hashing every padding leaf, so
+the tree above a short last piece of a file or a short piece layer costs no
+more than the hashes which are actually present.  A PieceHasher takes the
+blocks of a piece as they arrive and, given the hashes of the blocks, checks
+each one on arrival so that a bad block is known as soon as it is received.
+"""
+
+import hashlib
+
+BLOCK_SIZE = 2**14
+HASH_SIZE = 32
+
+_ZERO = '\x00' * HASH_SIZE
+
+
+def block_hash(data):
+    """
+    block_hash() returns the leaf hash of a block of data.
+    """
+    return hashlib.sha256(data).digest()
+
+
+def width_for(length):
+    """
+    width_for() returns the number of leaves, a power of two, of the
+    smallest tree which covers the given number of bytes.
+    """
+    width = 1
+    while width * BLOCK_SIZE < length:
+        width *= 2
+    return width
+
+
+def pad_hash(width):
+    """
+    pad_hash() returns the root of a tree of the given width whose leaves
+    are all padding.
+    """
+    pad = _ZERO
+    while width > 1:
+        pad = hashlib.sha256(pad + pad).digest()
+        width /= 2
+    return pad
+
+
+def root(hashes, width, pad=_ZERO):
+    """
+    root() returns the root of the tree whose layer of the given width, a
+    power of two, begins with the hashes, the rest of the layer being the
+    pad hash.
+    """
+    if len(hashes) > width:
+        raise ValueError("More hashes than the width of the tree")
+    layer = list(hashes)
+    while width > 1:
+        if len(layer) % 2:
+            layer.append(pad)
+        layer = [hashlib.sha256(layer[i] + layer[i+1]).digest()
+                 for i in xrange(0, len(layer), 2)]
+        pad = hashlib.sha256(pad + pad).digest()
+        width /= 2
+    return layer[0] if layer else pad
+
+
+def split(hashes):
+    """
+    split() returns the list of hashes in a string of concatenated hashes.
+    """
+    if len(hashes) % HASH_SIZE:
+        raise ValueError("Hashes must be {} bytes long".format(HASH_SIZE))
+    return [hashes[i:i+HASH_SIZE] for i in xrange(0, len(hashes), HASH_SIZE)]
+
+
+class PieceHasher(object):
+    """
+    A PieceHasher computes the hash of a piece of the given width from its
+    blocks, which must be supplied in order.  Like the hashes of the hashlib
+    module, it is told about the data with update() and gives the hash of
+    the piece with digest().
+    """
+    def __init__(self, width):
+        self._width = width
+        self._hashes = []
+
+    def update(self, data):
+        for i in xrange(0, len(data), BLOCK_SIZE):
+            self._hashes.append(block_hash(buffer(data, i, BLOCK_SIZE)))
+
+    def verify(self, block, leaves):
+        """
+        verify() takes the next block of the piece and the list of the leaf
+        hashes of the piece's blocks.  It returns whether the block matches
+        its leaf, taking the block only if it does.
+        """
+        digest = block_hash(block)
+        if digest != leaves[len(self._hashes)]:
+            return False
+        self._hashes.append(digest)
+        return True
+
+    def digest(self):
+        return root(self._hashes, self._width)
@@ -0,0 +1,447 @@
+"""
+The MetadataMgr fetches the info dictionary of a torrent known only by the
+info hash in a magnet link, using metadata exchange (BEP 9), so that the
+torrent can be served without its metainfo file.  After being created, the
+MetadataMgr must be told to fetch, whereupon it looks for peers through the
+trackers named in the magnet link, the DHT and any peers named in the link
+itself, and connects to several of them at once.
+
+Each peer whose extended handshake says it supports ut_metadata and gives
+the size of the info dictionary is asked for the 16 KiB pieces of the
+dictionary which no other peer has been asked for, a couple at a time, so
+that the pieces are fetched from several peers in parallel.  Once every
+piece has been asked for, a peer with nothing left to do asks for pieces
+still outstanding with other peers, so that a slow peer doesn't hold up the
+last few pieces.  A peer which rejects a request, sends a piece of the wrong
+size or doesn't answer in time is dropped and its pieces are asked of other
+peers.  Peers which don't support metadata exchange are dropped too.
+
+When every piece has arrived, the info dictionary is checked against the
+info hash.  If it matches, the fetch fires with a Metainfo for the torrent
+made from the info dictionary and the magnet link's trackers, and peers()
+gives the peers which were connected to, for the torrent to try first.  If
+it doesn't, the peers which supplied pieces are dropped and the pieces are
+fetched again from others.  The fetch fails with a MetadataError if the
+info dictionary can't be fetched within ten minutes.
+
+The MetadataMgr is a client of its PeerProxies and its TrackerProxy in the
+same way as the TorrentMgr, but it has no pieces, rejects any requests for
+blocks or metadata and ignores messages about pieces.
+"""
+
+import hashlib
+import logging
+
+from bitstring import BitArray
+from twisted.internet.defer import Deferred
+
+import bencoding
+import extensions
+import peeraddr
+from metainfo import Metainfo
+from peerpool import PeerPool
+from peerproxy import PeerProxy
+from trackerproxy import TrackerProxy
+
+logger = logging.getLogger('bt.metadatamgr')
+
+_TIMER_INTERVAL = 1
+_PEER_TARGET = 10
+_MAX_OUTSTANDING = 2
+_REQUEST_TIMEOUT = 20
+_HANDSHAKE_TIMEOUT = 20
+_DHT_INTERVAL = 60
+_FETCH_TIMEOUT = 10 * 60
+_MAX_METADATA_SIZE = 8 * 2**20
+
+
+class MetadataError(Exception):
+    pass
+
+
+class MetadataMgr(object):
+    def __init__(self, magnet, port, peer_id, reactor, dht=None):
+        self._magnet = magnet
+        self._port = port
+        self._peer_id = peer_id
+        self._reactor = reactor
+        self._dht = dht
+
+        self._deferred = None
+        self._timer = None
+        self._deadline = None
+
+        # _size is the size of the info dictionary given by the first peer
+        # offering it and _pieces is a list of the data received for each of
+        # its pieces, or None for pieces not yet received.  _sources maps
+        # each piece received to the peer which sent it.
+        self._size = None
+        self._pieces = []
+        self._sources = {}
+
+        # _requested maps each piece which has been asked for to a dictionary
+        # mapping each peer asked to the time the request was sent
+        self._requested = {}
+
+        # _peers is a list of the peers connected to and _records maps each
+        # of them to its record.  _connected maps each peer which hasn't yet
+        # offered the info dictionary to when it was connected to, and _ready
+        # is the set of peers which have.
+        self._peers = []
+        self._records = {}
+        self._connected = {}
+        self._ready = set()
+
+        # _found holds the records of the peers which were connected to when
+        # the fetch finished
+        self._found = []
+
+        # Peers named in the magnet link are tried first
+        self._pool = PeerPool()
+        self._pool.add(magnet.peers, preferred=True)
+
+        self._tracker_proxy = TrackerProxy(self, magnet, port, peer_id,
+                                           reactor)
+        self._awaiting_peers = False
+        self._dht_searching = False
+        self._next_dht = 0
+
+    def fetch(self):
+        """
+        fetch() starts looking for peers and returns a deferred which fires
+        with a Metainfo for the torrent once its info dictionary has been
+        fetched and verified.  It fails with a MetadataError if the info
+        dictionary can't be fetched in time.
+        """
+        if self._deferred:
+            raise MetadataError("Already fetching")
+
+        self._deferred = Deferred()
+        self._deadline = self._reactor.seconds() + _FETCH_TIMEOUT
+        self._timer = self._reactor.callLater(_TIMER_INTERVAL,
+                                              self._timer_event)
+
+        def failed(failure):
+            logger.info("No tracker for {}: {}"
+                        .format(self._magnet.name, failure.value))
+
+        (self._tracker_proxy.start()
+         .addCallbacks(lambda _: self._connect_to_peers(), failed))
+        self._connect_to_peers()
+        return self._deferred
+
+    def stop(self):
+        """
+        stop() abandons the fetch, which fails.
+        """
+        self._finish(error=MetadataError("Fetch of {} stopped"
+                                         .format(self._magnet.name)))
+
+    def peers(self):
+        """
+        peers() returns the compact records of the peers which were connected
+        to when the fetch finished, so that the torrent can try them first.
+        """
+        return self._found
+
+    def _finish(self, metainfo=None, error=None):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        self._tracker_proxy.stop()
+
+        self._found = [self._records[peer] for peer in self._peers
+                       if peer.is_connected()]
+        for peer in self._peers:
+            peer.drop_connection()
+        self._peers = []
+
+        d, self._deferred = self._deferred, None
+        if d:
+            if error:
+                d.errback(error)
+            else:
+                d.callback(metainfo)
+
+    def _connect_to_peers(self):
+        # Connect to peers from the pool up to the target, asking the
+        # tracker and the DHT for more when the pool runs short
+        if not self._deferred:
+            return
+        n = _PEER_TARGET - len(self._peers)
+        if n <= 0:
+            return
+
+        records = self._pool.take(n)
+        now = self._reactor.seconds()
+        for record in records:
+            peer = PeerProxy(self, self._peer_id, peeraddr.to_addr(record),
+                             self._reactor, info_hash=self._magnet.info_hash)
+            self._peers.append(peer)
+            self._records[peer] = record
+            self._connected[peer] = now
+
+        if len(records) < n:
+            if not self._awaiting_peers and self._tracker_proxy.is_started():
+                self._awaiting_peers = True
+                (self._tracker_proxy.get_peers(n - len(records))
+                 .addCallback(self._found_peers))
+            self._search_dht()
+
+    def _found_peers(self, records):
+        self._awaiting_peers = False
+        if self._pool.add(records):
+            self._connect_to_peers()
+
+    def _search_dht(self):
+        now = self._reactor.seconds()
+        if not self._dht or self._dht_searching or now < self._next_dht:
+            return
+        self._dht_searching = True
+        self._next_dht = now + _DHT_INTERVAL
+
+        def found(records):
+            self._dht_searching = False
+            logger.debug("DHT found {} peers for {}"
+                         .format(len(records), self._magnet.name))
+            if self._pool.add(records):
+                self._connect_to_peers()
+
+        def failed(failure):
+            self._dht_searching = False
+            logger.info("DHT lookup failed: {}".format(failure.value))
+
+        (self._dht.get_peers(self._magnet.info_hash)
+         .addCallbacks(found, failed))
+
+    def _drop(self, peer):
+        if peer in self._records:
+            peer.drop_connection()
+            self._remove_peer(peer)
+
+    def _remove_peer(self, peer):
+        # Forget the peer and give the pieces it was asked for to others
+        if peer not in self._records:
+            return
+        self._peers.remove(peer)
+        self._pool.forget(self._records.pop(peer))
+        self._connected.pop(peer, None)
+        self._ready.discard(peer)
+        for piece, asked in self._requested.items():
+            asked.pop(peer, None)
+            if not asked:
+                del self._requested[piece]
+        for other in self._ready:
+            self._request(other)
+
+    def _piece_length(self, piece):
+        return min(extensions.METADATA_PIECE_SIZE,
+                   self._size - piece*extensions.METADATA_PIECE_SIZE)
+
+    def _request(self, peer):
+        # Ask the peer for pieces no other peer has been asked for, keeping
+        # a couple of requests outstanding.  When there are none, ask for
+        # pieces other peers have been asked for.
+        outstanding = sum(1 for asked in self._requested.values()
+                          if peer in asked)
+        missing = [piece for piece, data in enumerate(self._pieces)
+                   if data is None]
+        missing.sort(key=lambda piece: len(self._requested.get(piece, ())))
+        now = self._reactor.seconds()
+        for piece in missing:
+            if outstanding >= _MAX_OUTSTANDING:
+                break
+            asked = self._requested.setdefault(piece, {})
+            if peer not in asked:
+                asked[peer] = now
+                peer.metadata_request(piece)
+                outstanding += 1
+
+    def _verify(self):
+        info = ''.join(self._pieces)
+        if hashlib.sha1(info).digest() != self._magnet.info_hash:
+            # Any of the peers which sent pieces may have sent bad data, so
+            # none of them is trusted again
+            logger.info("Metadata for {} doesn't match its info hash"
+                        .format(self._magnet.name))
+            for peer in set(self._sources.values()):
+                self._drop(peer)
+            self._pieces = [None] * len(self._pieces)
+            self._sources = {}
+            if not self._ready:
+                self._size = None
+            for peer in self._ready:
+                self._request(peer)
+            return
+
+        # The trackers from the magnet link go in front of the info
+        # dictionary, which is kept exactly as received
+        outer = {}
+        if self._magnet.trackers:
+            outer['announce'] = self._magnet.announce
+            outer['announce-list'] = self._magnet.announce_list
+        contents = bencoding.encode(outer)[:-1] + '4:info' + info + 'e'
+        try:
+            metainfo = Metainfo(None, contents=contents,
+                                info_hash=self._magnet.info_hash)
+        except ValueError as err:
+            self._finish(error=MetadataError("Invalid metadata for {}: {}"
+                                             .format(self._magnet.name,
+                                                     err)))
+            return
+
+        logger.info("Fetched metadata for {}".format(metainfo.name))
+        self._finish(metainfo)
+
+    # Tracker callbacks
+
+    def uploaded(self):
+        return 0
+
+    def downloaded(self):
+        return 0
+
+    def left(self):
+        # The size of the torrent isn't known yet.  Reporting nothing left
+        # would make the trackers take this client for a seed.
+        return 1
+
+    # PeerProxy callbacks
+
+    def get_bitfield(self):
+        return BitArray()
+
+    def get_port(self):
+        return self._port
+
+    def metadata_size(self):
+        return None
+
+    def peer_unconnected(self, peer):
+        self._remove_peer(peer)
+        self._connect_to_peers()
+
+    def peer_extended_handshake(self, peer):
+        size = peer.extended_handshake().get('metadata_size')
+        if (not peer.supports_extension(extensions.UT_METADATA) or
+                not isinstance(size, (int, long)) or
+                not 0 < size <= _MAX_METADATA_SIZE or
+                (self._size is not None and size != self._size)):
+            self._drop(peer)
+            self._connect_to_peers()
+            return
+
+        if self._size is None:
+            self._size = size
+            self._pieces = [None] * ((size + extensions.METADATA_PIECE_SIZE
+                                      - 1) / extensions.METADATA_PIECE_SIZE)
+        self._connected.pop(peer, None)
+        self._ready.add(peer)
+        self._request(peer)
+
+    def peer_metadata_data(self, peer, piece, total_size, data):
+        if peer not in self._requested.get(piece, ()):
+            return
+        del self._requested[piece]
+
+        if total_size != self._size or len(data) != self._piece_length(piece):
+            logger.debug("Bad metadata piece {} from {}"
+                         .format(piece, str(peer.addr())))
+            self._drop(peer)
+            self._connect_to_peers()
+            return
+
+        self._pieces[piece] = data
+        self._sources[piece] = peer
+        if None not in self._pieces:
+            self._verify()
+        else:
+            self._request(peer)
+
+    def peer_metadata_reject(self, peer, piece):
+        if peer in self._requested.get(piece, ()):
+            self._drop(peer)
+            self._connect_to_peers()
+
+    def peer_metadata_request(self, peer, piece):
+        peer.metadata_reject(piece)
+
+    def peer_request(self, peer, index, begin, length):
+        peer.reject(index, begin, length)
+
+    def peer_hash_request(self, peer, pieces_root, base_layer, index, length,
+                          proof_layers):
+        peer.hash_reject(pieces_root, base_layer, index, length, proof_layers)
+
+    def peer_pex(self, peer, added, dropped):
+        if self._pool.add(added):
+            self._connect_to_peers()
+
+    def peer_bitfield(self, peer, bitfield):
+        pass
+
+    def peer_has_all(self, peer):
+        pass
+
+    def peer_has(self, peer, index):
+        pass
+
+    def peer_choked(self, peer):
+        pass
+
+    def peer_unchoked(self, peer):
+        pass
+
+    def peer_interested(self, peer):
+        pass
+
+    def peer_not_interested(self, peer):
+        pass
+
+    def peer_sent_block(self, peer, index, begin, buf):
+        pass
+
+    def peer_canceled(self, peer, index, begin, length):
+        pass
+
+    def peer_suggests(self, peer, index):
+        pass
+
+    def peer_rejected(self, peer, index, begin, length):
+        pass
+
+    def peer_allowed_fast(self, peer, index):
+        pass
+
+    def peer_hashes(self, peer, pieces_root, base_layer, index, length,
+                    proof_layers, hashes):
+        pass
+
+    def peer_hash_reject(self, peer, pieces_root, base_layer, index, length,
+                         proof_layers):
+        pass
+
+    # Reactor callback
+
+    def _timer_event(self):
+        self._timer = self._reactor.callLater(_TIMER_INTERVAL,
+                                              self._timer_event)
+        now = self._reactor.seconds()
+
+        if now >= self._deadline:
+            self._finish(error=MetadataError("Couldn't fetch metadata for "
+                                             "{} in time"
+                                             .format(self._magnet.name)))
+            return
+
+        # Drop peers which are slow to answer requests or haven't offered
+        # the info dictionary soon after connecting
+        for asked in self._requested.values():
+            for peer, sent in asked.items():
+                if now - sent >= _REQUEST_TIMEOUT:
+                    self._drop(peer)
+        for peer, since in self._connected.items():
+            if now - since >= _HANDSHAKE_TIMEOUT:
+                self._drop(peer)
+
+        self._connect_to_peers()
@@ -4,58 +4,204 @@ available via properties.  Upon initialization, Metainfo raises an exception if
 the specified file doesn't exist (IOError) or is not a valid bencoded
 BitTorrent metainfo file (ValueError).
 
-The SHA1 hash is currently computed on the info key which is bencoded after
-previously having been bdecoded.  This is probably not the right way to do it
-because if the order of the keys is different from the original the hash will
-be different.
+The SHA1 hash is computed on the bytes of the info key's value exactly as
+they appear in the file, so the info hash is correct even when the file
+isn't bencoded in canonical form.  The piece hashes are kept as a memoryview
+into the file's contents rather than copied out of it.
+
+A Metainfo can also be made from the contents of a metainfo file kept
+elsewhere, such as in the Catalog, along with the info hash computed when
+the file was first read so that it needn't be computed again.
+
+The announce url is optional, since a torrent whose info dictionary was
+fetched through a magnet link may have no trackers and be served through the
+DHT alone.  The bytes of the info dictionary are available, as a memoryview,
+so that they can be given to peers fetching the metadata themselves.
+
+BitTorrent v2 (BEP 52) torrents, and hybrid torrents which are both v1 and
+v2, are understood as well.  Their files are listed in a file tree, each
+with the root of a SHA-256 merkle tree over its 16 KiB blocks (see merkle),
+and every file starts at a piece boundary.  The nodes of each file's tree
+which cover its pieces are given in the piece layers outside the info
+dictionary.  Since they aren't covered by the info hash, they are checked
+against the pieces roots when the metainfo is read.  For a v2 torrent,
+piece_hash() gives the merkle hash of a piece, covering piece_width()
+blocks, rather than its SHA1 hash, and piece_size() excludes the unused end
+of the last piece of each file.
+
+The pieces are numbered as in a hybrid torrent, whose v1 file list places a
+padding file after each file which doesn't end on a piece boundary.  A v2
+torrent is given the same padding files, so the pieces lie at the same
+offsets within the files either way, and padding files are listed in
+padding so that they aren't stored.  A v2 torrent is identified by the
+SHA-256 hash of its info dictionary, truncated to 20 bytes where a v1 info
+hash is expected, while a hybrid torrent keeps its SHA1 info hash so that it
+is served to v1 and v2 peers alike.  A hybrid torrent without piece layers,
+such as one fetched through a magnet link, is served as a v1 torrent.
 """
 
-import bencode
+import bisect
 import hashlib
 
+import bencoding
+import merkle
+
+
+def _walk(tree, path, files):
+    # Appends the (path, length, pieces root) of each file in a v2 file tree
+    # to files, in the order of the tree
+    for name in sorted(tree):
+        node = tree[name]
+        if not isinstance(node, dict):
+            raise ValueError("Invalid BitTorrent metainfo file format")
+        if '' in node:
+            leaf = node['']
+            length = leaf['length']
+            if length < 0:
+                raise ValueError("Invalid BitTorrent metainfo file format")
+            files.append((path + [name], length,
+                          leaf['pieces root'] if length else None))
+        else:
+            _walk(node, path + [name], files)
+
 
 class Metainfo(object):
-    def __init__(self, filename):
-        metafile = open(filename, 'rb')
+    def __init__(self, filename, contents=None, info_hash=None):
+        if contents is None:
+            with open(filename, 'rb') as metafile:
+                contents = metafile.read()
+        self._contents = contents
 
         try:
-            self._metainfo = bencode.bdecode(metafile.read())
-        except bencode.BTFailure:
+            self._metainfo, spans = bencoding.decode_spans(contents,
+                                                           views=('pieces',))
+        except bencoding.BencodeError:
             raise ValueError("Invalid BitTorrent metainfo file format")
 
-        if 'announce' not in self._metainfo or 'info' not in self._metainfo:
+        if not isinstance(self._metainfo.get('info'), dict):
             raise ValueError("Invalid BitTorrent metainfo file format")
 
         info = self._metainfo['info']
+        v2 = info.get('meta version') == 2 and 'file tree' in info
         if ('piece length' not in info
-                or 'pieces' not in info
+                or ('pieces' not in info and not v2)
                 or 'name' not in info):
             raise ValueError("Invalid BitTorrent metainfo file format")
 
         self._name = info['name']
+        self._info_span = spans['info']
+        start, end = self._info_span
+
+        # _padding is the set of indices of padding files
+        self._padding = set()
+        self._v2 = None
 
         try:
-            if 'length' in info:
+            if v2 and ('pieces' not in info or
+                       'piece layers' in self._metainfo):
+                self._parse_v2(info, self._metainfo.get('piece layers', {}))
+            elif 'length' in info:
                 # Single file mode
                 self._directory = ''
                 self._files = [([info['name']], info['length'])]
-                self._length = info['length']
             else:
                 # Multi file mode
                 self._directory = info['name']
-                self._files = [(d['path'], d['length'])
-                               for d in self._metainfo['info']['files']]
-                self._length = sum([length for (_, length) in self._files])
-        except:
+                self._files = []
+                for d in info['files']:
+                    if 'p' in d.get('attr', ''):
+                        self._padding.add(len(self._files))
+                    self._files.append((d['path'], d['length']))
+            self._length = sum([length for (_, length) in self._files])
+        except (KeyError, TypeError, AttributeError):
             raise ValueError("Invalid BitTorrent metainfo file format")
 
-        self._hash = hashlib.sha1(bencode.bencode(info)).digest()
+        if 'pieces' in info:
+            self._pieces = info['pieces']
+            if not isinstance(self._pieces, memoryview):
+                raise ValueError("Invalid BitTorrent metainfo file format")
+            self._num_pieces = len(self._pieces)/20
+
+        if self._v2 and 'pieces' in info:
+            if self._num_pieces != self._v2_pieces:
+                raise ValueError("Inconsistent hybrid metainfo file")
+        elif self._v2:
+            self._num_pieces = self._v2_pieces
+
+        if info_hash is None:
+            if 'pieces' in info:
+                info_hash = hashlib.sha1(contents[start:end]).digest()
+            else:
+                info_hash = self.info_hash_v2[:20]
+        self._hash = info_hash
+
+    def _parse_v2(self, info, layers):
+        piece_length = info['piece length']
+        if piece_length < merkle.BLOCK_SIZE or piece_length & (
+                piece_length - 1):
+            raise ValueError("Invalid BitTorrent metainfo file format")
+        width = piece_length / merkle.BLOCK_SIZE
+
+        files = []
+        _walk(info['file tree'], [], files)
+        if not files:
+            raise ValueError("Invalid BitTorrent metainfo file format")
+
+        # A single file is named after the torrent, while the files of a
+        # multi file torrent lie within a directory named after it
+        if len(files) == 1 and files[0][0] == [info['name']]:
+            self._directory = ''
+        else:
+            self._directory = info['name']
+
+        # _v2 holds, for each file with data, the index of its first piece,
+        # its length, its pieces root and the hashes of its pieces.  A file
+        # which isn't the last and doesn't end on a piece boundary is
+        # followed by a padding file.
+        self._v2 = []
+        self._v2_first = []
+        self._files = []
+        piece = 0
+        for i, (path, length, root) in enumerate(files):
+            self._files.append((path, length))
+            if not length:
+                continue
+            if len(root) != merkle.HASH_SIZE:
+                raise ValueError("Invalid pieces root")
+            pieces = -(-length // piece_length)
+            if pieces == 1:
+                hashes = [root]
+            else:
+                if root not in layers:
+                    raise ValueError("Missing piece layer")
+                hashes = merkle.split(layers[root])
+                if (len(hashes) != pieces or
+                        merkle.root(hashes, merkle.width_for(
+                            pieces * merkle.BLOCK_SIZE),
+                            merkle.pad_hash(width)) != root):
+                    raise ValueError("Invalid piece layer")
+            self._v2_first.append(piece)
+            self._v2.append((length, root, hashes))
+            piece += pieces
 
-        self._num_pieces = len(self._metainfo['info']['pieces'])/20
+            tail = length % piece_length
+            if tail and i != len(files) - 1:
+                self._padding.add(len(self._files))
+                self._files.append((['.pad', str(piece_length - tail)],
+                                    piece_length - tail))
+        self._v2_pieces = piece
+
+    def _v2_piece(self, index):
+        # Returns the entry in _v2 for the file holding the piece and the
+        # index of the piece within the file
+        if not 0 <= index < self._num_pieces:
+            raise IndexError("{} out of range".format(index))
+        i = bisect.bisect_right(self._v2_first, index) - 1
+        return self._v2[i], index - self._v2_first[i]
 
     @property
     def announce(self):
-        return self._metainfo['announce']
+        return self._metainfo.get('announce', None)
 
     @property
     def announce_list(self):
@@ -89,12 +235,49 @@ class Metainfo(object):
     def num_pieces(self):
         return self._num_pieces
 
+    @property
+    def meta_version(self):
+        return 2 if self._v2 else 1
+
     def piece_hash(self, index):
-        if index <= self._num_pieces:
-            return self._metainfo['info']['pieces'][index*20:index*20+20]
+        if self._v2:
+            (_, _, hashes), piece = self._v2_piece(index)
+            return hashes[piece]
+        if 0 <= index < self._num_pieces:
+            return self._pieces[index*20:index*20+20].tobytes()
         else:
             raise IndexError("{} out of range".format(index))
 
+    def piece_size(self, index):
+        if self._v2:
+            (length, _, _), piece = self._v2_piece(index)
+            return min(self.piece_length, length - piece*self.piece_length)
+        if 0 <= index < self._num_pieces - 1:
+            return self.piece_length
+        elif index == self._num_pieces - 1:
+            return self._length - index*self.piece_length
+        else:
+            raise IndexError("{} out of range".format(index))
+
+    def piece_width(self, index):
+        """
+        piece_width() returns the number of blocks covered by the merkle
+        hash of a piece of a v2 torrent.
+        """
+        (length, _, hashes), _ = self._v2_piece(index)
+        if len(hashes) == 1:
+            return merkle.width_for(length)
+        return self.piece_length / merkle.BLOCK_SIZE
+
+    def piece_root(self, index):
+        """
+        piece_root() returns a tuple of the pieces root of the file holding
+        a piece of a v2 torrent and the index within the file's tree of the
+        leaf of the piece's first block.
+        """
+        (_, root, _), piece = self._v2_piece(index)
+        return root, piece * self.piece_length / merkle.BLOCK_SIZE
+
     @property
     def private(self):
         return self._metainfo['info'].get('private', None)
@@ -107,10 +290,30 @@ class Metainfo(object):
     def files(self):
         return self._files
 
+    @property
+    def padding(self):
+        return self._padding
+
+    @property
+    def contents(self):
+        return self._contents
+
+    @property
+    def info(self):
+        start, end = self._info_span
+        return memoryview(self._contents)[start:end]
+
     @property
     def info_hash(self):
         return self._hash
 
+    @property
+    def info_hash_v2(self):
+        if self._metainfo['info'].get('meta version') != 2:
+            return None
+        start, end = self._info_span
+        return hashlib.sha256(self._contents[start:end]).digest()
+
     @property
     def name(self):
         return self._name
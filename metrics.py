@@ -0,0 +1,244 @@
+"""
+The metrics module instruments the client with counters, gauges and
+histograms which the HTTP control channel exposes at /metrics in the
+Prometheus text format.
+
+Metrics are created at module level by the modules which update them, much
+as loggers are, and register themselves with the module's registry.  A
+metric may have labels, in which case labels() returns the child holding
+the value for a particular set of label values.  The hot paths of the client
+look up their children once, when a module is imported or an object is
+created, so that counting an event is no more than incrementing an
+attribute.  A metric without labels can be updated directly.  Nothing is
+formatted until the metrics are collected.
+
+A gauge can instead be given a function which is called when the metrics
+are collected and returns the value for each set of label values, so that
+figures which the client already keeps, such as the number of peers in each
+state, cost nothing until they are asked for.
+
+A histogram counts observations in buckets given by their upper bounds and
+keeps their sum.  The counts are kept per bucket and made cumulative only
+when collected.
+
+The ReactorLag measures how late the reactor runs a call scheduled at a
+regular interval, which shows how long the client's event handlers keep the
+reactor busy.
+"""
+
+import bisect
+
+_BUCKETS = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5)
+_LAG_INTERVAL = 1
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n') for value in values)
+    return '{' + ','.join('{}="{}"'.format(name, value)
+                          for name, value in zip(names, escaped)) + '}'
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._names = set()
+
+    def register(self, metric):
+        if metric.name in self._names:
+            raise ValueError("Metric {} is already registered"
+                             .format(metric.name))
+        self._names.add(metric.name)
+        self._metrics.append(metric)
+
+    def expose(self):
+        """
+        expose() returns the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, names, values, value in metric.samples():
+                lines.append('{}{}{} {}'.format(
+                    metric.name, suffix, _format_labels(names, values),
+                    _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets(object):
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        if not self.label_names:
+            self._bind(self.labels())
+        registry.register(self)
+
+    def _bind(self, child):
+        # Let a metric without labels be updated directly
+        pass
+
+    def _child(self):
+        return _Value()
+
+    def labels(self, *values):
+        """
+        labels() returns the child of the metric for the label values,
+        creating it if need be.
+        """
+        if len(values) != len(self.label_names):
+            raise ValueError("Metric {} takes labels {}"
+                             .format(self.name, self.label_names))
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            yield '', self.label_names, values, child.value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _bind(self, child):
+        self.inc = child.inc
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self._collector = None
+        _Metric.__init__(self, name, help, labels, registry)
+
+    def _bind(self, child):
+        self.inc = child.inc
+        self.dec = child.dec
+        self.set = child.set
+
+    def set_collector(self, collector):
+        """
+        set_collector() gives the gauge a function which returns a
+        dictionary mapping tuples of label values to the gauge's values
+        when the metrics are collected.
+        """
+        self._collector = collector
+
+    def samples(self):
+        if self._collector is None:
+            for sample in _Metric.samples(self):
+                yield sample
+            return
+        for values, value in sorted(self._collector().items()):
+            yield '', self.label_names, values, value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=_BUCKETS,
+                 registry=REGISTRY):
+        self._bounds = tuple(sorted(buckets))
+        _Metric.__init__(self, name, help, labels, registry)
+
+    def _bind(self, child):
+        self.observe = child.observe
+
+    def _child(self):
+        return _Buckets(self._bounds)
+
+    def samples(self):
+        names = self.label_names + ('le',)
+        for values, child in sorted(self._children.items()):
+            total = 0
+            for bound, count in zip(self._bounds + (float('inf'),),
+                                    child.counts):
+                total += count
+                yield ('_bucket', names, values + (_format_value(bound),),
+                       total)
+            yield '_sum', self.label_names, values, child.sum
+            yield '_count', self.label_names, values, total
+
+
+_REACTOR_LAG = Histogram('bt_reactor_lag_seconds',
+                         "How late the reactor runs a call scheduled at a "
+                         "regular interval")
+
+
+class ReactorLag(object):
+    def __init__(self, reactor, interval=_LAG_INTERVAL):
+        self._reactor = reactor
+        self._interval = interval
+        self._expected = None
+        self._timer = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _schedule(self):
+        self._expected = self._reactor.seconds() + self._interval
+        self._timer = self._reactor.callLater(self._interval,
+                                              self.timer_event)
+
+    # Reactor callback
+
+    def timer_event(self):
+        _REACTOR_LAG.observe(max(0, self._reactor.seconds() - self._expected))
+        self._schedule()
@@ -0,0 +1,99 @@
+"""
+The peeraddr module converts between the ways peer addresses are represented.
+Trackers, peer exchange and the DHT all describe peers in compact form,
+where an IPv4 peer takes six bytes, four for the address and two for the
+port, and an IPv6 peer takes eighteen bytes, sixteen for the address and two
+for the port, all in network byte order.
+
+Rather than converting every peer into a host string and a port number as it
+arrives, peers are kept as compact records, the six or eighteen byte strings
+themselves.  Splitting a compact peer list into records is a slice per peer
+with no per-byte work, and records are small, hashable and compare equal
+exactly when the addresses are equal.  A record is converted to a (host,
+port) address with to_addr() only when a connection is actually made.
+
+Malformed input never raises.  Bytes left over at the end of a compact list
+are ignored, as are addresses which can't be understood.
+"""
+
+import socket
+import struct
+
+IPV4_LENGTH = 6
+IPV6_LENGTH = 18
+
+
+def _split(compact, length):
+    compact = str(compact)
+    return [compact[offset:offset+length]
+            for offset in xrange(0, len(compact) - len(compact) % length,
+                                 length)]
+
+
+def decode_peers(compact):
+    """
+    decode_peers() splits a compact list of IPv4 peers into records.
+    """
+    return _split(compact, IPV4_LENGTH)
+
+
+def decode_peers6(compact):
+    """
+    decode_peers6() splits a compact list of IPv6 peers into records.
+    """
+    return _split(compact, IPV6_LENGTH)
+
+
+def encode_peers(records):
+    """
+    encode_peers() returns a tuple of the compact lists of the IPv4 records
+    and the IPv6 records.
+    """
+    return (''.join(r for r in records if len(r) == IPV4_LENGTH),
+            ''.join(r for r in records if len(r) == IPV6_LENGTH))
+
+
+def is_ipv6(record):
+    return len(record) == IPV6_LENGTH
+
+
+def from_addr(addr):
+    """
+    from_addr() returns the record of a (host, port) address where the host
+    is a literal IPv4 or IPv6 address, or None if the address is invalid.
+    """
+    host, port = addr
+    try:
+        packed_port = struct.pack('>H', port)
+        if ':' in host:
+            return socket.inet_pton(socket.AF_INET6, host) + packed_port
+        return socket.inet_pton(socket.AF_INET, host) + packed_port
+    except (socket.error, struct.error, TypeError):
+        return None
+
+
+def from_dicts(peers):
+    """
+    from_dicts() returns the records of a non-compact tracker peer list, a
+    list of dictionaries with 'ip' and 'port' entries.
+    """
+    records = []
+    for peer in peers:
+        try:
+            record = from_addr((peer['ip'], peer['port']))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if record:
+            records.append(record)
+    return records
+
+
+def to_addr(record):
+    """
+    to_addr() returns the (host, port) address of a record.
+    """
+    if len(record) == IPV6_LENGTH:
+        host = socket.inet_ntop(socket.AF_INET6, record[:16])
+    else:
+        host = socket.inet_ntop(socket.AF_INET, record[:4])
+    return host, struct.unpack('>H', record[-2:])[0]
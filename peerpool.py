@@ -0,0 +1,64 @@
+"""
+The PeerPool holds the addresses of peers which a TorrentMgr may connect to.
+Addresses can come from any source that learns about peers, such as the
+tracker or peer exchange, and the TorrentMgr takes addresses from the pool
+whenever it wants to open connections.  Addresses are held as compact
+records (see peeraddr).
+
+The pool remembers every address it currently knows about, whether still
+waiting to be tried or taken for a connection, so that hearing about the same
+peer from several sources doesn't lead to duplicate connections.  When a
+connection to a peer ends, the TorrentMgr should tell the pool to forget the
+address so that the peer can be tried again if it is heard about later.
+
+Addresses waiting to be tried are handed out in the order they were added,
+except that addresses added as preferred, such as peers on the local
+network, are handed out before any others.  The pool holds a bounded number
+of them and ignores new addresses when full.
+"""
+
+from collections import deque
+
+_MAX_CANDIDATES = 2000
+
+
+class PeerPool(object):
+    def __init__(self, max_candidates=_MAX_CANDIDATES):
+        self._max_candidates = max_candidates
+        self._candidates = deque()
+        self._preferred = deque()
+        self._known = set()
+
+    def __len__(self):
+        return len(self._candidates) + len(self._preferred)
+
+    def add(self, addrs, preferred=False):
+        """
+        add() takes a list of peer records and adds those which are not
+        already known.  It returns the number of addresses added.
+        """
+        candidates = self._preferred if preferred else self._candidates
+        added = 0
+        for addr in addrs:
+            if len(self) >= self._max_candidates:
+                break
+            if addr not in self._known:
+                self._known.add(addr)
+                candidates.append(addr)
+                added += 1
+        return added
+
+    def take(self, n):
+        """
+        take() removes and returns up to n addresses to connect to.  The
+        addresses remain known until they are forgotten.
+        """
+        addrs = []
+        while self._preferred and len(addrs) < n:
+            addrs.append(self._preferred.popleft())
+        while self._candidates and len(addrs) < n:
+            addrs.append(self._candidates.popleft())
+        return addrs
+
+    def forget(self, addr):
+        self._known.discard(addr)
@@ -26,18 +26,62 @@ bytes.  Initially, the PeerProxy uses a HandshakeTranslator to translate the
 "handshake" protocol.  After the handshake has been established, it sets up a
 PeerWireTranslator to translate the peer wire protocol.
 
-Currently, the PeerProxy does not handle or generate keep alives at all.
+The PeerProxy advertises the Fast Extension (BEP 6) in its handshake.  When
+the peer advertises it too, a have all or have none message may be received
+or sent in place of a bitfield, requests which the peer won't satisfy are
+explicitly rejected, a choke no longer implicitly discards outstanding
+requests and the peer may suggest pieces or allow some pieces to be
+downloaded even while it is choking.  Fast Extension messages from a peer
+which did not negotiate the extension cause the connection to be dropped.
+
+The PeerProxy also advertises the extension protocol (BEP 10).  When the peer
+supports it as well, the PeerProxy sends an extended handshake right after
+the bitfield and remembers the extensions listed in the peer's extended
+handshake.  It decodes peer exchange (ut_pex) messages and passes on the
+peers they add and drop to the client, and it sends peer exchange messages
+on behalf of the client if the peer supports them.  It likewise passes on
+and sends the request, data and reject messages of metadata exchange
+(ut_metadata), and includes the size of the info dictionary the client
+supplies in its extended handshake.  A client which is still fetching the
+info dictionary has an empty bitfield, and no bitfield is sent for it.
+
+The PeerProxy advertises support for BitTorrent v2 (BEP 52) as well, and
+passes on and sends the hash request, hashes and hash reject messages with
+which v2 peers exchange the hashes of the blocks of a file.  Like Fast
+Extension messages, they cause the connection to be dropped if the peer
+didn't advertise v2 support.
+
+The PeerProxy measures how the peer is performing.  It keeps sliding window
+estimates of the download and upload rates and times each block request
+from the moment it is sent until the corresponding piece arrives to estimate
+the round trip time.  The client uses these to time out requests adaptively
+and to mark a peer as snubbed when a request goes unanswered.  A snubbed
+peer is unsnubbed as soon as it delivers a block.
+
+The PeerProxy records when it last received and last sent a message and
+when a block was last exchanged with the peer.  It does not time anything
+itself.  The client checks these times periodically and asks the PeerProxy to
+send a keep alive when the connection has been quiet, drops it when the peer
+has stopped talking and reaps it when it has not been useful for some time.
 """
 
+import extensions
 import logging
 
-from handshaketranslator import HandshakeTranslator
+from estimators import RateEstimator, RTTEstimator
+from handshaketranslator import (EXTENSION_PROTOCOL, FAST_EXTENSION,
+                                 V2_PROTOCOL, HandshakeTranslator,
+                                 has_extension, reserved_bytes)
 from peerwiretranslator import PeerWireTranslator
 from protocoladapter import ProtocolAdapterFactory
-from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint
 
 logger = logging.getLogger('bt.peerproxy')
 
+_STATE_NAMES = ['awaiting_handshake', 'awaiting_connection',
+                'handshake_initiated', 'bitfield_allowed', 'peer_to_peer',
+                'disconnected']
+
 
 class PeerProxy(object):
     class _States(object):
@@ -57,6 +101,33 @@ class PeerProxy(object):
         self._interested = False
         self._peer_choked = True
         self._peer_interested = False
+        self._snubbed = False
+        self._fast = False
+        self._extended = False
+        self._v2 = False
+
+        # _extended_handshake is the dictionary the peer sent in its extended
+        # handshake
+        self._extended_handshake = {}
+
+        # _allowed_fast is the set of pieces the peer allows to be requested
+        # while it is choking and _suggested is a list of the pieces it has
+        # suggested in the order they were suggested
+        self._allowed_fast = set()
+        self._suggested = []
+
+        self._download = RateEstimator()
+        self._upload = RateEstimator()
+        self._rtt = RTTEstimator()
+
+        # _request_times maps the (index, begin) of each outstanding block
+        # request to the time the request was sent
+        self._request_times = {}
+
+        now = reactor.seconds()
+        self._last_rx = now
+        self._last_tx = now
+        self._last_block = now
 
         if len(peer_id) != 20:
             raise ValueError("Peer id must be 20 bytes long")
@@ -68,8 +139,11 @@ class PeerProxy(object):
             self._translator = None
 
             host, port = addr
-            d = (TCP4ClientEndpoint(reactor, host, port)
-                 .connect(ProtocolAdapterFactory(self)))
+            if ':' in host:
+                endpoint = TCP6ClientEndpoint(reactor, host, port)
+            else:
+                endpoint = TCP4ClientEndpoint(reactor, host, port)
+            d = endpoint.connect(ProtocolAdapterFactory(self))
             d.addErrback(self.connection_failed)
 
             self._state = self._States.Awaiting_Connection
@@ -95,6 +169,7 @@ class PeerProxy(object):
             self._client.peer_unconnected(self)
 
     def _valid_rx_state(self):
+        self._last_rx = self._reactor.seconds()
         if self._state != self._States.Peer_to_Peer:
             if self._state == self._States.Bitfield_Allowed:
                 self._state = self._States.Peer_to_Peer
@@ -104,12 +179,34 @@ class PeerProxy(object):
                 return False
         return True
 
+    def _valid_fast_rx_state(self):
+        if not self._fast:
+            if self._state != self._States.Disconnected:
+                self._drop_connection()
+            return False
+        return self._valid_rx_state()
+
+    def _valid_extended_rx_state(self):
+        if not self._extended:
+            if self._state != self._States.Disconnected:
+                self._drop_connection()
+            return False
+        return self._valid_rx_state()
+
+    def _valid_v2_rx_state(self):
+        if not self._v2:
+            if self._state != self._States.Disconnected:
+                self._drop_connection()
+            return False
+        return self._valid_rx_state()
+
     def _valid_tx_state(self):
         if self._state != self._States.Peer_to_Peer:
             if self._state == self._States.Bitfield_Allowed:
                 self._state = self._States.Peer_to_Peer
             else:
                 return False
+        self._last_tx = self._reactor.seconds()
         return True
 
     def addr(self):
@@ -127,17 +224,95 @@ class PeerProxy(object):
     def is_peer_interested(self):
         return self._peer_interested
 
-    # Callbacks which result from TCP4ClientEndpoint.connect()
+    def is_snubbed(self):
+        return self._snubbed
+
+    def supports_fast(self):
+        return self._fast
+
+    def supports_v2(self):
+        return self._v2
+
+    def is_allowed_fast(self, index):
+        return index in self._allowed_fast
+
+    def allowed_fast(self):
+        return self._allowed_fast
+
+    def suggested(self):
+        return self._suggested
+
+    def supports_extension(self, name):
+        return bool(self._extended_handshake.get('m', {}).get(name))
+
+    def extended_handshake(self):
+        return self._extended_handshake
+
+    def is_connected(self):
+        return self._state in (self._States.Bitfield_Allowed,
+                               self._States.Peer_to_Peer)
+
+    def state(self):
+        return _STATE_NAMES[self._state]
+
+    def last_rx(self):
+        return self._last_rx
+
+    def last_tx(self):
+        return self._last_tx
+
+    def last_block(self):
+        return self._last_block
+
+    def download_rate(self):
+        return self._download.rate(self._reactor.seconds())
+
+    def upload_rate(self):
+        return self._upload.rate(self._reactor.seconds())
+
+    def rtt(self):
+        return self._rtt.srtt
+
+    def request_timeout(self):
+        return self._rtt.timeout()
+
+    def stats(self):
+        host, port = self._addr
+        if ':' in host:
+            host = "[{}]".format(host)
+        return {'addr': "{}:{}".format(host, port),
+                'state': self.state(),
+                'download_rate': self.download_rate(),
+                'upload_rate': self.upload_rate(),
+                'rtt': self._rtt.srtt,
+                'snubbed': self._snubbed,
+                'interested': self._interested,
+                'unchoked': not self._peer_choked,
+                'requests': len(self._request_times)}
+
+    # Callbacks which result from the client endpoint's connect()
 
     def connection_complete(self, protocol):
+        # A connection which completes after the peer has been dropped is
+        # closed straight away
+        if self._state == self._States.Disconnected:
+            protocol.unset_receiver()
+            protocol.stop()
+            return
+
         self._protocol = protocol
         self._setup_handshake_translator()
 
-        self._translator.tx_handshake(0, self._info_hash, self._peer_id)
+        self._translator.tx_handshake(reserved_bytes(EXTENSION_PROTOCOL,
+                                                     FAST_EXTENSION,
+                                                     V2_PROTOCOL),
+                                      self._info_hash, self._peer_id)
+        self._last_tx = self._reactor.seconds()
         self._state = self._States.Handshake_Initiated
 
     def connection_failed(self, reason):
-        self._client.peer_unconnected(self)
+        if self._state != self._States.Disconnected:
+            self._client.peer_unconnected(self)
 
     # Translator callbacks
 
@@ -147,6 +322,7 @@ class PeerProxy(object):
     # HandshakeTranslator callbacks
 
     def rx_handshake(self, reserved, info_hash, peer_id):
+        self._last_rx = self._reactor.seconds()
         if self._state == self._States.Handshake_Initiated:
             if info_hash != self._info_hash:
                 self._drop_connection()
@@ -156,8 +332,24 @@ class PeerProxy(object):
 
                 self._translator = PeerWireTranslator(self, self._protocol)
                 self._state = self._States.Bitfield_Allowed
-
-                self._translator.tx_bitfield(self._client.get_bitfield())
+                self._fast = has_extension(reserved, FAST_EXTENSION)
+                self._extended = has_extension(reserved, EXTENSION_PROTOCOL)
+                self._v2 = has_extension(reserved, V2_PROTOCOL)
+
+                bitfield = self._client.get_bitfield()
+                if self._fast and not bitfield.any(True):
+                    self._translator.tx_have_none()
+                elif self._fast and bitfield.all(True):
+                    self._translator.tx_have_all()
+                elif len(bitfield):
+                    self._translator.tx_bitfield(bitfield)
+
+                if self._extended:
+                    self._translator.tx_extended(
+                        extensions.EXTENDED_HANDSHAKE,
+                        extensions.encode_handshake(
+                            self._client.get_port(),
+                            self._client.metadata_size()))
 
     def rx_non_handshake(self):
         self._drop_connection()
@@ -165,18 +357,40 @@ class PeerProxy(object):
     # PeerWireTranslator callbacks
 
     def rx_bitfield(self, bitfield):
+        self._last_rx = self._reactor.seconds()
         if self._state == self._States.Bitfield_Allowed:
             self._state = self._States.Peer_to_Peer
             self._client.peer_bitfield(self, bitfield)
         else:
             self._drop_connection()
 
+    def rx_have_all(self):
+        self._last_rx = self._reactor.seconds()
+        if self._fast and self._state == self._States.Bitfield_Allowed:
+            self._state = self._States.Peer_to_Peer
+            self._client.peer_has_all(self)
+        else:
+            self._drop_connection()
+
+    def rx_have_none(self):
+        # The peer's bitfield is already empty, so there is nothing to tell
+        # the client
+        self._last_rx = self._reactor.seconds()
+        if self._fast and self._state == self._States.Bitfield_Allowed:
+            self._state = self._States.Peer_to_Peer
+        else:
+            self._drop_connection()
+
     def rx_keep_alive(self):
-        pass
+        self._last_rx = self._reactor.seconds()
 
     def rx_choke(self):
         if self._valid_rx_state():
+            # Without the Fast Extension, a choke discards any outstanding
+            # requests.  With it, each one is explicitly rejected or served.
             self._peer_choked = True
+            if not self._fast:
+                self._request_times.clear()
             self._client.peer_choked(self)
 
     def rx_unchoke(self):
@@ -200,21 +414,97 @@ class PeerProxy(object):
 
     def rx_request(self, index, begin, length):
         if self._valid_rx_state():
-            self._client.peer_requests(self, index, begin, length)
+            self._client.peer_request(self, index, begin, length)
 
     def rx_piece(self, index, begin, buf):
         if self._valid_rx_state():
+            now = self._reactor.seconds()
+            sent = self._request_times.pop((index, begin), None)
+            if sent is not None:
+                self._rtt.sample(now - sent)
+            self._download.update(len(buf), now)
+            self._last_block = now
+            self._snubbed = False
             self._client.peer_sent_block(self, index, begin, buf)
 
     def rx_cancel(self, index, begin, length):
         if self._valid_rx_state():
             self._client.peer_canceled(self, index, begin, length)
 
+    def rx_suggest_piece(self, index):
+        if self._valid_fast_rx_state():
+            if index not in self._suggested:
+                self._suggested.append(index)
+            self._client.peer_suggests(self, index)
+
+    def rx_reject_request(self, index, begin, length):
+        if self._valid_fast_rx_state():
+            self._request_times.pop((index, begin), None)
+            self._client.peer_rejected(self, index, begin, length)
+
+    def rx_allowed_fast(self, index):
+        if self._valid_fast_rx_state():
+            self._allowed_fast.add(index)
+            self._client.peer_allowed_fast(self, index)
+
+    def rx_extended(self, extended_id, payload):
+        if not self._valid_extended_rx_state():
+            return
+
+        try:
+            if extended_id == extensions.EXTENDED_HANDSHAKE:
+                handshake = extensions.decode_handshake(payload)
+                self._extended_handshake = handshake
+                self._client.peer_extended_handshake(self)
+            elif extended_id == extensions.LOCAL_IDS[extensions.UT_PEX]:
+                added, dropped = extensions.decode_pex(payload)
+                self._client.peer_pex(self, added, dropped)
+            elif extended_id == extensions.LOCAL_IDS[extensions.UT_METADATA]:
+                msg_type, piece, total_size, data = (
+                    extensions.decode_metadata(payload))
+                if msg_type == extensions.METADATA_REQUEST:
+                    self._client.peer_metadata_request(self, piece)
+                elif msg_type == extensions.METADATA_DATA:
+                    self._client.peer_metadata_data(self, piece, total_size,
+                                                    data)
+                else:
+                    self._client.peer_metadata_reject(self, piece)
+            else:
+                logger.debug("Received unknown extended message id {} from {}"
+                             .format(extended_id, str(self._addr)))
+        except ValueError as err:
+            logger.debug("{} from {}".format(err, str(self._addr)))
+
+    def rx_hash_request(self, pieces_root, base_layer, index, length,
+                        proof_layers):
+        if self._valid_v2_rx_state():
+            self._client.peer_hash_request(self, pieces_root, base_layer,
+                                           index, length, proof_layers)
+
+    def rx_hashes(self, pieces_root, base_layer, index, length, proof_layers,
+                  hashes):
+        if self._valid_v2_rx_state():
+            self._client.peer_hashes(self, pieces_root, base_layer, index,
+                                     length, proof_layers, str(hashes))
+
+    def rx_hash_reject(self, pieces_root, base_layer, index, length,
+                       proof_layers):
+        if self._valid_v2_rx_state():
+            self._client.peer_hash_reject(self, pieces_root, base_layer,
+                                          index, length, proof_layers)
+
     # Client calls
 
     def drop_connection(self):
         self._drop_connection(False)
 
+    def snub(self):
+        self._snubbed = True
+
+    def keep_alive(self):
+        if self._valid_tx_state():
+            self._translator.tx_keep_alive()
+
     def choke(self):
         if self._valid_tx_state():
             self._choked = True
@@ -241,12 +531,65 @@ class PeerProxy(object):
 
     def request(self, index, begin, length):
         if self._valid_tx_state():
+            self._request_times[(index, begin)] = self._reactor.seconds()
             self._translator.tx_request(index, begin, length)
 
     def piece(self, index, begin, buf, offset):
         if self._valid_tx_state():
+            self._last_block = self._last_tx
+            self._upload.update(len(buf), self._last_block)
             self._translator.tx_piece(index, begin, buf)
 
     def cancel(self, index, begin, length):
         if self._valid_tx_state():
+            self._request_times.pop((index, begin), None)
             self._translator.tx_cancel(index, begin, length)
+
+    def reject(self, index, begin, length):
+        if self._fast and self._valid_tx_state():
+            self._translator.tx_reject_request(index, begin, length)
+
+    def suggest(self, index):
+        if self._fast and self._valid_tx_state():
+            self._translator.tx_suggest_piece(index)
+
+    def pex(self, added, dropped):
+        if (self.supports_extension(extensions.UT_PEX) and
+                self._valid_tx_state()):
+            self._translator.tx_extended(
+                self._extended_handshake['m'][extensions.UT_PEX],
+                extensions.encode_pex(added, dropped))
+
+    def _metadata(self, msg_type, piece, total_size=None, data=''):
+        if (self.supports_extension(extensions.UT_METADATA) and
+                self._valid_tx_state()):
+            self._translator.tx_extended(
+                self._extended_handshake['m'][extensions.UT_METADATA],
+                extensions.encode_metadata(msg_type, piece, total_size, data))
+
+    def metadata_request(self, piece):
+        self._metadata(extensions.METADATA_REQUEST, piece)
+
+    def metadata_data(self, piece, total_size, data):
+        self._metadata(extensions.METADATA_DATA, piece, total_size, data)
+
+    def metadata_reject(self, piece):
+        self._metadata(extensions.METADATA_REJECT, piece)
+
+    def hash_request(self, pieces_root, base_layer, index, length,
+                     proof_layers):
+        if self._v2 and self._valid_tx_state():
+            self._translator.tx_hash_request(pieces_root, base_layer, index,
+                                             length, proof_layers)
+
+    def hashes(self, pieces_root, base_layer, index, length, proof_layers,
+               hashes):
+        if self._v2 and self._valid_tx_state():
+            self._translator.tx_hashes(pieces_root, base_layer, index, length,
+                                       proof_layers, hashes)
+
+    def hash_reject(self, pieces_root, base_layer, index, length,
+                    proof_layers):
+        if self._v2 and self._valid_tx_state():
+            self._translator.tx_hash_reject(pieces_root, base_layer, index,
+                                            length, proof_layers)
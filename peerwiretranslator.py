@@ -18,7 +18,18 @@ lost.
 
 A receiver must implement the following methods: rx_keep_alive(), rx_choke(),
 rx_unchoke(), rx_interested(), rx_not_interested, rx_bitfield(), rx_have(),
-rx_request(), rx_piece() and rx_cancel() and connection_lost().
+rx_request(), rx_piece() and rx_cancel() and connection_lost().  It must also
+implement the Fast Extension (BEP 6) methods rx_suggest_piece(),
+rx_have_all(), rx_have_none(), rx_reject_request() and rx_allowed_fast().
+It must implement rx_extended() for messages of the extension protocol (BEP
+10).  Finally, it must implement rx_hash_request(), rx_hashes() and
+rx_hash_reject() for the messages with which BitTorrent v2 (BEP 52) peers
+exchange the hashes of a file's merkle tree.  Each identifies a run of hashes
+by the pieces root of the file, the layer of the tree, counted up from the
+leaves, the index of the first hash and the number of hashes, and also gives
+the number of layers of proof hashes wanted or sent above them.  The
+translator doesn't know whether these extensions were negotiated, so it is up
+to the receiver to decide whether these messages are acceptable.
 
 On the readerwriter side, when incoming bytes are available, the readerwriter
 asks the PeerWireTranslator for a buffer to put them into and after it has
@@ -29,9 +40,12 @@ data to be placed in one buffer even if it is received over multiple socket
 reads.
 
 A readerwriter must implement set_receiver(), unset_receiver() and tx_bytes()
+
+The messages sent and received are counted by type for the client's metrics.
 """
 
 import logging
+import metrics
 import struct
 from bitstring import BitArray
 
@@ -48,6 +62,48 @@ _MSG_BITFIELD = 5
 _MSG_REQUEST = 6
 _MSG_PIECE = 7
 _MSG_CANCEL = 8
+_MSG_SUGGEST_PIECE = 13
+_MSG_HAVE_ALL = 14
+_MSG_HAVE_NONE = 15
+_MSG_REJECT_REQUEST = 16
+_MSG_ALLOWED_FAST = 17
+_MSG_EXTENDED = 20
+_MSG_HASH_REQUEST = 21
+_MSG_HASHES = 22
+_MSG_HASH_REJECT = 23
+
+_HASH_HEADER_LEN = 48
+
+_MSG_NAMES = {_MSG_CHOKE: 'choke',
+              _MSG_UNCHOKE: 'unchoke',
+              _MSG_INTERESTED: 'interested',
+              _MSG_NOT_INTERESTED: 'not_interested',
+              _MSG_HAVE: 'have',
+              _MSG_BITFIELD: 'bitfield',
+              _MSG_REQUEST: 'request',
+              _MSG_PIECE: 'piece',
+              _MSG_CANCEL: 'cancel',
+              _MSG_SUGGEST_PIECE: 'suggest_piece',
+              _MSG_HAVE_ALL: 'have_all',
+              _MSG_HAVE_NONE: 'have_none',
+              _MSG_REJECT_REQUEST: 'reject_request',
+              _MSG_ALLOWED_FAST: 'allowed_fast',
+              _MSG_EXTENDED: 'extended',
+              _MSG_HASH_REQUEST: 'hash_request',
+              _MSG_HASHES: 'hashes',
+              _MSG_HASH_REJECT: 'hash_reject'}
+
+# The counters of the messages sent and received of each type are looked up
+# once so that counting a message costs no more than an increment
+_MESSAGES = metrics.Counter('bt_peer_messages_total',
+                            "Peer wire messages by direction and type",
+                            ('direction', 'type'))
+_SENT = dict((message_id, _MESSAGES.labels('sent', name))
+             for message_id, name in _MSG_NAMES.items())
+_RECEIVED = dict((message_id, _MESSAGES.labels('received', name))
+                 for message_id, name in _MSG_NAMES.items())
+_SENT_KEEP_ALIVE = _MESSAGES.labels('sent', 'keep_alive')
+_RECEIVED_KEEP_ALIVE = _MESSAGES.labels('received', 'keep_alive')
 
 
 class PeerWireTranslator(object):
@@ -77,7 +133,16 @@ class PeerWireTranslator(object):
                               _MSG_BITFIELD: self.rx_bitfield,
                               _MSG_REQUEST: self.rx_request,
                               _MSG_PIECE: self.rx_piece,
-                              _MSG_CANCEL: self.rx_cancel}
+                              _MSG_CANCEL: self.rx_cancel,
+                              _MSG_SUGGEST_PIECE: self.rx_suggest_piece,
+                              _MSG_HAVE_ALL: self.rx_have_all,
+                              _MSG_HAVE_NONE: self.rx_have_none,
+                              _MSG_REJECT_REQUEST: self.rx_reject_request,
+                              _MSG_ALLOWED_FAST: self.rx_allowed_fast,
+                              _MSG_EXTENDED: self.rx_extended,
+                              _MSG_HASH_REQUEST: self.rx_hash_request,
+                              _MSG_HASHES: self.rx_hashes,
+                              _MSG_HASH_REJECT: self.rx_hash_reject}
 
     def _length_state_setup(self):
         self._rx_state = self._States.Length
@@ -111,6 +176,7 @@ class PeerWireTranslator(object):
             if self._rx_state == self._States.Length:
                 (length,) = struct.unpack('>i', buffer(self._length_buf))
                 if length == 0:
+                    _RECEIVED_KEEP_ALIVE.inc()
                     self.rx_keep_alive()
                     self._length_state_setup()
                 else:
@@ -125,6 +191,7 @@ class PeerWireTranslator(object):
                                               buffer(self._current_buf[0:1]))
 
                 try:
+                    _RECEIVED[message_id].inc()
                     self._rx_functions[message_id]()
                 except KeyError:
                     logger.debug("Received message with invalid msg id: {}"
@@ -181,34 +248,90 @@ class PeerWireTranslator(object):
             index, begin, length, = struct.unpack(">3I", buf)
             self._receiver.rx_cancel(index, begin, length)
 
+    def rx_suggest_piece(self):
+        if self._receiver:
+            (index,) = struct.unpack(">I", buffer(self._current_buf[1:5]))
+            self._receiver.rx_suggest_piece(index)
+
+    def rx_have_all(self):
+        if self._receiver:
+            self._receiver.rx_have_all()
+
+    def rx_have_none(self):
+        if self._receiver:
+            self._receiver.rx_have_none()
+
+    def rx_reject_request(self):
+        if self._receiver:
+            buf = buffer(self._current_buf[1:])
+            index, begin, length, = struct.unpack(">3I", buf)
+            self._receiver.rx_reject_request(index, begin, length)
+
+    def rx_allowed_fast(self):
+        if self._receiver:
+            (index,) = struct.unpack(">I", buffer(self._current_buf[1:5]))
+            self._receiver.rx_allowed_fast(index)
+
+    def rx_extended(self):
+        if self._receiver:
+            (extended_id,) = struct.unpack("B",
+                                           buffer(self._current_buf[1:2]))
+            self._receiver.rx_extended(extended_id,
+                                       buffer(self._current_buf[2:]))
+
+    def _hash_header(self):
+        return struct.unpack('>32s4I', buffer(self._current_buf,
+                                              1, _HASH_HEADER_LEN))
+
+    def rx_hash_request(self):
+        if self._receiver:
+            self._receiver.rx_hash_request(*self._hash_header())
+
+    def rx_hashes(self):
+        if self._receiver:
+            header = self._hash_header()
+            hashes = buffer(self._current_buf, 1+_HASH_HEADER_LEN)
+            self._receiver.rx_hashes(*(header + (hashes,)))
+
+    def rx_hash_reject(self):
+        if self._receiver:
+            self._receiver.rx_hash_reject(*self._hash_header())
+
     def tx_keep_alive(self):
         if self._readerwriter:
-            self._readerwriter.tx_bytes(struct.pack('B', 0))
+            _SENT_KEEP_ALIVE.inc()
+            self._readerwriter.tx_bytes(struct.pack('>I', 0))
 
     def tx_choke(self):
         if self._readerwriter:
+            _SENT[_MSG_CHOKE].inc()
             self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_CHOKE))
 
     def tx_unchoke(self):
         if self._readerwriter:
+            _SENT[_MSG_UNCHOKE].inc()
             self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_UNCHOKE))
 
     def tx_interested(self):
         if self._readerwriter:
+            _SENT[_MSG_INTERESTED].inc()
             self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_INTERESTED))
 
     def tx_not_interested(self):
         if self._readerwriter:
+            _SENT[_MSG_NOT_INTERESTED].inc()
             self._readerwriter.tx_bytes(struct.pack('>IB', 1,
                                                     _MSG_NOT_INTERESTED))
 
     def tx_have(self, index):
         if self._readerwriter:
+            _SENT[_MSG_HAVE].inc()
             self._readerwriter.tx_bytes(struct.pack('>IBI', 5,
                                                     _MSG_HAVE, index))
 
     def tx_bitfield(self, bits):
         if self._readerwriter:
+            _SENT[_MSG_BITFIELD].inc()
             bitfield = bits.tobytes()
             length = len(bitfield)
             self._readerwriter.tx_bytes(struct.pack('>IB{}s'.format(length),
@@ -217,11 +340,13 @@ class PeerWireTranslator(object):
 
     def tx_request(self, index, begin, length):
         if self._readerwriter:
+            _SENT[_MSG_REQUEST].inc()
             self._readerwriter.tx_bytes(struct.pack('>IB3I', 13, _MSG_REQUEST,
                                                     index, begin, length))
 
     def tx_piece(self, index, begin, block):
         if self._readerwriter:
+            _SENT[_MSG_PIECE].inc()
             length = len(block)
             self._readerwriter.tx_bytes(struct.pack('>IB2I{}s'.format(length),
                                                     9+length, _MSG_PIECE,
@@ -229,9 +354,73 @@ class PeerWireTranslator(object):
 
     def tx_cancel(self, index, begin, length):
         if self._readerwriter:
+            _SENT[_MSG_CANCEL].inc()
             self._readerwriter.tx_bytes(struct.pack('>IB3I', 13, _MSG_CANCEL,
                                                     index, begin, length))
 
+    def tx_suggest_piece(self, index):
+        if self._readerwriter:
+            _SENT[_MSG_SUGGEST_PIECE].inc()
+            self._readerwriter.tx_bytes(struct.pack('>IBI', 5,
+                                                    _MSG_SUGGEST_PIECE,
+                                                    index))
+
+    def tx_have_all(self):
+        if self._readerwriter:
+            _SENT[_MSG_HAVE_ALL].inc()
+            self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_HAVE_ALL))
+
+    def tx_have_none(self):
+        if self._readerwriter:
+            _SENT[_MSG_HAVE_NONE].inc()
+            self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_HAVE_NONE))
+
+    def tx_reject_request(self, index, begin, length):
+        if self._readerwriter:
+            _SENT[_MSG_REJECT_REQUEST].inc()
+            self._readerwriter.tx_bytes(struct.pack('>IB3I', 13,
+                                                    _MSG_REJECT_REQUEST,
+                                                    index, begin, length))
+
+    def tx_allowed_fast(self, index):
+        if self._readerwriter:
+            _SENT[_MSG_ALLOWED_FAST].inc()
+            self._readerwriter.tx_bytes(struct.pack('>IBI', 5,
+                                                    _MSG_ALLOWED_FAST, index))
+
+    def tx_extended(self, extended_id, payload):
+        if self._readerwriter:
+            _SENT[_MSG_EXTENDED].inc()
+            length = len(payload)
+            self._readerwriter.tx_bytes(struct.pack('>IBB{}s'.format(length),
+                                                    2+length, _MSG_EXTENDED,
+                                                    extended_id, payload))
+
+    def _tx_hash_message(self, message_id, pieces_root, base_layer, index,
+                         length, proof_layers, hashes=''):
+        if self._readerwriter:
+            _SENT[message_id].inc()
+            self._readerwriter.tx_bytes(struct.pack(
+                '>IB32s4I', 1+_HASH_HEADER_LEN+len(hashes), message_id,
+                pieces_root, base_layer, index, length, proof_layers))
+            if hashes:
+                self._readerwriter.tx_bytes(hashes)
+
+    def tx_hash_request(self, pieces_root, base_layer, index, length,
+                        proof_layers):
+        self._tx_hash_message(_MSG_HASH_REQUEST, pieces_root, base_layer,
+                              index, length, proof_layers)
+
+    def tx_hashes(self, pieces_root, base_layer, index, length, proof_layers,
+                  hashes):
+        self._tx_hash_message(_MSG_HASHES, pieces_root, base_layer, index,
+                              length, proof_layers, hashes)
+
+    def tx_hash_reject(self, pieces_root, base_layer, index, length,
+                       proof_layers):
+        self._tx_hash_message(_MSG_HASH_REJECT, pieces_root, base_layer,
+                              index, length, proof_layers)
+
     def connection_lost(self):
         if self._receiver:
             self._receiver.connection_lost()
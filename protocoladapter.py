@@ -20,10 +20,20 @@ presented to it to the transport.
 
 Then name of the ProtocolAdapter reflects the effort to integrate the twisted
 framework into the existing BitTorrent structure.
+
+The bytes received and sent over every connection are counted for the
+client's metrics.
 """
 
+import metrics
 from twisted.internet import protocol
 
+_BYTES = metrics.Counter('bt_wire_bytes_total',
+                         "Bytes received and sent over peer connections",
+                         ('direction',))
+_BYTES_RECEIVED = _BYTES.labels('received')
+_BYTES_SENT = _BYTES.labels('sent')
+
 
 class ProtocolAdapter(protocol.Protocol):
     def __init__(self, receiver):
@@ -36,10 +46,13 @@ class ProtocolAdapter(protocol.Protocol):
         self._receiver = None
 
     def dataReceived(self, data):
+        _BYTES_RECEIVED.inc(len(data))
         if self._receiver:
             buf = buffer(data)
             offset = 0
-            while offset < len(buf):
+            # The receiver may be unset part way through if the data leads to
+            # the connection being dropped
+            while offset < len(buf) and self._receiver:
                 view, size = self._receiver.get_rx_buffer()
                 n = min(size, len(buf) - offset)
 
@@ -56,6 +69,7 @@ class ProtocolAdapter(protocol.Protocol):
             self._receiver.connection_lost()
 
     def tx_bytes(self, bytestr):
+        _BYTES_SENT.inc(len(bytestr))
         self.transport.write(bytestr)
 
     def stop(self):
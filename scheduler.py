@@ -0,0 +1,324 @@
+"""
+The Scheduler shares the client's resources among the torrents it serves.
+Rather than each TorrentMgr opening as many connections as it likes and
+running a timer of its own, the TorrentMgrs are started and driven by the
+Scheduler, which decides how many connections and how much of the download
+rate each one may use.
+
+A single periodic timer drives every started torrent.  Each torrent is put
+in one of a number of slices and one slice is ticked at a time, a fraction
+of a second apart, so that each torrent is still ticked once a second but
+thousands of torrents don't all do their periodic work in the same turn of
+the reactor.
+
+Every few seconds, and whenever a torrent is added, removed, finishes or
+has its priority changed, the connection slots and the download rate are
+divided among the torrents which are still downloading.  Each is divided by
+weighted max-min sharing: the torrents are weighted by their priority and
+no torrent is given more than it can use, the surplus going to the rest in
+proportion to their weights.  What a torrent can use of the connection slots
+depends on the health of its swarm, the number of peers it knows about or
+that its tracker reports, so a torrent with a small swarm doesn't hold slots
+it can't fill.  A torrent whose downloads have been held back by its share
+of the download rate, or which hasn't downloaded anything yet, can use as
+much of the rate as it is given.  Otherwise it is held back by its peers and
+can use only a little more than it has been getting, so it gives up the rest
+of its share to the other torrents.  A torrent which has finished
+downloading is given no connections.  Since uploading isn't implemented,
+there are no upload slots or upload rate to share out.
+
+At most a limited number of torrents download at once.  A torrent added
+beyond that limit is queued rather than started, and queued torrents are
+started as the active ones finish, those with the highest priority first,
+then those whose trackers report the most seeders, then in the order they
+were added.  A torrent which has already been downloaded is started
+straight away as it doesn't count against the limit.  A torrent may be
+added having only been loaded, as torrents remembered from an earlier run
+are, in which case it is initialized, opening its files and contacting its
+trackers, when it is started.  While it is being initialized it counts
+against the limit but isn't given any connections.
+
+Torrent priorities run from one to seven and are one unless changed.  A
+SchedulerError is raised for an invalid priority.
+"""
+
+import logging
+
+logger = logging.getLogger('bt.scheduler')
+
+_TIMER_INTERVAL = 1
+_SLICES = 10
+_ALLOCATE_INTERVAL = 5
+_ACTIVE_LIMIT = 8
+_MAX_CONNECTIONS = 200
+_TORRENT_CONNECTIONS = 30
+_MIN_CONNECTIONS = 4
+_MIN_RATE = 2**15
+_RATE_HEADROOM = 1.5
+_MIN_PRIORITY = 1
+_MAX_PRIORITY = 7
+
+
+class SchedulerError(Exception):
+    pass
+
+
+def share(total, weights, demands):
+    """
+    share() divides the total among the keys of the weights dictionary by
+    weighted max-min sharing.  Each key is given a share in proportion to its
+    weight but never more than its demand, and what isn't wanted by those
+    whose demands are met is shared among the others.  share() returns a
+    dictionary of the shares.
+    """
+    result = dict.fromkeys(weights, 0.0)
+    remaining = set(key for key in weights
+                    if weights[key] > 0 and demands[key] > 0)
+    left = float(total)
+    while remaining and left > 0:
+        weight = float(sum(weights[key] for key in remaining))
+        satisfied = [key for key in remaining
+                     if demands[key] <= left * weights[key] / weight]
+        if not satisfied:
+            for key in remaining:
+                result[key] = left * weights[key] / weight
+            break
+        for key in satisfied:
+            result[key] = demands[key]
+            left -= demands[key]
+            remaining.remove(key)
+    return result
+
+
+def share_slots(total, weights, demands):
+    """
+    share_slots() is share() for a whole number of slots.  The shares are
+    rounded down and the slots left over are handed out one at a time to
+    the keys whose demands aren't met, the heaviest first.
+    """
+    result = dict((key, int(slots)) for key, slots
+                  in share(total, weights, demands).items())
+    left = total - sum(result.values())
+    for key in sorted(weights, key=lambda key: -weights[key]):
+        if left <= 0:
+            break
+        if result[key] < demands[key]:
+            result[key] += 1
+            left -= 1
+    return result
+
+
+class Scheduler(object):
+    def __init__(self, reactor, active_limit=_ACTIVE_LIMIT,
+                 max_connections=_MAX_CONNECTIONS, download_rate=None):
+        self._reactor = reactor
+        self._active_limit = active_limit
+        self._max_connections = max_connections
+        self._download_rate = download_rate
+
+        # _priorities maps each torrent, started or queued, to its priority
+        # and _order maps it to the order in which it was added
+        self._priorities = {}
+        self._order = {}
+        self._added = 0
+
+        # _slices is a list of the sets of started torrents ticked together
+        # and _slice maps each started torrent to its slice
+        self._slices = [set() for _ in xrange(_SLICES)]
+        self._slice = {}
+        self._current = 0
+
+        # _queue is the list of torrents waiting to be started and
+        # _downloading is the set of started torrents which were still
+        # downloading when resources were last allocated
+        self._queue = []
+        self._downloading = set()
+
+        # _initializing is the set of loaded torrents being initialized
+        # before they are started, and _failed maps each torrent added with
+        # a function to call if it can't be initialized to the function
+        self._initializing = set()
+        self._failed = {}
+
+        self._next_allocate = 0
+        self._timer = None
+
+    def start(self):
+        self._timer = self._reactor.callLater(
+            float(_TIMER_INTERVAL) / _SLICES, self.timer_event)
+
+    def stop(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def add(self, torrent, priority=_MIN_PRIORITY, failed=None):
+        """
+        add() takes an initialized or loaded TorrentMgr and starts it, or
+        queues it if the limit on the number of torrents downloading at once
+        has been reached.  A loaded TorrentMgr is initialized when it is
+        started, and is forgotten if that fails, in which case failed is
+        called, if given, with the TorrentMgr and the failure.
+        """
+        self._check_priority(priority)
+        self._priorities[torrent] = priority
+        if failed:
+            self._failed[torrent] = failed
+        self._order[torrent] = self._added
+        self._added += 1
+
+        if (not torrent.is_complete() and
+                self._active() >= self._active_limit):
+            logger.info("Queueing {}".format(torrent.name()))
+            self._queue.append(torrent)
+        else:
+            self._start(torrent)
+        self._allocate()
+
+    def remove(self, torrent):
+        """
+        remove() forgets a torrent, which should be stopped by its owner,
+        and starts a queued torrent in its place if there is room.
+        """
+        self._priorities.pop(torrent, None)
+        self._order.pop(torrent, None)
+        self._failed.pop(torrent, None)
+        self._downloading.discard(torrent)
+        self._initializing.discard(torrent)
+        if torrent in self._queue:
+            self._queue.remove(torrent)
+        if torrent in self._slice:
+            self._slices[self._slice.pop(torrent)].discard(torrent)
+        self._allocate()
+
+    def is_queued(self, torrent):
+        return torrent in self._queue
+
+    def is_initializing(self, torrent):
+        return torrent in self._initializing
+
+    def priority(self, torrent):
+        return self._priorities[torrent]
+
+    def set_priority(self, torrent, priority):
+        """
+        set_priority() changes the priority of a torrent, which changes its
+        share of the connections and download rate and, if it is queued, its
+        place in the queue.
+        """
+        self._check_priority(priority)
+        self._priorities[torrent] = priority
+        self._allocate()
+
+    def _check_priority(self, priority):
+        if (not isinstance(priority, (int, long)) or
+                not _MIN_PRIORITY <= priority <= _MAX_PRIORITY):
+            raise SchedulerError("Invalid priority: {}".format(priority))
+
+    def _start(self, torrent):
+        # Start the torrent and put it in the slice with fewest torrents.  It
+        # connects to no peers until it is next allocated connections.  A
+        # torrent which has only been loaded is initialized first.
+        if torrent.is_stopped():
+            self._initialize(torrent)
+            return
+        index = min(xrange(_SLICES), key=lambda i: len(self._slices[i]))
+        self._slices[index].add(torrent)
+        self._slice[torrent] = index
+        torrent.start(scheduled=True)
+
+    def _initialize(self, torrent):
+        self._initializing.add(torrent)
+
+        def initialized(_):
+            if torrent not in self._initializing:
+                # The torrent was removed while it was being initialized
+                torrent.stop()
+                return
+            self._initializing.remove(torrent)
+            self._start(torrent)
+            self._allocate()
+
+        def failed(failure):
+            if torrent not in self._initializing:
+                return
+            callback = self._failed.get(torrent)
+            self.remove(torrent)
+            if callback:
+                callback(torrent, failure)
+            else:
+                logger.warning("Can't start {}: {}"
+                               .format(torrent.name(), failure.value))
+
+        torrent.initialize().addCallbacks(initialized, failed)
+
+    def _unfinished(self):
+        return [torrent for torrent in self._slice
+                if not torrent.is_complete()]
+
+    def _active(self):
+        # The number of torrents which count against the limit on those
+        # downloading at once
+        return len([torrent for torrent in self._initializing
+                    if not torrent.is_complete()] + self._unfinished())
+
+    def _start_queued(self):
+        # Start queued torrents while there is room, highest priority first,
+        # then the healthiest swarm, then the earliest added
+        while self._queue and self._active() < self._active_limit:
+            torrent = max(self._queue, key=lambda torrent: (
+                self._priorities[torrent], torrent.seeders(),
+                -self._order[torrent]))
+            self._queue.remove(torrent)
+            logger.info("Starting queued {}".format(torrent.name()))
+            self._start(torrent)
+
+    def _allocate(self):
+        # Share the connection slots and download rate among the torrents
+        # which are downloading, first starting any queued torrents for
+        # which there is room
+        self._next_allocate = self._reactor.seconds() + _ALLOCATE_INTERVAL
+        self._start_queued()
+
+        downloading = self._unfinished()
+        self._downloading = set(downloading)
+        weights = dict((torrent, self._priorities[torrent])
+                       for torrent in downloading)
+        demands = dict((torrent, min(_TORRENT_CONNECTIONS,
+                                     max(_MIN_CONNECTIONS,
+                                         torrent.swarm_size())))
+                       for torrent in downloading)
+        connections = share_slots(self._max_connections, weights, demands)
+
+        rates = dict.fromkeys(downloading)
+        if self._download_rate is not None:
+            demands = {}
+            for torrent in downloading:
+                rate = torrent.download_rate()
+                if torrent.rate_limited() or not rate:
+                    demands[torrent] = self._download_rate
+                else:
+                    demands[torrent] = max(_MIN_RATE, _RATE_HEADROOM * rate)
+            rates = share(self._download_rate, weights, demands)
+
+        for torrent in self._slice:
+            if torrent in connections:
+                torrent.allocate(connections[torrent], rates[torrent])
+            else:
+                torrent.allocate(0, None)
+
+    # Reactor callback
+
+    def timer_event(self):
+        self._timer = self._reactor.callLater(
+            float(_TIMER_INTERVAL) / _SLICES, self.timer_event)
+
+        finished = False
+        for torrent in list(self._slices[self._current]):
+            torrent.tick()
+            if torrent in self._downloading and torrent.is_complete():
+                finished = True
+        self._current = (self._current + 1) % _SLICES
+
+        if finished or self._reactor.seconds() >= self._next_allocate:
+            self._allocate()
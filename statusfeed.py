@@ -0,0 +1,124 @@
+"""
+The StatusFeed pushes the status of the client's torrents to browsers as
+server-sent events, so that they needn't poll the HTTP control channel for
+it.  A browser subscribes with an EventSource and is sent a snapshot event
+holding the status of every torrent, in the form /torrents responds with,
+and then a delta event whenever something has changed.
+
+The status of the torrents is gathered once per interval however many
+browsers have subscribed.  The snapshot is compared with the previous one
+and a single delta is encoded and written to every subscriber.  The delta
+holds the fields which have changed for each torrent, every field for a
+torrent which has been added, and the keys of the torrents which have gone.
+A subscriber which joins between intervals is sent the last snapshot, which
+the next delta is relative to.  The feed only runs its timer while there
+are subscribers.  When nothing has changed for a while, a comment is sent so
+that the connection isn't closed as idle.
+"""
+
+import json
+import logging
+
+logger = logging.getLogger('bt.statusfeed')
+
+_INTERVAL = 1
+_KEEP_ALIVE_INTERVAL = 15
+
+
+def _event(name, value):
+    # Returns the server-sent event with the given name and json data
+    return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(value))
+
+
+def delta(old, new):
+    """
+    delta() returns the delta between two snapshots of the torrents, a
+    dictionary holding the changed fields of each torrent under 'changed'
+    and the keys of the torrents which have gone under 'removed', or None if
+    nothing has changed.
+    """
+    changed = {}
+    for key, status in new.items():
+        previous = old.get(key, {})
+        fields = dict((field, value) for field, value in status.items()
+                      if previous.get(field) != value)
+        if fields:
+            changed[key] = fields
+    removed = [key for key in old if key not in new]
+    if not changed and not removed:
+        return None
+    return {'changed': changed, 'removed': removed}
+
+
+class StatusFeed(object):
+    def __init__(self, client, reactor, interval=_INTERVAL):
+        self._client = client
+        self._reactor = reactor
+        self._interval = interval
+
+        # _snapshot is the status of the torrents when they were last
+        # gathered and _encoded is its snapshot event, encoded when it is
+        # first needed
+        self._snapshot = {}
+        self._encoded = None
+
+        self._subscribers = []
+        self._last_sent = 0
+        self._timer = None
+
+    def subscribe(self, request):
+        """
+        subscribe() starts sending events to the request, which is held open
+        until the browser goes away.
+        """
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+
+        if not self._subscribers:
+            self._gather()
+            self._last_sent = self._reactor.seconds()
+            self._timer = self._reactor.callLater(self._interval,
+                                                  self.timer_event)
+        if self._encoded is None:
+            self._encoded = _event('snapshot', self._snapshot)
+        request.write(self._encoded)
+
+        self._subscribers.append(request)
+        request.notifyFinish().addBoth(lambda _: self._unsubscribe(request))
+        logger.debug("{} status subscribers".format(len(self._subscribers)))
+
+    def _unsubscribe(self, request):
+        if request in self._subscribers:
+            self._subscribers.remove(request)
+        if not self._subscribers and self._timer and self._timer.active():
+            self._timer.cancel()
+            self._timer = None
+
+    def _gather(self):
+        # Take a snapshot of the torrents and return the delta from the last
+        snapshot = self._client.get_torrents()
+        result = delta(self._snapshot, snapshot)
+        if result is not None:
+            self._snapshot = snapshot
+            self._encoded = None
+        return result
+
+    # Reactor callback
+
+    def timer_event(self):
+        self._timer = self._reactor.callLater(self._interval,
+                                              self.timer_event)
+
+        # Send every subscriber the same encoded delta, or a comment if the
+        # subscribers haven't been sent anything for a while
+        now = self._reactor.seconds()
+        result = self._gather()
+        if result is not None:
+            data = _event('delta', result)
+        elif now - self._last_sent >= _KEEP_ALIVE_INTERVAL:
+            data = ':\n\n'
+        else:
+            return
+        self._last_sent = now
+        for request in self._subscribers:
+            request.write(data)
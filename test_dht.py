@@ -0,0 +1,93 @@
+"""
+Tests for the DHTNode, run with trial:
+
+trial test_dht
+
+A small DHT is built from nodes listening on loopback in this process, each
+bootstrapping from the first, as the DHTNode allows.  Peers announced
+through one node are looked up through another.  A silent DatagramProtocol
+stands in for nodes which never answer, so that stopping a node in the
+middle of a lookup can be tested.
+"""
+
+import os
+
+import dht
+import peeraddr
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet.protocol import DatagramProtocol
+from twisted.trial import unittest
+
+_HOST = '127.0.0.1'
+_NODES = 12
+
+
+class _Silent(DatagramProtocol):
+    # Stands in for nodes which never respond
+    def datagramReceived(self, data, addr):
+        pass
+
+
+class DHTNodeTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        first = dht.DHTNode(reactor, bootstrap=[])
+        first.start(0, _HOST)
+        self.nodes = [first]
+        bootstrap = [(_HOST, first.port())]
+        for _ in range(_NODES - 1):
+            node = dht.DHTNode(reactor, bootstrap=bootstrap)
+            yield node.start(0, _HOST)
+            self.nodes.append(node)
+
+    def tearDown(self):
+        return gatherResults([node.stop() for node in self.nodes
+                              if node.port()])
+
+    def test_bootstrap(self):
+        # Every node has found others besides the one it bootstrapped from
+        for node in self.nodes[1:]:
+            self.assertTrue(len(node.routing_table()) > 1)
+
+    @inlineCallbacks
+    def test_announce_and_get_peers(self):
+        info_hash = os.urandom(20)
+        yield self.nodes[3].announce(info_hash, 5555)
+
+        peers = yield self.nodes[-1].get_peers(info_hash)
+        self.assertIn((_HOST, 5555),
+                      [peeraddr.to_addr(peer) for peer in peers])
+
+    @inlineCallbacks
+    def test_get_peers_unknown(self):
+        peers = yield self.nodes[5].get_peers(os.urandom(20))
+        self.assertEqual(peers, [])
+
+
+class StopTest(unittest.TestCase):
+    @inlineCallbacks
+    def test_stop_during_lookup(self):
+        # A node stopped while its queries to unresponsive nodes are
+        # outstanding fails the lookup without querying the nodes it hadn't
+        # got to, and leaves no timers behind
+        silent = reactor.listenUDP(0, _Silent(), interface=_HOST)
+        self.addCleanup(silent.stopListening)
+        addr = (_HOST, silent.getHost().port)
+
+        node = dht.DHTNode(reactor, bootstrap=[])
+        node.start(0, _HOST)
+        now = reactor.seconds()
+        for _ in range(dht.K):
+            node.routing_table().update(os.urandom(20), addr, now)
+
+        lookup = node.get_peers(os.urandom(20))
+        self.assertTrue(node._transactions)
+
+        yield node.stop()
+        self.assertEqual(node._transactions, {})
+        self.assertEqual([call for call in reactor.getDelayedCalls()
+                          if call.func.__module__ == 'dht'], [])
+        peers = yield lookup
+        self.assertEqual(peers, [])
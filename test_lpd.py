@@ -0,0 +1,151 @@
+"""
+Tests for LocalPeerDiscovery, run with trial:
+
+trial test_lpd
+
+Two instances talk to each other over loopback multicast, as
+LocalPeerDiscovery allows by taking the group port and interface on
+creation.  Their timers run on a Clock, which passes listenMulticast on to
+the reactor, so that the rate limits can be tested without waiting for
+them while messages still travel over the network.
+"""
+
+import peeraddr
+from lpd import LocalPeerDiscovery
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+_HOST = '127.0.0.1'
+_GROUP_PORT = 16771
+_SHARED = '\x11' * 20
+_OTHER = '\x22' * 20
+
+
+class _Clock(Clock):
+    # A Clock which listens on the network through the reactor
+    def listenMulticast(self, *args, **kwargs):
+        return reactor.listenMulticast(*args, **kwargs)
+
+
+def _message(port, info_hashes, cookie):
+    # A BT-SEARCH message as another client would send it
+    lines = ["BT-SEARCH * HTTP/1.1",
+             "Host: 239.192.152.143:6771",
+             "Port: {}".format(port)]
+    lines.extend("Infohash: {}".format(info_hash.encode('hex'))
+                 for info_hash in info_hashes)
+    lines.append("cookie: {}".format(cookie))
+    return "\r\n".join(lines) + "\r\n\r\n\r\n"
+
+
+class LocalPeerDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.heard = {7001: [], 7002: []}
+        self.sent = {7001: [], 7002: []}
+        self.instances = {}
+        for port in (7001, 7002):
+            instance = LocalPeerDiscovery(
+                self.clock, port,
+                lambda info_hash, record, port=port:
+                    self.heard[port].append((info_hash,
+                                             peeraddr.to_addr(record))),
+                group_port=_GROUP_PORT, interface=_HOST)
+            self.count_sends(instance, self.sent[port])
+            instance.start()
+            self.instances[port] = instance
+        self.a, self.b = self.instances[7001], self.instances[7002]
+
+    def tearDown(self):
+        return gatherResults([maybeDeferred(instance.stop)
+                              for instance in self.instances.values()])
+
+    def count_sends(self, instance, sent):
+        # Records the info hashes in each message the instance sends
+        send = instance._send
+
+        def counting(info_hashes):
+            sent.append(list(info_hashes))
+            send(info_hashes)
+        instance._send = counting
+
+    def wait_for(self, condition, timeout=5):
+        # Returns a deferred which fires once the condition holds, letting
+        # the reactor deliver datagrams in the meantime
+        d = Deferred()
+        deadline = reactor.seconds() + timeout
+
+        def check():
+            if condition():
+                d.callback(None)
+            elif reactor.seconds() > deadline:
+                d.errback(AssertionError("Timed out waiting"))
+            else:
+                reactor.callLater(0.01, check)
+        check()
+        return d
+
+    def test_search_received(self):
+        self.a.add_torrent(_SHARED)
+        self.a.add_torrent(_OTHER)
+        self.b.add_torrent(_SHARED)
+        self.clock.advance(1)
+
+        def heard(_):
+            self.assertIn((_SHARED, (_HOST, 7001)), self.heard[7002])
+            self.assertIn((_SHARED, (_HOST, 7002)), self.heard[7001])
+            self.assertNotIn(_OTHER, [info_hash for info_hash, addr
+                                      in self.heard[7002]])
+
+        return self.wait_for(lambda: self.heard[7001] and
+                             self.heard[7002]).addCallback(heard)
+
+    def test_own_cookie_ignored(self):
+        received = []
+        datagram_received = self.a.datagramReceived
+
+        def receiving(data, addr):
+            received.append(data)
+            datagram_received(data, addr)
+        self.a.datagramReceived = receiving
+
+        self.a.add_torrent(_SHARED)
+        self.clock.advance(1)
+
+        def looped_back(_):
+            self.assertEqual(self.heard[7001], [])
+
+        return self.wait_for(lambda: received).addCallback(looped_back)
+
+    def test_send_rate_limit(self):
+        # One message is sent a second with at most 20 info hashes, and a
+        # torrent isn't announced again within two seconds
+        info_hashes = [chr(i) * 20 for i in range(30)]
+        for info_hash in info_hashes:
+            self.a.add_torrent(info_hash)
+        self.clock.advance(1)
+        self.assertEqual([len(sent) for sent in self.sent[7001]], [20])
+        self.clock.advance(1)
+        self.assertEqual([len(sent) for sent in self.sent[7001]], [20, 10])
+
+        self.a._queue(info_hashes[25])
+        self.clock.advance(1)
+        self.assertEqual(len(self.sent[7001]), 2)
+        self.clock.advance(1)
+        self.assertEqual(self.sent[7001][2], [info_hashes[25]])
+
+    def test_receive_rate_limit(self):
+        # A second message from the same sender within a second is ignored
+        self.a.add_torrent(_SHARED)
+        self.a.add_torrent(_OTHER)
+        self.a.datagramReceived(_message(7003, [_SHARED], 'c'), (_HOST, 1))
+        self.a.datagramReceived(_message(7003, [_OTHER], 'c'), (_HOST, 1))
+        self.assertEqual(self.heard[7001], [(_SHARED, (_HOST, 7003))])
+
+        self.clock.advance(1)
+        self.a.datagramReceived(_message(7003, [_OTHER], 'c'), (_HOST, 1))
+        self.assertEqual(self.heard[7001], [(_SHARED, (_HOST, 7003)),
+                                            (_OTHER, (_HOST, 7003))])
@@ -0,0 +1,351 @@
+"""
+Tests for the UDPTrackerClient, run with trial:
+
+trial test_udptracker
+
+The client talks over loopback to a tracker stand-in, a DatagramProtocol
+which answers connect, announce and scrape requests as a BEP 15 tracker
+does, or drops them or answers with an error when told to.  The client's
+timers run on a Clock, so that connection id lifetimes and retransmission
+timeouts can be tested without waiting for them.  The retransmission
+backoff is tested with a transport which only records what is sent.
+"""
+
+import struct
+
+import peeraddr
+from udptracker import UDPTrackerClient, UDPTrackerError
+
+from twisted.internet import reactor
+from twisted.internet.defer import (CancelledError, gatherResults,
+                                    maybeDeferred, succeed)
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+_HOST = '127.0.0.1'
+_PROTOCOL_ID = 0x41727101980
+_CONNECT, _ANNOUNCE, _SCRAPE, _ERROR = range(4)
+_INFO_HASH = '\x11' * 20
+_OTHER_HASH = '\x22' * 20
+_PEER_ID = '-HS0001-000000000001'
+_PEERS = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+
+
+class _Clock(Clock):
+    # A Clock which resolves host names as the reactor does, without a
+    # lookup, since the tracker is addressed by IP address
+    def resolve(self, name):
+        return succeed(name)
+
+
+class _Tracker(DatagramProtocol):
+    """
+    The _Tracker stands in for a UDP tracker.  It records the action of
+    every request it receives, along with the connection id and body, and
+    ignores the first drop requests.
+    """
+    connection_id = 0x123456789abcdef
+
+    def __init__(self):
+        self.requests = []
+        self.drop = 0
+        self.error = None
+        self.connects = 0
+
+    def actions(self):
+        return [action for action, _, _ in self.requests]
+
+    def datagramReceived(self, data, addr):
+        connection_id, action, transaction_id = struct.unpack('>QII',
+                                                              data[:16])
+        body = data[16:]
+        self.requests.append((action, connection_id, body))
+        if self.drop:
+            self.drop -= 1
+            return
+
+        if self.error is not None:
+            reply = struct.pack('>II', _ERROR, transaction_id) + self.error
+        elif action == _CONNECT:
+            assert connection_id == _PROTOCOL_ID
+            self.connects += 1
+            reply = struct.pack('>IIQ', _CONNECT, transaction_id,
+                                self.connection_id + self.connects)
+        elif action == _ANNOUNCE:
+            peers, _ = peeraddr.encode_peers([peeraddr.from_addr(peer)
+                                              for peer in _PEERS])
+            reply = struct.pack('>IIIII', _ANNOUNCE, transaction_id, 1800, 5,
+                                7) + peers
+        elif action == _SCRAPE:
+            reply = struct.pack('>II', _SCRAPE, transaction_id)
+            for i in range(len(body) // 20):
+                reply += struct.pack('>III', 10 + i, 20 + i, 30 + i)
+        else:
+            return
+        self.transport.write(reply, addr)
+
+
+class _Transport(object):
+    # A transport which records when each packet is sent
+    def __init__(self, clock):
+        self._clock = clock
+        self.sent = []
+
+    def write(self, packet, addr):
+        self.sent.append((self._clock.seconds(), packet))
+
+
+class UDPTrackerClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = _Tracker()
+        self.tracker_port = reactor.listenUDP(0, self.tracker,
+                                              interface=_HOST)
+        self.url = 'udp://{}:{}/announce'.format(
+            _HOST, self.tracker_port.getHost().port)
+
+        self.clock = _Clock()
+        self.client = UDPTrackerClient(self.clock)
+        self.client_port = reactor.listenUDP(0, self.client, interface=_HOST)
+
+    def tearDown(self):
+        return gatherResults([maybeDeferred(self.tracker_port.stopListening),
+                              maybeDeferred(self.client_port.stopListening)])
+
+    def announce(self, event='started'):
+        return self.client.announce(self.url, _INFO_HASH, _PEER_ID, 0, 1000,
+                                    0, event, 42, 50, 6881)
+
+    def test_connect(self):
+        def announced(response):
+            self.assertEqual(self.tracker.actions(), [_CONNECT, _ANNOUNCE])
+            self.assertEqual(self.tracker.requests[1][1],
+                             _Tracker.connection_id + 1)
+
+        return self.announce().addCallback(announced)
+
+    def test_announce(self):
+        def announced(response):
+            self.assertEqual(response['interval'], 1800)
+            self.assertEqual(response['incomplete'], 5)
+            self.assertEqual(response['complete'], 7)
+
+            _, _, body = self.tracker.requests[1]
+            (info_hash, peer_id, downloaded, left, uploaded, event, _, key,
+             numwant, port) = struct.unpack('>20s20sQQQIIIiH', body)
+            self.assertEqual((info_hash, peer_id), (_INFO_HASH, _PEER_ID))
+            self.assertEqual((downloaded, left, uploaded), (0, 1000, 0))
+            self.assertEqual((event, key, numwant, port), (2, 42, 50, 6881))
+
+        return self.announce().addCallback(announced)
+
+    def test_compact_peers(self):
+        def announced(response):
+            peers = peeraddr.decode_peers(response['peers'])
+            self.assertEqual([peeraddr.to_addr(peer) for peer in peers],
+                             _PEERS)
+
+        return self.announce().addCallback(announced)
+
+    def test_scrape(self):
+        def scraped(stats):
+            self.assertEqual(self.tracker.actions(), [_CONNECT, _SCRAPE])
+            self.assertEqual(stats[_INFO_HASH], {'complete': 10,
+                                                 'downloaded': 20,
+                                                 'incomplete': 30})
+            self.assertEqual(stats[_OTHER_HASH], {'complete': 11,
+                                                  'downloaded': 21,
+                                                  'incomplete': 31})
+
+        return (self.client.scrape(self.url, [_INFO_HASH, _OTHER_HASH])
+                .addCallback(scraped))
+
+    def test_scrape_limit(self):
+        self.assertRaises(UDPTrackerError, self.client.scrape, self.url,
+                          [_INFO_HASH] * 75)
+
+    def test_connection_id_reused(self):
+        # A second announce within a minute uses the same connection id,
+        # and one after a minute obtains a new one
+        def first(_):
+            self.clock.advance(59)
+            return self.announce(None).addCallback(second)
+
+        def second(_):
+            self.assertEqual(self.tracker.actions(),
+                             [_CONNECT, _ANNOUNCE, _ANNOUNCE])
+            self.assertEqual(self.tracker.requests[2][1],
+                             _Tracker.connection_id + 1)
+            self.clock.advance(2)
+            return self.announce(None).addCallback(third)
+
+        def third(_):
+            self.assertEqual(self.tracker.actions(),
+                             [_CONNECT, _ANNOUNCE, _ANNOUNCE, _CONNECT,
+                              _ANNOUNCE])
+            self.assertEqual(self.tracker.requests[4][1],
+                             _Tracker.connection_id + 2)
+
+        return self.announce().addCallback(first)
+
+    def test_concurrent_requests_share_connect(self):
+        def done(_):
+            self.assertEqual(self.tracker.actions().count(_CONNECT), 1)
+            self.assertEqual(self.tracker.actions().count(_ANNOUNCE), 1)
+            self.assertEqual(self.tracker.actions().count(_SCRAPE), 1)
+
+        return gatherResults([
+            self.announce(),
+            self.client.scrape(self.url, [_INFO_HASH])]).addCallback(done)
+
+    def test_dropped_request_retransmitted(self):
+        # The tracker ignores the first connect, which is sent again once
+        # the clock passes the first retransmission timeout
+        self.tracker.drop = 1
+        d = self.announce()
+
+        def wait():
+            if len(self.tracker.requests) < 1:
+                return reactor.callLater(0.01, wait)
+            self.clock.advance(15)
+
+        def announced(response):
+            self.assertEqual(self.tracker.actions(),
+                             [_CONNECT, _CONNECT, _ANNOUNCE])
+            self.assertEqual(response['complete'], 7)
+
+        wait()
+        return d.addCallback(announced)
+
+    def test_error_action(self):
+        self.tracker.error = 'Torrent not registered'
+
+        def failed(failure):
+            failure.trap(UDPTrackerError)
+            self.assertIn('Torrent not registered', failure.value.message)
+
+        return self.announce().addCallbacks(
+            lambda _: self.fail("Announce succeeded"), failed)
+
+    def test_error_action_after_connect(self):
+        def connected(_):
+            self.tracker.error = 'Rate limited'
+            self.clock.advance(1)
+            return self.client.scrape(self.url, [_INFO_HASH])
+
+        def failed(failure):
+            failure.trap(UDPTrackerError)
+            self.assertIn('Rate limited', failure.value.message)
+            self.assertEqual(self.tracker.actions(),
+                             [_CONNECT, _ANNOUNCE, _SCRAPE])
+
+        return (self.announce().addCallback(connected)
+                .addCallbacks(lambda _: self.fail("Scrape succeeded"),
+                              failed))
+
+
+class RetransmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.client = UDPTrackerClient(self.clock)
+        self.transport = _Transport(self.clock)
+        self.client.makeConnection(self.transport)
+        self.addr = (_HOST, 6969)
+        self.url = 'udp://{}:{}'.format(*self.addr)
+
+    def announce(self):
+        return self.client.announce(self.url, _INFO_HASH, _PEER_ID, 0, 1000,
+                                    0, None, 42, 50, 6881)
+
+    def reply(self, packet, payload):
+        # Answers the request in the packet as the tracker would
+        action, transaction_id = struct.unpack('>II', packet[8:16])
+        self.client.datagramReceived(
+            struct.pack('>II', action, transaction_id) + payload, self.addr)
+
+    def run_out(self, start):
+        # Advances the clock through every retransmission, returning the
+        # times at which the packets were sent
+        for n in range(9):
+            self.clock.advance(15 * 2**n)
+        return [time - start for time, _ in self.transport.sent]
+
+    def test_connect_backoff(self):
+        failures = []
+        self.announce().addErrback(failures.append)
+
+        times = self.run_out(0)
+        self.assertEqual(times, [15 * (2**n - 1) for n in range(9)])
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(UDPTrackerError)
+        self.assertIn('did not respond', failures[0].value.message)
+        self.assertEqual(self.client._transactions, {})
+
+    def test_request_backoff(self):
+        failures = []
+        self.announce().addErrback(failures.append)
+        self.reply(self.transport.sent[0][1], struct.pack('>Q', 99))
+        del self.transport.sent[:]
+
+        # The connection id expires after a minute, so later
+        # retransmissions of the announce obtain a new one first
+        self.clock.advance(15)
+        self.assertEqual(len(self.transport.sent), 1)
+        (connection_id,) = struct.unpack('>Q', self.transport.sent[0][1][:8])
+        self.assertEqual(connection_id, 99)
+        self.clock.advance(30)
+        self.assertEqual(len(self.transport.sent), 2)
+        self.clock.advance(60)
+        (connection_id,) = struct.unpack('>Q', self.transport.sent[2][1][:8])
+        self.assertEqual(connection_id, _PROTOCOL_ID)
+        self.assertEqual(failures, [])
+
+    def test_response_cancels_retransmission(self):
+        results = []
+        self.announce().addCallback(results.append)
+        self.clock.advance(15)
+        self.assertEqual(len(self.transport.sent), 2)
+
+        self.reply(self.transport.sent[1][1], struct.pack('>Q', 99))
+        self.reply(self.transport.sent[2][1],
+                   struct.pack('>III', 1800, 0, 1))
+        self.clock.advance(10000)
+        self.assertEqual(len(self.transport.sent), 3)
+        self.assertEqual(results[0]['complete'], 1)
+
+    def test_cancel_stops_retransmission(self):
+        failures = []
+        d = self.announce()
+        d.addErrback(failures.append)
+        self.reply(self.transport.sent[0][1], struct.pack('>Q', 99))
+        self.assertEqual(len(self.transport.sent), 2)
+
+        d.cancel()
+        self.clock.advance(10000)
+        self.assertEqual(len(self.transport.sent), 2)
+        failures[0].trap(CancelledError)
+        self.assertEqual(self.client._transactions, {})
+
+    def test_cancel_while_connecting(self):
+        failures = []
+        self.announce().addErrback(failures.append).cancel()
+        self.clock.advance(10000)
+        self.assertEqual(len(self.transport.sent), 1)
+        failures[0].trap(CancelledError)
+        self.assertEqual(self.client._transactions, {})
+        self.assertEqual(self.client._connecting, {})
+
+    def test_cancel_keeps_shared_connect(self):
+        # Cancelling one of two requests waiting on the same connect leaves
+        # the connect to carry on for the other
+        results = []
+        first = self.announce()
+        first.addErrback(lambda failure: failure.trap(CancelledError))
+        self.announce().addCallback(results.append)
+        first.cancel()
+
+        self.reply(self.transport.sent[0][1], struct.pack('>Q', 99))
+        self.assertEqual(len(self.transport.sent), 2)
+        self.reply(self.transport.sent[1][1],
+                   struct.pack('>III', 1800, 0, 1))
+        self.assertEqual(results[0]['complete'], 1)
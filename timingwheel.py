@@ -0,0 +1,44 @@
+"""
+The TimingWheel schedules a large number of items for attention at a later
+time without a reactor timer for each one.  It is a ring of slots, each of
+which holds the set of items due when the wheel reaches it.  The owner
+advances the wheel by one slot on each tick of a single periodic timer and
+handles whatever items were due in that slot.
+
+Scheduling an item and advancing the wheel both take constant time no matter
+how many items are scheduled, so checking thousands of connections costs only
+what is due on a given tick.  Items are not removed from the wheel when they
+become irrelevant.  Instead, the owner is expected to ignore an item that is
+no longer of interest when it comes due.  Delays longer than the wheel can
+represent are shortened to the longest delay it can represent, so the owner
+should be prepared to see an item before it is actually due and simply
+schedule it again.
+"""
+
+
+class TimingWheel(object):
+    def __init__(self, slots):
+        if slots < 2:
+            raise ValueError("A timing wheel needs at least two slots")
+
+        self._slots = [set() for _ in xrange(slots)]
+        self._current = 0
+
+    def schedule(self, item, ticks):
+        """
+        schedule() arranges for the item to be returned by advance() after
+        the given number of ticks.  The number of ticks is adjusted to fall
+        between one and one less than the number of slots.
+        """
+        ticks = max(1, min(int(ticks), len(self._slots)-1))
+        self._slots[(self._current + ticks) % len(self._slots)].add(item)
+
+    def advance(self):
+        """
+        advance() moves the wheel forward one tick and returns the set of
+        items which are due.
+        """
+        self._current = (self._current + 1) % len(self._slots)
+        due = self._slots[self._current]
+        self._slots[self._current] = set()
+        return due
@@ -31,25 +31,81 @@ requesting to try to rectify potential hung situations such as when a peer is
 interested but unchoked for a long period of time or when it has an outstanding
 request over a long period of time.
 
-This TorrentMgr does not currently implement pipelined requests, an endgame
-strategy or uploading.
+Besides this, requests time out adaptively and snubbed peers are given
+common pieces, connections are kept alive or reaped as they come due on a
+timing wheel, peers come from the trackers, the DHT, the local network and
+peer exchange, and the Fast Extension, metadata exchange and BitTorrent v2
+block hashes are supported.  Pieces can be given deadlines so that the
+torrent can be read while it downloads, files can be given priorities or
+skipped, and a Scheduler can share connections and download rate among many
+TorrentMgrs.  A TorrentMgr can also be loaded without being served, and
+stopped to be resumed later.  Each of these is described where it is done.
 """
 
+import extensions
 import hashlib
 import logging
+import merkle
+import metrics
+import peeraddr
 from bitstring import BitArray
+from catalog import CatalogError
+from estimators import RateEstimator
 from filemgr import FileMgr
 from metainfo import Metainfo
+from peerpool import PeerPool
 from peerproxy import PeerProxy
+from timingwheel import TimingWheel
 from trackerproxy import TrackerProxy
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, fail, succeed
 
 logger = logging.getLogger('bt.torrentmgr')
 
 _BLOCK_SIZE = 2**14
-_TIMER_INTERVAL = 10
-_MAX_RETRIES = 2
+_TIMER_INTERVAL = 1
+_INTEREST_TIMEOUT = 40
+_PEER_TARGET = 20
+_CONNECTION_BUDGET = 30
+_KEEP_ALIVE_INTERVAL = 90
+_DEAD_TIMEOUT = 180
+_IDLE_TIMEOUT = 120
+_WHEEL_SLOTS = 128
+_PEX_INTERVAL = 60
+_PEX_MAX_PEERS = 50
+_DHT_INTERVAL = 15 * 60
+_DHT_MIN_INTERVAL = 60
+_TRACKER_RETRY_INTERVAL = 300
+_SAVE_INTERVAL = 60
+_SAVED_PEERS = 50
+_MAX_HASHES = 512
+_READAHEAD = 2**23
+_MIN_READAHEAD_PIECES = 4
+_DEADLINE_STEP = 1
+_ENDGAME_MARGIN = 2
+_MAX_DUPLICATES = 3
+_DEADLINE_EXPIRY = 60
+_MAX_PRIORITY = 7
+_SUMMARY_INTERVAL = 1
+
+_PAYLOAD = metrics.Counter('bt_payload_bytes_total',
+                           "Piece and metadata bytes received and sent for "
+                           "each torrent", ('torrent', 'direction'))
+_HASH_FAILURES = metrics.Counter('bt_hash_failures_total',
+                                 "Pieces and blocks which failed their hash "
+                                 "check", ('kind',))
+_PIECE_FAILURES = _HASH_FAILURES.labels('piece')
+_BLOCK_FAILURES = _HASH_FAILURES.labels('block')
+_TIMEOUTS = metrics.Counter('bt_timeouts_total',
+                            "Requests and interest timed out by the periodic "
+                            "tick", ('kind',))
+_REQUEST_TIMEOUTS = _TIMEOUTS.labels('request')
+_INTEREST_TIMEOUTS = _TIMEOUTS.labels('interest')
+_RETRIES = metrics.Counter('bt_retries_total',
+                           "Trackers tried again and rejected pieces asked "
+                           "for again by the periodic tick", ('kind',))
+_TRACKER_RETRIES = _RETRIES.labels('tracker')
+_REJECTED_RETRIES = _RETRIES.labels('rejected')
 
 
 class TorrentMgrError(Exception):
@@ -58,39 +114,51 @@ class TorrentMgrError(Exception):
 
 class TorrentMgr(object):
     class _States(object):
-        (Uninitialized, Initialized, Started) = range(3)
+        (Uninitialized, Initialized, Started, Stopped) = range(4)
 
-    def __init__(self, filename, port, peer_id, reactor):
+    def __init__(self, filename, port, peer_id, reactor, dht=None,
+                 catalog=None, info_hash=None, metainfo=None, peers=None):
         self._filename = filename
         self._port = port
         self._peer_id = peer_id
         self._reactor = reactor
+        self._dht = dht
+        self._catalog = catalog
+        self._catalog_hash = info_hash
+        self._metainfo = metainfo
+
+        # _known_peers is a list of records of peers already known to serve
+        # the torrent, as when its metadata was fetched from them, which are
+        # tried first along with those saved in the catalog
+        self._known_peers = peers or []
         self._state = self._States.Uninitialized
+        self._timer = None
+        self._tracker_proxy = None
+        self._scraped = (None, None)
+        self._summary = None
+        self._summary_expires = 0
 
     def initialize(self):
         """
         initialize() returns a deferred which fires when initialization
-        of the TorrentMgr is complete or an error has occurred.
+        of the TorrentMgr is complete or an error has occurred.  Unless the
+        trackers are the only source of peers, it doesn't wait for them to
+        respond.  A stopped TorrentMgr is initialized again to resume
+        serving the torrent.
         """
-        if not self._state == self._States.Uninitialized:
+        if self._state not in (self._States.Uninitialized,
+                               self._States.Stopped):
             error = "TorrentMgr can't be reinitialized"
             logger.debug(error)
             d = Deferred()
             d.errback(TorrentMgrError(error))
             return d
 
-        try:
-            self._metainfo = Metainfo(self._filename)
-        except ValueError as err:
-            logger.error(err)
-            d = Deferred()
-            d.errback(TorrentMgrError(err.message))
-            return d
-        except IOError as err:
-            logger.error(err)
-            d = Deferred()
-            d.errback(TorrentMgrError(err.strerror))
-            return d
+        if self._state == self._States.Uninitialized:
+            try:
+                self.load()
+            except TorrentMgrError as err:
+                return fail(err)
 
         # _peers is a list of peers that the TorrentMgr is trying
         # to communicate with
@@ -102,74 +170,379 @@ class TorrentMgr(object):
 
         # _have is the bitfield for this torrent. It is initialized to reflect
         # which pieces are already available on disk.
-        self._filemgr = FileMgr(self._metainfo)
+        self._filemgr = FileMgr(self._metainfo, self._have, self._priorities)
         self._have = self._filemgr.have()
 
+        # _unsaved is set when pieces have been downloaded since the state
+        # of the torrent was last saved in the catalog
+        self._unsaved = False
+        self._next_save = 0
+
         # _needed is a dictionary of pieces which are still needed.
         # The value for each piece is a tuple of the number of peers which
         # have the piece and a list of those peers.
         self._needed = {piece: (0, []) for piece
-                        in list(self._have.findall('0b0'))}
+                        in list((~self._have & self._wanted).findall('0b1'))}
 
         # _interested is a dictionary of peers to whom interest has been
         # expressed.  The value for each peer is a tuple of the piece that
         # has been reserved for the peer, the number of bytes of the piece that
-        # have already been received, the sha1 hash of the bytes received so
-        # far and the value of the tick at the time interest was expressed.
+        # have already been received, the hash of the bytes received so far
+        # and the time at which interest was expressed.
         self._interested = {}
 
         # _requesting is a dictionary of peers to whom a block request has been
         # made.  The value for each peer is a tuple of the piece that is being
         # requested, the number of bytes that have already been received, the
-        # shal2 hash of the bytes received so far, the value of the tick at
-        # the time the request was made and the number of retries that have
-        # been attempted
+        # hash of the bytes received so far and the time at which the
+        # outstanding block request was made
         self._requesting = {}
 
         # _partial is a list which tracks pieces that were interrupted while
         # being downloaded.  Each entry is a tuple containing the index of the
-        # piece, the number of bytes received so far and the sha1 hash of those
+        # piece, the number of bytes received so far and the hash of those
         # bytes.
         self._partial = []
 
-        self._tracker_proxy = TrackerProxy(self._metainfo, self._port,
-                                           self._peer_id)
-
+        # For a v2 torrent, _block_hashes maps pieces to the list of the leaf
+        # hashes of their blocks, once they are known, and _hash_requests
+        # maps the (pieces root, index) of each outstanding request for them
+        # to the piece and the peer asked
+        self._v2 = self._metainfo.meta_version == 2
+        self._block_hashes = {}
+        self._hash_requests = {}
+
+        # _deadlines maps needed pieces near the cursor of a stream to the
+        # time by which they are wanted, and _readers is a list of the
+        # reads waiting on pieces.  Each reader is a list of the set of
+        # pieces still missing, the range of the torrent to read and the
+        # deferred to fire with the data.
+        self._deadlines = {}
+        self._readers = []
+
+        # _rejected is a dictionary mapping peers to the set of pieces for
+        # which they have rejected a request since they last unchoked
+        self._rejected = {}
+
+        self._download_rate = RateEstimator()
+
+        # _peer_target is the number of peers to keep connected and
+        # _connection_budget the most connections to open, unless a
+        # Scheduler allocates otherwise.  _rate_limit is the download rate
+        # allocated, or None if it isn't limited, _allowance is the number of
+        # bytes which can be requested before the limit is reached and
+        # _throttled is the list of peers whose requests are waiting for
+        # more allowance.  _rate_limited is set when a request has had to
+        # wait since the download rate was last allocated.
+        self._peer_target = _PEER_TARGET
+        self._connection_budget = _CONNECTION_BUDGET
+        self._rate_limit = None
+        self._allowance = 0
+        self._throttled = []
+        self._rate_limited = False
+        self._last_tick = None
+
+        # _wheel holds each peer until its connection next needs checking
+        self._wheel = TimingWheel(_WHEEL_SLOTS)
+
+        # _pool holds the records of peers which can be connected to and
+        # _records maps each peer to its record
+        self._pool = PeerPool()
+        self._pool.add(self._saved_peers)
+        self._records = {}
+
+        # _pex_sent is a dictionary mapping peers which support peer exchange
+        # to the set of records of peers they were last told are connected
+        self._pex_sent = {}
+        self._next_pex = 0
+
+        # _awaiting_peers is set while waiting on the tracker for peers
+        self._awaiting_peers = False
+
+        # _dht_searching is set while a DHT lookup is in progress
+        self._dht_searching = False
+        self._last_dht = None
+        self._next_dht = 0
+
+        # _next_tracker_retry is when to try the trackers again after none
+        # could be reached, or None while they are being tried or have been
+        # reached
+        self._next_tracker_retry = None
+
+        # Uploading isn't implemented, so nothing is ever uploaded
+        self._uploaded = 0
+
+        self._tracker_proxy = TrackerProxy(self, self._metainfo, self._port,
+                                           self._peer_id, self._reactor)
+
+        if self._dht or len(self._pool):
+            # Peers can be found through the DHT or among the peers saved in
+            # the catalog while the trackers are announced to, so the
+            # torrent is served without waiting for a tracker to respond
+            self._start_trackers()
+            self._initialized()
+            return succeed(None)
+
+        # Otherwise peers can only come from the trackers, and the TorrentMgr
+        # can't be initialized if none of them can be reached
         def success(result):
-            self._state = self._States.Initialized
+            self._initialized()
 
         def failure(failure):
-            logger.critical("Could not connect to tracker at {}"
-                            .format(self._metainfo.announce))
             message = failure.value.message
+            logger.critical("Could not connect to any tracker for {}"
+                            .format(self._metainfo.name))
             logger.debug("    Tracker Error: {}".format(message))
+            self._filemgr.close()
+            self._filemgr = None
             raise TorrentMgrError(message)
 
         return self._tracker_proxy.start().addCallbacks(success, failure)
 
-    def start(self):
+    def _start_trackers(self):
+        # Announce to the trackers, connecting to the peers they send once
+        # one of them responds and trying them again later if none can be
+        # reached.  The outcome is ignored if the TrackerProxy has since been
+        # replaced, as when the TorrentMgr is stopped and initialized again.
+        self._next_tracker_retry = None
+        tracker_proxy = self._tracker_proxy
+
+        def started(_):
+            if self._tracker_proxy is tracker_proxy:
+                self._connect_to_peers(self._peer_target - len(self._peers))
+
+        def failed(failure):
+            if self._tracker_proxy is not tracker_proxy:
+                return
+            logger.warning("Could not connect to any tracker for {}, "
+                           "relying on other peers: {}"
+                           .format(self._metainfo.name, failure.value))
+            self._next_tracker_retry = (self._reactor.seconds() +
+                                        _TRACKER_RETRY_INTERVAL)
+
+        tracker_proxy.start().addCallbacks(started, failed)
+
+    def _initialized(self):
+        self._state = self._States.Initialized
+        self.remember()
+
+    def remember(self):
+        """
+        remember() adds the torrent to the catalog, if the TorrentMgr has
+        one, so that it is served again when the client is restarted even if
+        it is still queued.  A torrent already in the catalog is left as it
+        is.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't remember an unloaded TorrentMgr")
+        if self._catalog:
+            try:
+                self._catalog.add(self._metainfo.info_hash, self._filename,
+                                  self._metainfo.contents)
+            except CatalogError as err:
+                logger.warning("Can't add {} to the catalog: {}"
+                               .format(self._filename, err))
+
+    def load(self):
+        """
+        load() reads the torrent's metainfo and whatever the catalog holds
+        about the torrent without opening its files or contacting its
+        trackers, leaving the TorrentMgr stopped, as it is when paused.  It
+        raises a TorrentMgrError if the metainfo can't be read.
+        """
+        if self._state != self._States.Uninitialized:
+            raise TorrentMgrError("TorrentMgr has already been loaded")
+
+        # A torrent in the catalog is opened from the metainfo saved there,
+        # otherwise the metainfo file is read unless a Metainfo was supplied,
+        # as for a magnet link.  Either way, the pieces downloaded and peers
+        # known when the torrent was last served are restored from the
+        # catalog.
+        saved = None
+        try:
+            if not self._metainfo and self._catalog and self._catalog_hash:
+                saved = self._catalog.load(self._catalog_hash)
+                if saved:
+                    self._metainfo = Metainfo(self._filename,
+                                              contents=saved[0],
+                                              info_hash=self._catalog_hash)
+            if not self._metainfo:
+                self._metainfo = Metainfo(self._filename)
+            if self._catalog and not saved:
+                saved = self._catalog.load(self._metainfo.info_hash)
+        except ValueError as err:
+            logger.error(err)
+            raise TorrentMgrError(err.message)
+        except IOError as err:
+            logger.error(err)
+            raise TorrentMgrError(err.strerror)
+        except CatalogError as err:
+            raise TorrentMgrError(err.message)
+
+        have = BitArray(self._metainfo.num_pieces)
+        saved_peers = []
+        priorities = [1] * len(self._metainfo.files)
+        if saved:
+            _, saved_have, saved_peers, saved_priorities = saved
+            if (saved_have is not None and
+                    len(saved_have) == (self._metainfo.num_pieces+7)/8):
+                have = BitArray(bytes=saved_have,
+                                length=self._metainfo.num_pieces)
+            if (saved_priorities is not None and
+                    len(saved_priorities) == len(priorities)):
+                priorities = saved_priorities
+
+        # _file_offsets holds the offset of each file within the torrent
+        self._file_offsets = []
+        offset = 0
+        for _, length in self._metainfo.files:
+            self._file_offsets.append(offset)
+            offset += length
+
+        # _priorities holds the priority of each file.  _piece_priorities
+        # holds the priority of each piece and _wanted is the bitfield of
+        # pieces whose priority isn't zero.
+        self._priorities = priorities
+        self._prioritize()
+
+        # _have is the bitfield of pieces downloaded, as far as is known
+        # until the files are opened, _needed holds the pieces still
+        # needed and _saved_peers is the list of records of the peers to
+        # try first
+        self._have = have
+        self._needed = dict.fromkeys(
+            (~self._have & self._wanted).findall('0b1'), (0, []))
+        self._saved_peers = saved_peers + [record for record
+                                           in self._known_peers
+                                           if record not in saved_peers]
+
+        # _received and _sent count the torrent's payload for the metrics
+        key = self._metainfo.info_hash.encode('hex')
+        self._received = _PAYLOAD.labels(key, 'received')
+        self._sent = _PAYLOAD.labels(key, 'sent')
+
+        # A loaded TorrentMgr has no peers, so that its status can be
+        # reported before it is served, and a TrackerProxy which isn't
+        # started, so that its tracker can be scraped
+        self._peers = []
+        self._pool = None
+        self._requesting = {}
+        self._download_rate = RateEstimator()
+        self._tracker_proxy = TrackerProxy(self, self._metainfo, self._port,
+                                           self._peer_id, self._reactor)
+        self._state = self._States.Stopped
+
+    def start(self, scheduled=False):
+        """
+        start() starts serving the torrent.  A TorrentMgr started by a
+        Scheduler is ticked by the Scheduler and connects to peers once the
+        Scheduler allocates its connections, otherwise it runs its own timer
+        and connects to peers straight away.
+        """
         if not self._state == self._States.Initialized:
             raise TorrentMgrError("TorrentMgr must be initialized to be "
                                   "started")
 
-        self._reactor.callLater(_TIMER_INTERVAL, self.timer_event)
-        self._tick = 1
+        if not scheduled:
+            self._timer = self._reactor.callLater(_TIMER_INTERVAL,
+                                                  self.timer_event)
+
+        if self._catalog:
+            self._next_save = self._reactor.seconds() + _SAVE_INTERVAL
 
         logger.info("Starting to serve torrent {}".format(self._filename))
         print "Starting to serve torrent {}".format(self._filename)
 
         self._state = self._States.Started
 
-        self._connect_to_peers(20)
+        if not scheduled:
+            self._connect_to_peers(self._peer_target)
+
+    def stop(self):
+        """
+        stop() stops serving the torrent, as when it is paused.  Its timer is
+        cancelled, its peers are disconnected, its files are closed, reads
+        waiting for pieces fail and the trackers are told it has stopped.
+        Only what is needed to describe the torrent and to resume it is
+        kept, and its state is saved in the catalog.  stop() returns a
+        deferred which fires when the trackers have been told.  The
+        TorrentMgr is resumed by initializing and starting it again.
+        """
+        if self._state not in (self._States.Initialized,
+                               self._States.Started):
+            raise TorrentMgrError("TorrentMgr isn't being served")
+
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        self.save()
+        self._saved_peers = list(set(self._records.values()))[:_SAVED_PEERS]
+        self._state = self._States.Stopped
+
+        for peer in self._peers:
+            peer.drop_connection()
+        readers, self._readers = self._readers, []
+        for _, begin, length, d in readers:
+            d.errback(TorrentMgrError("Torrent stopped before {} bytes at "
+                                      "{} could be read"
+                                      .format(length, begin)))
+
+        self._filemgr.close()
+        self._filemgr = None
+
+        # Let go of everything to do with the peers and the pieces being
+        # downloaded, keeping only the pieces still needed
+        self._needed = dict.fromkeys(self._needed, (0, []))
+        self._peers = []
+        self._bitfields = {}
+        self._records = {}
+        self._interested = {}
+        self._requesting = {}
+        self._partial = []
+        self._block_hashes = {}
+        self._hash_requests = {}
+        self._deadlines = {}
+        self._rejected = {}
+        self._pex_sent = {}
+        self._throttled = []
+        self._wheel = None
+        self._pool = None
+
+        logger.info("Stopped serving torrent {}".format(self._filename))
+        return self._tracker_proxy.stop()
+
+    def is_stopped(self):
+        return self._state == self._States.Stopped
+
+    def forget(self):
+        """
+        forget() drops the metrics kept for the torrent, which should be
+        stopped, once it is removed and won't be served again.
+        """
+        if self._state != self._States.Uninitialized:
+            key = self._metainfo.info_hash.encode('hex')
+            _PAYLOAD.remove(key, 'received')
+            _PAYLOAD.remove(key, 'sent')
 
     def percent(self):
+        # The percentage downloaded is of the pieces which aren't skipped
         if not self._state == self._States.Uninitialized:
-            return 100 * (1 - (len(self._needed) /
-                               float(self._metainfo.num_pieces)))
+            wanted = self._wanted.count(1)
+            if not wanted:
+                return 100.0
+            return 100 * (1 - (len(self._needed) / float(wanted)))
         else:
             raise TorrentMgrError("Can't get percent on uninitialized "
                                   "TorrentMgr")
 
+    def is_complete(self):
+        """
+        is_complete() returns whether every wanted piece has been
+        downloaded.
+        """
+        return not self._needed
+
     def info_hash(self):
         if not self._state == self._States.Uninitialized:
             return self._metainfo.info_hash
@@ -180,22 +553,482 @@ class TorrentMgr(object):
     def name(self):
         return self._metainfo.name
 
+    def download_rate(self):
+        return self._download_rate.rate(self._reactor.seconds())
+
+    def upload_rate(self):
+        return sum(peer.upload_rate() for peer in self._peers)
+
+    def peer_count(self):
+        return len(self._peers)
+
+    def peer_states(self):
+        """
+        peer_states() returns a dictionary of the number of the torrent's
+        peers in each state.
+        """
+        states = {}
+        for peer in self._peers:
+            state = peer.state()
+            states[state] = states.get(state, 0) + 1
+        return states
+
+    def peer_stats(self):
+        """
+        peer_stats() returns a list of the statistics of each peer, along
+        with the piece being requested from it, if any.
+        """
+        stats = []
+        for peer in self._peers:
+            peer_stats = peer.stats()
+            peer_stats['piece'] = (self._requesting[peer][0]
+                                   if peer in self._requesting else None)
+            stats.append(peer_stats)
+        return stats
+
+    def summary(self):
+        """
+        summary() returns a dictionary of the torrent's percent downloaded,
+        download and upload rates, bytes left, estimated seconds to
+        completion, or None if nothing is being downloaded, the number of
+        peers, of those connected, of those it is interested in and of those
+        unchoking it, and the number of pieces being downloaded.  The rates
+        are measured over a sliding window.  Working out the summary looks
+        at every peer, so it is done at most once a second and the same
+        dictionary, which mustn't be changed, is returned in between.
+        """
+        now = self._reactor.seconds()
+        if self._summary is not None and now < self._summary_expires:
+            return self._summary
+
+        connected = interested = unchoked = 0
+        for peer in self._peers:
+            if peer.is_connected():
+                connected += 1
+                if peer.is_interested():
+                    interested += 1
+                if not peer.is_peer_choked():
+                    unchoked += 1
+
+        download_rate = self.download_rate()
+        left = self.left()
+        if not left:
+            eta = 0
+        elif download_rate:
+            eta = int(left / download_rate + 0.5)
+        else:
+            eta = None
+
+        in_flight = set(index for index, _, _, _
+                        in self._requesting.values())
+        self._summary = {'percent': self.percent(),
+                         'download_rate': download_rate,
+                         'upload_rate': self.upload_rate(),
+                         'left': left,
+                         'eta': eta,
+                         'peer_count': len(self._peers),
+                         'connected': connected,
+                         'interested': interested,
+                         'unchoked': unchoked,
+                         'pieces_in_flight': len(in_flight)}
+        self._summary_expires = now + _SUMMARY_INTERVAL
+        return self._summary
+
+    def scrape_url(self):
+        if self._tracker_proxy:
+            return self._tracker_proxy.scrape_url()
+
+    def scraped(self, stats):
+        """
+        scraped() takes the statistics for the torrent from a scrape of its
+        tracker, which stand in for those of an announce until a tracker
+        responds to one.
+        """
+        self._scraped = (stats['complete'], stats['incomplete'])
+
+    def _swarm(self):
+        # The numbers of seeders and leechers last reported in response to
+        # an announce, or failing that to a scrape
+        if self._tracker_proxy:
+            complete, incomplete = self._tracker_proxy.swarm()
+            if complete is not None or incomplete is not None:
+                return complete, incomplete
+        return self._scraped
+
+    def seeders(self):
+        """
+        seeders() returns the number of seeders the trackers last reported,
+        or zero if they haven't reported any.
+        """
+        complete, _ = self._swarm()
+        return complete or 0
+
+    def swarm_size(self):
+        """
+        swarm_size() returns the number of peers known to be serving the
+        torrent, either connected to, waiting in the pool or reported by the
+        trackers, whichever is largest.
+        """
+        # A torrent which is loaded or stopped has no pool
+        complete, incomplete = self._swarm()
+        pooled = len(self._pool) if self._pool else 0
+        return max(len(self._peers) + pooled,
+                   (complete or 0) + (incomplete or 0))
+
+    def rate_limited(self):
+        """
+        rate_limited() returns whether the download rate allocated has held
+        back any requests since it was allocated.
+        """
+        return self._rate_limited
+
+    def allocate(self, connections, rate):
+        """
+        allocate() sets the number of connections the TorrentMgr may open
+        and the rate in bytes per second at which it may download, or None
+        for no limit.  Idle connected peers beyond the number of connections
+        are dropped, the least recently useful first, and more peers are
+        connected to if the number has grown.
+        """
+        self._connection_budget = connections
+        self._peer_target = min(_PEER_TARGET, connections)
+        self._rate_limit = rate
+        self._rate_limited = False
+        if rate is None:
+            self._release_throttled()
+
+        if self._state != self._States.Started:
+            return
+        excess = len(self._peers) - connections
+        if excess > 0:
+            idle = sorted((peer for peer in self._peers
+                           if peer.is_connected() and self._is_idle(peer)),
+                          key=lambda peer: peer.last_block())
+            for peer in idle[:excess]:
+                peer.drop_connection()
+                self._remove_peer(peer)
+        elif len(self._peers) < self._peer_target:
+            self._connect_to_peers(self._peer_target - len(self._peers))
+
+    def save(self):
+        """
+        save() records the pieces downloaded, the peers connected to and the
+        priorities of the files in the catalog, if the TorrentMgr has one,
+        so that they are restored the next time the torrent is served.
+        """
+        if not self._catalog or self._state not in (self._States.Initialized,
+                                                    self._States.Started):
+            return
+        records = list(set(self._records.values()))[:_SAVED_PEERS]
+        try:
+            self._catalog.update(self._metainfo.info_hash,
+                                 self._have.tobytes(), records,
+                                 self._priorities)
+            self._unsaved = False
+        except CatalogError as err:
+            logger.warning("Can't save the state of {}: {}"
+                           .format(self._metainfo.name, err))
+
+    def file_span(self, index):
+        """
+        file_span() returns a tuple of the path, as a list of components, the
+        offset within the torrent and the length of one of the torrent's
+        files.  It raises an IndexError for a file that doesn't exist.
+        """
+        if not 0 <= index < len(self._file_offsets):
+            raise IndexError("{} out of range".format(index))
+        path, length = self._metainfo.files[index]
+        return path, self._file_offsets[index], length
+
+    def files(self):
+        """
+        files() returns a list with a dictionary for each of the torrent's
+        files, other than padding files, holding its index, name, length,
+        priority and the percentage of its pieces which have been
+        downloaded.
+        """
+        piece_length = self._metainfo.piece_length
+        result = []
+        for index, (path, length) in enumerate(self._metainfo.files):
+            if index in self._metainfo.padding:
+                continue
+            offset = self._file_offsets[index]
+            if length:
+                pieces = self._have[offset / piece_length:
+                                    (offset + length - 1) / piece_length + 1]
+                percent = 100.0 * pieces.count(1) / len(pieces)
+            else:
+                percent = 100.0
+            result.append({'index': index,
+                           'name': '/'.join(path),
+                           'length': length,
+                           'priority': self._priorities[index],
+                           'percent': percent})
+        return result
+
+    def priorities(self):
+        return list(self._priorities)
+
+    def set_priorities(self, priorities):
+        """
+        set_priorities() takes a list with the priority of each of the
+        torrent's files, from zero, which skips the file, to seven.  Pieces
+        which are no longer wanted are abandoned, along with any reads
+        waiting for them, and pieces which are wanted again are sought from
+        the connected peers.  It raises a TorrentMgrError if the priorities
+        are invalid.
+        """
+        if self._state not in (self._States.Initialized,
+                               self._States.Started):
+            raise TorrentMgrError("Can't set priorities on a TorrentMgr "
+                                  "which isn't being served")
+        if (len(priorities) != len(self._metainfo.files) or
+                not all(isinstance(priority, (int, long)) and
+                        0 <= priority <= _MAX_PRIORITY
+                        for priority in priorities)):
+            raise TorrentMgrError("Invalid priorities")
+
+        self._filemgr.set_priorities(priorities)
+        self._priorities = list(priorities)
+        self._prioritize()
+        self._unsaved = True
+
+        for index in self._needed.keys():
+            if not self._wanted[index]:
+                del self._needed[index]
+                self._deadlines.pop(index, None)
+                self._block_hashes.pop(index, None)
+                self._release(index)
+        for reader in self._readers[:]:
+            missing, begin, length, d = reader
+            if any(not self._wanted[index] for index in missing):
+                self._readers.remove(reader)
+                d.errback(TorrentMgrError("Can't read {} bytes at {} from "
+                                          "a skipped file"
+                                          .format(length, begin)))
+
+        for index in (~self._have & self._wanted).findall('0b1'):
+            if index not in self._needed:
+                peers = [peer for peer in self._peers
+                         if self._bitfields[peer][index]]
+                self._needed[index] = (len(peers), peers)
+
+        for peer in self._peers:
+            self._check_interest(peer)
+
+    def _prioritize(self):
+        # Work out the priority of each piece from the priorities of the
+        # files it holds part of
+        piece_length = self._metainfo.piece_length
+        self._piece_priorities = [0] * self._metainfo.num_pieces
+        for index, (_, length) in enumerate(self._metainfo.files):
+            if not length or index in self._metainfo.padding:
+                continue
+            offset = self._file_offsets[index]
+            for piece in xrange(offset / piece_length,
+                                (offset + length - 1) / piece_length + 1):
+                self._piece_priorities[piece] = max(
+                    self._piece_priorities[piece], self._priorities[index])
+
+        self._wanted = BitArray(self._metainfo.num_pieces)
+        self._wanted.set(True, [piece for piece, priority
+                                in enumerate(self._piece_priorities)
+                                if priority])
+
+    def stream(self, begin, end=None):
+        """
+        stream() moves the cursor of a stream through the torrent, or
+        through the part of it ending at end, to begin.  The pieces ahead of
+        the cursor are given deadlines, the first of them straight away.
+        """
+        if self._state != self._States.Started:
+            return
+        if end is None:
+            end = self._metainfo.total_length
+        piece_length = self._metainfo.piece_length
+        readahead = max(_READAHEAD, piece_length * _MIN_READAHEAD_PIECES)
+        first = begin / piece_length
+        last = (min(end, begin + readahead) - 1) / piece_length
+
+        now = self._reactor.seconds()
+        for ahead, index in enumerate(xrange(first, last + 1)):
+            if index in self._needed:
+                deadline = now + ahead * _DEADLINE_STEP
+                self._deadlines[index] = min(deadline,
+                                             self._deadlines.get(index,
+                                                                 deadline))
+        self._hurry()
+
+    def read(self, begin, length, end=None):
+        """
+        read() returns a deferred which fires with the torrent's data in the
+        range starting at begin once the pieces holding it have been
+        downloaded.  It also moves the cursor of the stream through the
+        torrent, or through the part of it ending at end, to begin.
+        Cancelling the deferred abandons the read.
+        """
+        if self._state != self._States.Started:
+            return fail(TorrentMgrError("TorrentMgr must be started to be "
+                                        "read"))
+        if (begin < 0 or length <= 0 or
+                begin + length > self._metainfo.total_length):
+            return fail(TorrentMgrError("Can't read {} bytes at {}"
+                                        .format(length, begin)))
+
+        piece_length = self._metainfo.piece_length
+        missing = set(index for index
+                      in xrange(begin / piece_length,
+                                (begin + length - 1) / piece_length + 1)
+                      if not self._have[index])
+        if any(not self._wanted[index] for index in missing):
+            return fail(TorrentMgrError("Can't read {} bytes at {} from a "
+                                        "skipped file".format(length, begin)))
+        self.stream(begin, end)
+        if not missing:
+            return succeed(self._filemgr.read(begin, length))
+
+        reader = [missing, begin, length, None]
+
+        def cancel(_):
+            if reader in self._readers:
+                self._readers.remove(reader)
+
+        reader[3] = Deferred(cancel)
+        self._readers.append(reader)
+        return reader[3]
+
+    def add_local_peer(self, record):
+        """
+        add_local_peer() takes the record of a peer found on the local
+        network.  Such a peer is tried before any others and is connected to
+        right away, even if the target number of peers is already connected,
+        as long as the connection budget allows.
+        """
+        if (self._state == self._States.Started and
+                self._pool.add([record], preferred=True)):
+            self._connect_to_peers(1)
+
     def _connect_to_peers(self, n):
-        # Get addresses of n peers from the tracker and try to establish
-        # a connection with each
-
-        def handle_addrs(addrs):
-            for addr in addrs:
-                peer = PeerProxy(self, self._peer_id,
-                                 (addr['ip'], addr['port']), self._reactor,
-                                 info_hash=self._metainfo.info_hash)
-                self._peers.append(peer)
-                self._bitfields[peer] = BitArray(self._metainfo.num_pieces)
-        self._tracker_proxy.get_peers(n).addCallback(handle_addrs)
+        # Take addresses of n peers from the pool, getting more from the
+        # tracker if the pool runs short, and try to establish a connection
+        # with each without exceeding the connection budget
+        n = min(n, self._connection_budget - len(self._peers))
+        if n <= 0 or self._state != self._States.Started:
+            return
+
+        records = self._pool.take(n)
+        for record in records:
+            self._add_peer(record)
+
+        def handle_records(records):
+            self._awaiting_peers = False
+            if self._state != self._States.Started:
+                return
+            self._pool.add(records)
+            self._connect_to_peers(self._peer_target - len(self._peers))
+
+        # Only one request for peers is made of the tracker at a time.  If
+        # the tracker has none, the request is satisfied at its next
+        # announce.
+        if (len(records) < n and not self._awaiting_peers and
+                self._tracker_proxy.is_started()):
+            self._awaiting_peers = True
+            (self._tracker_proxy.get_peers(n - len(records))
+             .addCallback(handle_records))
+
+        if (len(records) < n and self._dht and
+                (self._last_dht is None or self._reactor.seconds() -
+                 self._last_dht >= _DHT_MIN_INTERVAL)):
+            self._search_dht()
+
+    def _search_dht(self):
+        # Announce to the DHT and add the peers it knows about to the pool.
+        # This is done when the TorrentMgr starts, every fifteen minutes and,
+        # at most once a minute, whenever the pool runs short.
+        if self._dht_searching:
+            return
+        self._dht_searching = True
+        self._last_dht = self._reactor.seconds()
+        self._next_dht = self._last_dht + _DHT_INTERVAL
+
+        def found(records):
+            self._dht_searching = False
+            logger.debug("DHT found {} peers for {}"
+                         .format(len(records), self._metainfo.name))
+            if (self._state == self._States.Started and
+                    self._pool.add(records) and
+                    len(self._peers) < self._peer_target):
+                self._connect_to_peers(self._peer_target - len(self._peers))
+
+        def failed(failure):
+            self._dht_searching = False
+            logger.info("DHT lookup failed: {}".format(failure.value))
+
+        (self._dht.announce(self._metainfo.info_hash, self._port)
+         .addCallbacks(found, failed))
+
+    def _add_peer(self, record):
+        peer = PeerProxy(self, self._peer_id, peeraddr.to_addr(record),
+                         self._reactor, info_hash=self._metainfo.info_hash)
+        self._peers.append(peer)
+        self._records[peer] = record
+        self._bitfields[peer] = BitArray(self._metainfo.num_pieces)
+        self._wheel.schedule(peer, _KEEP_ALIVE_INTERVAL)
+
+    def _exchange_peers(self):
+        # Tell each peer which supports peer exchange about the peers which
+        # have been connected or disconnected since it was last told, up to
+        # a limited number of each
+        connected = set(self._records[peer] for peer in self._peers
+                        if peer.is_connected())
+        for peer, sent in self._pex_sent.items():
+            added = list(connected - sent - set([self._records[peer]]))
+            added = added[:_PEX_MAX_PEERS]
+            dropped = list(sent - connected)[:_PEX_MAX_PEERS]
+            if added or dropped:
+                peer.pex(added, dropped)
+                self._pex_sent[peer] = (sent - set(dropped)) | set(added)
+
+    def _is_idle(self, peer):
+        return (not peer.is_interested() and not peer.is_peer_interested()
+                and not peer in self._interested
+                and not peer in self._requesting)
+
+    def _check_connection(self, peer, now):
+        # Drop a peer that has gone silent, reap one that has not been useful
+        # when connections are scarce and keep a quiet connection alive.
+        # Afterwards, put the peer back on the wheel for when the next of
+        # these may be due.
+        if now - peer.last_rx() >= _DEAD_TIMEOUT:
+            logger.debug("Dropping silent peer {}".format(str(peer.addr())))
+            peer.drop_connection()
+            self._remove_peer(peer)
+            self._connect_to_peers(1)
+            return
+
+        if (len(self._peers) >= self._connection_budget and
+                self._is_idle(peer) and
+                now - peer.last_block() >= _IDLE_TIMEOUT):
+            logger.debug("Reaping idle peer {}".format(str(peer.addr())))
+            peer.drop_connection()
+            self._remove_peer(peer)
+            self._connect_to_peers(1)
+            return
+
+        if (peer.is_connected() and
+                now - peer.last_tx() >= _KEEP_ALIVE_INTERVAL):
+            peer.keep_alive()
+
+        due = min(peer.last_rx() + _DEAD_TIMEOUT,
+                  peer.last_tx() + _KEEP_ALIVE_INTERVAL,
+                  peer.last_block() + _IDLE_TIMEOUT)
+        self._wheel.schedule(peer, due - now)
 
     def _remove_peer(self, peer):
         # Clean up references to the peer in various data structures
         self._peers.remove(peer)
+        self._pool.forget(self._records.pop(peer))
+        self._pex_sent.pop(peer, None)
 
         pieces = list(self._bitfields[peer].findall('0b1'))
         for piece in pieces:
@@ -206,22 +1039,47 @@ class TorrentMgr(object):
                     self._needed[piece] = (occurences-1, peers)
 
         del self._bitfields[peer]
+        self._rejected.pop(peer, None)
+        if peer in self._throttled:
+            self._throttled.remove(peer)
+        for key, (_, asked) in self._hash_requests.items():
+            if asked is peer:
+                del self._hash_requests[key]
 
         if peer in self._interested:
             del self._interested[peer]
         elif peer in self._requesting:
             # If the peer is in the middle of downloading a piece, save
             # the state in the partial list
-            index, offset, sha1, _, _ = self._requesting[peer]
-            self._partial.append((index, offset, sha1))
+            index, offset, hasher, _ = self._requesting[peer]
+            self._partial.append((index, offset, hasher))
             del self._requesting[peer]
 
     def _rarest(self):
         # Returns a list of tuples which includes a piece index sorted by
         # the number of peers which have the piece in ascending order
+        # and, before that, by priority in descending order
         return sorted([(occurences, peers, index)
                        for (index, (occurences, peers)) in self._needed.items()
-                       if occurences != 0])
+                       if occurences != 0],
+                      key=lambda (occurences, _, index): (
+                          -self._piece_priorities[index], occurences, index))
+
+    def _rarest_indices(self):
+        return [index for _, _, index in self._rarest()]
+
+    def _of_interest(self, peer):
+        # Returns the set of needed pieces which the peer has and has not
+        # rejected
+        needed = ~self._have & self._wanted
+        of_interest = set((needed & self._bitfields[peer]).findall('0b1'))
+        return of_interest - self._rejected.get(peer, set())
+
+    def _dont_consider(self):
+        # Returns the set of pieces already designated for some peer
+        dont_consider = set(i for i, _, _, _ in self._interested.values())
+        dont_consider.update(i for i, _, _, _ in self._requesting.values())
+        return dont_consider
 
     def _show_interest(self, peer):
         if not peer.is_interested():
@@ -229,7 +1087,8 @@ class TorrentMgr(object):
                          .format(str(peer.addr())))
             peer.interested()
 
-        if not peer.is_peer_choked():
+        index = self._interested[peer][0]
+        if not peer.is_peer_choked() or peer.is_allowed_fast(index):
             self._request(peer)
 
     def _check_interest(self, peer):
@@ -238,30 +1097,35 @@ class TorrentMgr(object):
         if not peer in self._interested and not peer in self._requesting:
             # Compute the set of needed pieces which the peer has that are not
             # already designated for another peer
-            needed = self._have.copy()
-            needed.invert()
-            of_interest = list((needed & self._bitfields[peer]).findall('0b1'))
-            dont_consider = [i for i, _, _, _ in self._interested.values()]
-            dont_consider.extend([i for i, _, _, _, _
-                                  in self._requesting.values()])
+            of_interest = self._of_interest(peer)
+            dont_consider = self._dont_consider()
 
             # When there are potential pieces for the peer to download, give
-            # preference to a piece that has already been partially
-            # downloaded followed by the rarest available piece
+            # preference to a piece that can be downloaded while the peer is
+            # choking, then to the piece with the earliest deadline, then to
+            # a piece that has already been partially downloaded, then to a
+            # piece the peer suggested followed by the rarest available
+            # piece.  A snubbed peer is instead given the most common
+            # available piece and only resumes a partial piece as a last
+            # resort.
             if len(of_interest) > 0:
-                for index, offset, sha1 in self._partial:
-                    if index in of_interest:
-                        self._partial.remove((index, offset, sha1))
-                        self._interested[peer] = (index, offset, sha1,
-                                                  self._tick)
-                        self._show_interest(peer)
+                if self._assign_allowed_fast(peer, of_interest,
+                                             dont_consider):
+                    return
+
+                rarest = self._rarest_indices()
+                if not peer.is_snubbed():
+                    if (self._assign_deadline(peer, of_interest) or
+                        self._assign_partial(peer, of_interest) or
+                        self._assign_new(peer, of_interest, dont_consider,
+                                         peer.suggested()) or
+                        self._assign_new(peer, of_interest, dont_consider,
+                                         rarest)):
                         return
-
-                for _, _, index in self._rarest():
-                    if index in of_interest and not index in dont_consider:
-                        self._interested[peer] = (index, 0, hashlib.sha1(),
-                                                  self._tick)
-                        self._show_interest(peer)
+                else:
+                    if (self._assign_new(peer, of_interest, dont_consider,
+                                         reversed(rarest)) or
+                        self._assign_partial(peer, of_interest)):
                         return
 
             # If there is no further piece for a peer which was previously
@@ -273,40 +1137,186 @@ class TorrentMgr(object):
                 peer.not_interested()
                 self._connect_to_peers(1)
 
+    def _assign_deadline(self, peer, of_interest):
+        # Give the peer the piece with the earliest deadline which it has
+        # and no peer is getting, or which too few peers are getting once
+        # the deadline is near
+        now = self._reactor.seconds()
+        getting = {}
+        for index, _, _, _ in (self._interested.values() +
+                               self._requesting.values()):
+            getting[index] = getting.get(index, 0) + 1
+
+        for index in sorted(self._deadlines, key=self._deadlines.get):
+            if not index in of_interest:
+                continue
+            count = getting.get(index, 0)
+            if count == 0:
+                return (self._assign_partial(peer, set([index])) or
+                        self._assign_new(peer, of_interest, (), [index]))
+            if (count < _MAX_DUPLICATES and
+                    self._deadlines[index] - now <= _ENDGAME_MARGIN):
+                return self._assign_new(peer, of_interest, (), [index])
+        return False
+
+    def _hurry(self):
+        # Offer the pieces whose deadlines are near to idle peers
+        now = self._reactor.seconds()
+        for index, deadline in self._deadlines.items():
+            if deadline - now <= _ENDGAME_MARGIN:
+                self._reassign(index)
+
+    def _release(self, index, keep=None):
+        # Stop every peer but keep getting the piece, forget any partial
+        # download of it and return the peers which were stopped
+        self._partial = [entry for entry in self._partial
+                         if entry[0] != index]
+        released = []
+        for other, (piece, _, _, _) in self._interested.items():
+            if piece == index:
+                del self._interested[other]
+                released.append(other)
+        for other, (piece, offset, _, _) in self._requesting.items():
+            if piece == index and other is not keep:
+                other.cancel(piece, offset,
+                             self._bytes_to_request(piece, offset))
+                del self._requesting[other]
+                released.append(other)
+        return released
+
+    def _piece_received(self, peer, index):
+        # Now that the piece is here, stop any other peers getting it and
+        # complete the reads which were waiting for it
+        self._deadlines.pop(index, None)
+        for other in self._release(index, peer):
+            self._check_interest(other)
+
+        for reader in self._readers[:]:
+            missing, begin, length, d = reader
+            missing.discard(index)
+            if not missing:
+                self._readers.remove(reader)
+                d.callback(self._filemgr.read(begin, length))
+
+    def _check_allowed_fast(self, peer):
+        # If the peer is choking and idle, start on a piece it allows to be
+        # downloaded while choked
+        if (peer.is_peer_choked() and not peer in self._interested
+                and not peer in self._requesting):
+            self._assign_allowed_fast(peer, self._of_interest(peer),
+                                      self._dont_consider())
+
+    def _assign_allowed_fast(self, peer, of_interest, dont_consider):
+        if not peer.is_peer_choked():
+            return False
+        fast = of_interest & peer.allowed_fast()
+        return bool(fast) and (self._assign_partial(peer, fast) or
+                               self._assign_new(peer, fast, dont_consider,
+                                                self._rarest_indices()))
+
+    def _assign_partial(self, peer, of_interest):
+        for index, offset, hasher in self._partial:
+            if index in of_interest:
+                self._partial.remove((index, offset, hasher))
+                self._interested[peer] = (index, offset, hasher,
+                                          self._reactor.seconds())
+                self._show_interest(peer)
+                return True
+        return False
+
+    def _assign_new(self, peer, of_interest, dont_consider, candidates):
+        for index in candidates:
+            if index in of_interest and not index in dont_consider:
+                self._interested[peer] = (index, 0, self._new_hasher(index),
+                                          self._reactor.seconds())
+                self._show_interest(peer)
+                return True
+        return False
+
+    def _new_hasher(self, index):
+        if self._v2:
+            return merkle.PieceHasher(self._metainfo.piece_width(index))
+        return hashlib.sha1()
+
+    def _request_hashes(self, peer, index):
+        # Ask a v2 peer for the hashes of the blocks of a piece, unless they
+        # are already known or asked for or the piece is a single block
+        if not self._v2 or not peer.supports_v2():
+            return
+        width = self._metainfo.piece_width(index)
+        if (index in self._block_hashes or not 1 < width <= _MAX_HASHES or
+                index in [piece for piece, _ in self._hash_requests.values()]):
+            return
+        pieces_root, first = self._metainfo.piece_root(index)
+        self._hash_requests[(pieces_root, first)] = (index, peer)
+        peer.hash_request(pieces_root, 0, first, width, 0)
+
+    def _bad_block(self, peer, index, begin):
+        # Drop a peer which sent a block that doesn't match its hash.  What
+        # was received of the piece before the bad block is kept for another
+        # peer.
+        logger.info("Bad block pc: {} off: {} from {}"
+                    .format(index, begin, str(peer.addr())))
+        _BLOCK_FAILURES.inc()
+        peer.drop_connection()
+        self._remove_peer(peer)
+        self._reassign(index)
+        self._connect_to_peers(1)
+
+    def _reassign(self, index):
+        # Offer a piece which has just been released to the fastest idle,
+        # unsnubbed peer which has it
+        idle = [peer for peer in self._peers
+                if not peer in self._interested
+                and not peer in self._requesting
+                and not peer.is_snubbed()
+                and self._bitfields[peer][index]]
+        if idle:
+            self._check_interest(max(idle, key=lambda p: p.download_rate()))
+
     def _request(self, peer):
         if peer in self._interested:
-            index, offset, sha1, _ = self._interested[peer]
+            index, offset, hasher, _ = self._interested[peer]
             del self._interested[peer]
-            self._requesting[peer] = (index, offset, sha1, self._tick, 0)
+            self._requesting[peer] = (index, offset, hasher,
+                                      self._reactor.seconds())
+            self._request_hashes(peer, index)
+
+        # When the download rate is limited and the allowance has run out,
+        # the request waits until the allowance is topped up
+        if self._rate_limit is not None and self._allowance <= 0:
+            self._rate_limited = True
+            if peer not in self._throttled:
+                self._throttled.append(peer)
+            return
 
-        index, received_bytes, _, _, _ = self._requesting[peer]
+        index, received_bytes, _, _ = self._requesting[peer]
 
         bytes_to_request = self._bytes_to_request(index, received_bytes)
+        if self._rate_limit is not None:
+            self._allowance -= bytes_to_request
         logger.debug("Requesting pc: {} off: {} len: {} from {}"
                      .format(index, received_bytes, bytes_to_request,
                              str(peer.addr())))
         peer.request(index, received_bytes, bytes_to_request)
 
-    def _is_last_piece(self, index):
-        return index == self._metainfo.num_pieces-1
-
-    def _length_of_last_piece(self):
-        return (self._metainfo.total_length -
-               (self._metainfo.num_pieces-1)*self._metainfo.piece_length)
+    def _release_throttled(self):
+        # Send the requests which were waiting for allowance, timing them
+        # from now, for as long as the allowance lasts
+        now = self._reactor.seconds()
+        while self._throttled and (self._rate_limit is None or
+                                   self._allowance > 0):
+            peer = self._throttled.pop(0)
+            if peer in self._requesting:
+                index, offset, hasher, _ = self._requesting[peer]
+                self._requesting[peer] = (index, offset, hasher, now)
+                self._request(peer)
 
     def _length_of_piece(self, index):
-        if self._is_last_piece(index):
-            return self._length_of_last_piece()
-        else:
-            return self._metainfo.piece_length
+        return self._metainfo.piece_size(index)
 
     def _in_last_block(self, index, offset):
-        if self._is_last_piece(index):
-            piece_length = self._length_of_last_piece()
-        else:
-            piece_length = self._metainfo.piece_length
-
-        return piece_length-offset < _BLOCK_SIZE
+        return self._length_of_piece(index)-offset < _BLOCK_SIZE
 
     def _bytes_to_request(self, index, offset):
         if not self._in_last_block(index, offset):
@@ -314,11 +1324,28 @@ class TorrentMgr(object):
         else:
             return self._length_of_piece(index) - offset
 
+    # TrackerProxy callbacks
+
+    def uploaded(self):
+        return self._uploaded
+
+    def downloaded(self):
+        return self._download_rate.total
+
+    def left(self):
+        return sum(self._length_of_piece(index) for index in self._needed)
+
     # PeerProxy callbacks
 
     def get_bitfield(self):
         return self._have
 
+    def get_port(self):
+        return self._port
+
+    def metadata_size(self):
+        return len(self._metainfo.info)
+
     def peer_unconnected(self, peer):
         logger.info("Peer {} is unconnected".format(str(peer.addr())))
         self._remove_peer(peer)
@@ -352,6 +1379,20 @@ class TorrentMgr(object):
         # Check whether there may be interest obtaining a piece from this peer
         self._check_interest(peer)
 
+    def peer_has_all(self, peer):
+        # Set the peer's bitfield and update needed to reflect that the peer
+        # has every piece
+        logger.debug("Peer at {} has all pieces".format(str(peer.addr())))
+        bitfield = BitArray(self._metainfo.num_pieces)
+        bitfield.invert()
+        self._bitfields[peer] = bitfield
+        for piece, (occurences, peers) in self._needed.items():
+            if not peer in peers:
+                peers.append(peer)
+                self._needed[piece] = (occurences+1, peers)
+
+        self._check_interest(peer)
+
     def peer_has(self, peer, index):
         # Update the peer's bitfield and needed to reflect the availability
         # of the piece
@@ -377,15 +1418,47 @@ class TorrentMgr(object):
             del self._interested[peer]
         elif peer in self._requesting:
             # When choked in the middle of obtaining a piece, save the
-            # progress in the partial list
-            index, offset, sha1, _, _ = self._requesting[peer]
-            self._partial.append((index, offset, sha1))
+            # progress in the partial list unless the piece is one that can
+            # be downloaded while choked
+            index, offset, hasher, _ = self._requesting[peer]
+            if peer.is_allowed_fast(index):
+                return
+            self._partial.append((index, offset, hasher))
             del self._requesting[peer]
 
+        self._check_allowed_fast(peer)
+
     def peer_unchoked(self, peer):
         logger.debug("Peer {} unchoked".format(str(peer.addr())))
+        self._rejected.pop(peer, None)
         if peer in self._interested:
             self._request(peer)
+        else:
+            self._check_interest(peer)
+
+    def peer_rejected(self, peer, index, begin, length):
+        # When the outstanding request is rejected, save the progress in the
+        # partial list, give the piece to another peer and find a different
+        # piece for this one
+        logger.debug("Peer {} rejected pc: {} off: {}"
+                     .format(str(peer.addr()), index, begin))
+        if peer in self._requesting:
+            piece, offset, hasher, _ = self._requesting[peer]
+            if piece == index and offset == begin:
+                self._rejected.setdefault(peer, set()).add(index)
+                self._partial.append((index, offset, hasher))
+                del self._requesting[peer]
+                self._reassign(index)
+                self._check_interest(peer)
+
+    def peer_suggests(self, peer, index):
+        # A piece the peer suggests is preferred over the rarest piece
+        if index in self._needed:
+            self._check_interest(peer)
+
+    def peer_allowed_fast(self, peer, index):
+        if index in self._needed:
+            self._check_allowed_fast(peer)
 
     def peer_sent_block(self, peer, index, begin, buf):
         if not peer in self._requesting:
@@ -396,14 +1469,23 @@ class TorrentMgr(object):
                          .format(str(peer.addr())))
             return
 
-        piece, received_bytes, sha1, _, _ = self._requesting[peer]
+        piece, received_bytes, hasher, _ = self._requesting[peer]
         if piece == index and begin == received_bytes:
             # When the next expected block is received, update the hash value
-            # and write the block to file
-            sha1.update(buf)
+            # and write the block to file.  If the hashes of the piece's
+            # blocks are known, the block is checked first.
+            if index in self._block_hashes:
+                if not hasher.verify(buf, self._block_hashes[index]):
+                    self._bad_block(peer, index, begin)
+                    return
+            else:
+                hasher.update(buf)
             self._filemgr.write_block(index, begin, buf)
+            now = self._reactor.seconds()
+            self._download_rate.update(len(buf), now)
+            self._received.inc(len(buf))
             self._requesting[peer] = (piece, received_bytes + len(buf),
-                                      sha1, self._tick, 0)
+                                      hasher, now)
 
             if received_bytes + len(buf) < self._length_of_piece(index):
                 # Request the next block in the piece
@@ -411,24 +1493,61 @@ class TorrentMgr(object):
             else:
                 # On receipt of the last block in the piece, verify the hash
                 # and update the records to reflect receipt of the piece
-                if sha1.digest() == self._metainfo.piece_hash(index):
+                if hasher.digest() == self._metainfo.piece_hash(index):
                     logger.info("Successfully received piece {} from {}"
                                 .format(index, str(peer.addr())))
                     del self._needed[index]
                     print "{0}: Downloaded {1:1.4f}%".format(self._filename,
                                                              self.percent())
                     self._have[index] = 1
+                    self._unsaved = True
+                    self._block_hashes.pop(index, None)
+                    self._piece_received(peer, index)
                 else:
                     logger.info("Unsuccessfully received piece {} from {}"
                                 .format(index, str(peer.addr())))
+                    _PIECE_FAILURES.inc()
                 del self._requesting[peer]
 
                 if self._needed != {}:
                     # Try to find another piece for this peer to get
                     self._check_interest(peer)
-                else:
+                elif self._have.all(True):
                     logger.info("Successfully downloaded entire torrent {}"
                                 .format(self._filename))
+                    self._tracker_proxy.completed()
+                else:
+                    logger.info("Successfully downloaded the wanted files "
+                                "of torrent {}".format(self._filename))
+
+    def peer_extended_handshake(self, peer):
+        if peer.supports_extension(extensions.UT_PEX):
+            self._pex_sent.setdefault(peer, set())
+
+    def peer_pex(self, peer, added, dropped):
+        # Add the peers learned about to the pool and connect to more peers
+        # if there are fewer than the target number
+        logger.debug("Peer {} exchanged {} added and {} dropped peers"
+                     .format(str(peer.addr()), len(added), len(dropped)))
+        if self._pool.add(added) and len(self._peers) < self._peer_target:
+            self._connect_to_peers(self._peer_target - len(self._peers))
+
+    def peer_metadata_request(self, peer, piece):
+        # Serve the info dictionary to peers which came from a magnet link
+        info = self._metainfo.info
+        begin = piece * extensions.METADATA_PIECE_SIZE
+        if begin < len(info):
+            data = info[begin:begin+extensions.METADATA_PIECE_SIZE].tobytes()
+            self._sent.inc(len(data))
+            peer.metadata_data(piece, len(info), data)
+        else:
+            peer.metadata_reject(piece)
+
+    def peer_metadata_data(self, peer, piece, total_size, data):
+        pass
+
+    def peer_metadata_reject(self, peer, piece):
+        pass
 
     def peer_interested(self, peer):
         pass
@@ -437,44 +1556,147 @@ class TorrentMgr(object):
         pass
 
     def peer_request(self, peer, index, begin, length):
-        pass
+        # Uploading isn't implemented, so tell a peer which understands the
+        # Fast Extension that it won't get the block
+        peer.reject(index, begin, length)
 
     def peer_canceled(self, peer, index, begin, length):
         pass
 
+    def peer_hash_request(self, peer, pieces_root, base_layer, index, length,
+                          proof_layers):
+        # Requests for hashes are rejected, just as requests for blocks are
+        peer.hash_reject(pieces_root, base_layer, index, length, proof_layers)
+
+    def peer_hashes(self, peer, pieces_root, base_layer, index, length,
+                    proof_layers, hashes):
+        # Accept the hashes of the blocks of a piece if they hash up to the
+        # piece's hash, otherwise drop the peer which sent them.  Any proof
+        # hashes following them aren't needed.
+        key = (pieces_root, index)
+        request = self._hash_requests.get(key)
+        if base_layer != 0 or not request or request[1] is not peer:
+            return
+        del self._hash_requests[key]
+        piece = request[0]
+        width = self._metainfo.piece_width(piece)
+        try:
+            leaves = merkle.split(hashes)[:width]
+        except ValueError:
+            leaves = []
+        if (length == width and len(leaves) == width and
+                merkle.root(leaves, width) ==
+                self._metainfo.piece_hash(piece)):
+            if piece in self._needed:
+                self._block_hashes[piece] = leaves
+            return
+
+        logger.info("Bad hashes for piece {} from {}"
+                    .format(piece, str(peer.addr())))
+        peer.drop_connection()
+        self._remove_peer(peer)
+        self._connect_to_peers(1)
+
+    def peer_hash_reject(self, peer, pieces_root, base_layer, index, length,
+                         proof_layers):
+        key = (pieces_root, index)
+        request = self._hash_requests.get(key)
+        if request and request[1] is peer:
+            del self._hash_requests[key]
+
     # Reactor callback
 
     def timer_event(self):
-        self._reactor.callLater(_TIMER_INTERVAL, self.timer_event)
-        self._tick += 1
+        self._timer = self._reactor.callLater(_TIMER_INTERVAL,
+                                              self.timer_event)
+        self.tick()
+
+    def tick(self):
+        """
+        tick() does the TorrentMgr's periodic work.  It is called once a
+        second, by the TorrentMgr's own timer or by its Scheduler.
+        """
+        now = self._reactor.seconds()
+
+        # Top up the allowance for the time since the last tick, keeping no
+        # more than a second's worth, but always enough for a block
+        if self._rate_limit is not None and self._last_tick is not None:
+            self._allowance = min(
+                self._allowance + self._rate_limit * (now - self._last_tick),
+                max(self._rate_limit, _BLOCK_SIZE))
+        self._last_tick = now
+        self._release_throttled()
+
+        # Check the connections which have come due on the wheel, ignoring
+        # any peers which have already been removed
+        for peer in self._wheel.advance():
+            if peer in self._bitfields:
+                self._check_connection(peer, now)
+
+        if now >= self._next_pex:
+            self._next_pex = now + _PEX_INTERVAL
+            self._exchange_peers()
+
+        if self._dht and now >= self._next_dht:
+            self._search_dht()
+
+        if self._unsaved and now >= self._next_save:
+            self._next_save = now + _SAVE_INTERVAL
+            self.save()
+
+        # Try the trackers again if none of them could be reached
+        if (self._next_tracker_retry is not None and
+                now >= self._next_tracker_retry):
+            _TRACKER_RETRIES.inc()
+            self._start_trackers()
+
+        # Forget deadlines which have long passed unless a read is waiting
+        # for the piece, and hurry the pieces whose deadlines are near
+        waiting = set()
+        for missing, _, _, _ in self._readers:
+            waiting.update(missing)
+        for index, deadline in self._deadlines.items():
+            if now - deadline >= _DEADLINE_EXPIRY and not index in waiting:
+                del self._deadlines[index]
+        self._hurry()
+
+        # A peer isn't asked again for a piece it has rejected until it
+        # unchokes afresh.  If the peers have rejected every piece still
+        # needed and nothing is being downloaded, forget the rejections and
+        # ask again rather than stall.
+        if (self._rejected and self._needed and not self._interested and
+                not self._requesting):
+            self._rejected = {}
+            _REJECTED_RETRIES.inc()
+            for peer in self._bitfields.keys():
+                self._check_interest(peer)
 
         # For any peers that have been interested but unchoked for an
         # excessive period of time, stop being interested, free up assigned
         # piece and connect to another peer
-        for peer, (_, _, _, tick) in self._interested.items():
-            if tick + 4 == self._tick:
+        for peer, (_, _, _, since) in self._interested.items():
+            if now - since >= _INTEREST_TIMEOUT:
                 logger.debug("Timed out on interest for peer {}"
                              .format(str(peer.addr())))
+                _INTEREST_TIMEOUTS.inc()
                 peer.not_interested()
                 del self._interested[peer]
                 self._connect_to_peers(1)
 
-        # For any peer that has an outstanding request for an excessive period
-        # of time, resend the request message in case it got lost or is being
-        # ignored
-        for peer, (index, offset, sha1, tick, retries) \
-                in self._requesting.items():
-            if tick + 5 == self._tick:
+        # For any peer whose outstanding request has taken longer than its
+        # round trip time suggests it should, snub the peer, cancel the
+        # request and give the piece to a faster peer.  The snubbed peer is
+        # then offered a common piece.
+        for peer, (index, offset, hasher, sent) in self._requesting.items():
+            if (now - sent >= peer.request_timeout() and
+                    peer not in self._throttled):
                 logger.debug("Timed out on request for peer {}"
                              .format(str(peer.addr())))
-                if retries < _MAX_RETRIES:
-                    self._requesting[peer] = (index, offset, sha1,
-                                              self._tick, retries+1)
-                    self._request(peer)
-                else:
-                    logger.debug("Giving up on peer {}"
-                                 .format(str(peer.addr())))
-                    self._partial.append((index, offset, sha1))
-                    del self._requesting[peer]
-                    peer.not_interested()
-                    self._connect_to_peers(1)
+                _REQUEST_TIMEOUTS.inc()
+                peer.cancel(index, offset,
+                            self._bytes_to_request(index, offset))
+                peer.snub()
+                self._partial.append((index, offset, hasher))
+                del self._requesting[peer]
+                self._reassign(index)
+                self._check_interest(peer)
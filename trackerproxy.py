@@ -1,71 +1,409 @@
 """
-The TrackerProxy contacts the tracker specified in the supplied MetaInfo object
-and provides information about peers upon request.  After creation, the
-TrackerProxy must be told to start at which point it attempts to contact the
-tracker.  It raises a TrackerError if the tracker can't be contacted or
-returns an invalid response.
-
-Right now, this client doesn't support multiple trackers specified by
-announce-list in the Metainfo object.
-
-The TrackerProxy should periodically report progress back to the tracker and
-notify it when it has downloaded the entire torrent.  If the peer list is
-exhausted, it should also get more peers from the tracker.
+The TrackerProxy contacts the trackers specified in the supplied MetaInfo
+object, or a MagnetLink, and provides information about peers upon request.
+After creation, the TrackerProxy must be told to start at which point it
+attempts to contact the trackers.  It raises a TrackerError if no tracker
+can be contacted or every tracker returns an invalid response.
+
+The trackers are organized in tiers as described by the announce-list in the
+Metainfo object (BEP 12).  A torrent without an announce-list has a single
+tier holding its announce url, and one with neither has no trackers, in
+which case start() fails.  The order of the trackers within each tier is
+shuffled once when the TrackerProxy is created.  Each announce goes to all of
+the trackers in the first tier at once.  The first tracker to respond moves to
+the front of its tier and its response completes the announce, while the
+other trackers' responses are still accepted as they arrive.  When every
+tracker in a tier fails, or none responds in time, the announce moves on to
+the next tier.  A slow or dead tracker therefore delays an announce by at most
+the tier timeout, after which its announce is cancelled.  Peers from all of
+the trackers are merged and duplicates are dropped.
+
+Trackers with an http:// announce url are contacted through the shared
+HTTPTrackerClient, which keeps persistent connections to tracker hosts.
+Trackers with a udp:// announce url are contacted using the UDP tracker
+protocol through the shared UDPTrackerClient, whose responses are processed
+just like decoded HTTP responses.  scrape_url() gives the url at which the
+preferred tracker can be asked about the torrent's swarm so that a client
+can gather scrapes of many torrents into a few requests.
+
+Once started, the TrackerProxy announces again each time the interval asked
+for by the tracker which responded first elapses, adjusted by a small random
+amount so that torrents started together don't keep announcing together.
+Each announce reports the number of bytes uploaded, downloaded and left,
+which it gets from its client.  A client must implement uploaded(),
+downloaded() and left().  The client should tell the TrackerProxy when the
+torrent has been completely downloaded and when it stops serving the
+torrent so that the trackers can be notified.  A stop is sent to every
+tracker which has responded to an announce, and trackers which don't answer
+it within a few seconds are given up on.
+
+Peers received from the trackers, including IPv6 peers in a peers6 entry,
+are kept as compact records (see peeraddr) and handed out by get_peers().
+When the supply of peers runs low, the TrackerProxy announces early to get
+more, as long as the minimum interval the tracker asked for has passed.
+When there are no peers left, get_peers() waits until the next announce
+brings some.  Announces which fail after the TrackerProxy has started are
+retried later rather than reported.
 """
 
-import bencode
 import logging
+import random
 import sys
+import urllib
+
+from twisted.internet.defer import (CancelledError, Deferred, DeferredList,
+                                    fail, succeed)
 
-from twisted.internet.defer import Deferred
-from twisted.web.client import getPage
+import bencoding
+import httptracker
+import peeraddr
+import udptracker
 
 logger = logging.getLogger('bt.trackerproxy')
 
+_NUMWANT = 50
+_DEFAULT_INTERVAL = 1800
+_DEFAULT_MIN_INTERVAL = 60
+_RETRY_INTERVAL = 60
+_TIER_TIMEOUT = 30
+_STOP_TIMEOUT = 10
+_JITTER = 0.1
+
 
 class TrackerError(Exception):
     pass
 
 
+class _Tracker(object):
+    """
+    _Tracker holds what the TrackerProxy knows about one of its trackers.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.tracker_id = ""
+        self.interval = _DEFAULT_INTERVAL
+        self.min_interval = _DEFAULT_MIN_INTERVAL
+
+        # contacted is set once the tracker has responded to an announce,
+        # after which it needs to be told when the client stops
+        self.contacted = False
+
+
 class TrackerProxy(object):
-    def __init__(self, metainfo, port, peer_id):
+    def __init__(self, client, metainfo, port, peer_id, reactor):
+        self._client = client
         self._metainfo = metainfo
         self._port = port
         self._peer_id = peer_id
+        self._reactor = reactor
+
+        # _started is set once a tracker has responded and _stopped once
+        # stop() has been called, after which nothing more is announced
         self._started = False
-        self._tracker_id = ""
+        self._stopped = False
+
+        # _key identifies this client to the trackers even if its IP address
+        # changes
+        self._key = random.getrandbits(32)
+
+        # _tiers is a list of tiers, each of which is a list of trackers in
+        # the order they are preferred
+        self._tiers = self._make_tiers(metainfo)
+
+        # _peers is a list of the compact records of peers which haven't been
+        # handed out yet and _queued is the same peers as a set
+        self._peers = []
+        self._queued = set()
+
+        # _complete and _incomplete are the numbers of seeders and leechers
+        # last reported by a tracker
+        self._complete = None
+        self._incomplete = None
+
+        self._interval = _DEFAULT_INTERVAL
+        self._min_interval = _DEFAULT_MIN_INTERVAL
+        self._last_announce = None
+        self._announcing = False
+        self._timer = None
+
+        # _waiting is a list of tuples of the number of peers requested and
+        # the deferred to fire for each get_peers() call which couldn't be
+        # satisfied right away
+        self._waiting = []
+
+    def _make_tiers(self, metainfo):
+        tiers = []
+        seen = set()
+        for urls in metainfo.announce_list or []:
+            if not isinstance(urls, list):
+                continue
+            tier = []
+            for url in urls:
+                if isinstance(url, str) and url and url not in seen:
+                    seen.add(url)
+                    tier.append(_Tracker(url))
+            if tier:
+                random.shuffle(tier)
+                tiers.append(tier)
+
+        # BEP 12 says to ignore the announce url when there is a usable
+        # announce-list
+        if not tiers and metainfo.announce:
+            tiers = [[_Tracker(metainfo.announce)]]
+        return tiers
+
+    def is_started(self):
+        return self._started
+
+    def swarm(self):
+        """
+        swarm() returns a tuple of the numbers of seeders and leechers last
+        reported by a tracker, which are None until one has responded.
+        """
+        return self._complete, self._incomplete
+
+    def scrape_url(self):
+        """
+        scrape_url() returns the url at which the preferred tracker can be
+        scraped, or None if no tracker supports scraping.  For a UDP tracker
+        this is its announce url.
+        """
+        for tier in self._tiers:
+            for tracker in tier:
+                if tracker.url.startswith('udp://'):
+                    return tracker.url
+                url = httptracker.scrape_url(tracker.url)
+                if url:
+                    return url
+        return None
 
     def _params_str(self, params_dict):
-        return "&".join(str(k)+"="+str(v) for (k, v) in params_dict.items())
+        return urllib.urlencode(params_dict)
 
     def start(self):
         """
-        start() begins communication with the tracker.  It returns a
-        deferred which fires when a response has been received from the
+        start() begins communication with the trackers.  It returns a
+        deferred which fires when a response has been received from a
         tracker and validated.  It raises a TrackerError if it can't reach
-        the tracker, it receives a failure response or the response does
-        not contain required fields.
+        any tracker, or each tracker it reaches sends a failure response or
+        a response which doesn't contain required fields.
+        """
+        if not self._tiers:
+            return fail(TrackerError("No trackers"))
+        return self._announce('started')
+
+    def completed(self):
+        """
+        completed() tells the trackers that the torrent has been completely
+        downloaded.
         """
+        if self._started:
+            self._announce('completed')
+
+    def stop(self):
+        """
+        stop() tells the trackers that the client is no longer serving the
+        torrent and stops announcing.  Any get_peers() calls still waiting
+        for peers fire with an empty list.  It returns a deferred which
+        fires when the trackers have responded.
+        """
+        self._stopped = True
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        waiting, self._waiting = self._waiting, []
+        for _, d in waiting:
+            d.callback([])
+
+        if not self._started:
+            return succeed(None)
+        self._started = False
+
+        # Every tracker which has been contacted is told about the stop, not
+        # just those in the tier currently in use.  Trackers which haven't
+        # responded within the stop timeout are given up on.
+        ds = [self._announce_to(tracker, 'stopped')
+              .addErrback(lambda failure: None)
+              for tier in self._tiers for tracker in tier
+              if tracker.contacted]
+        def expire():
+            for d in ds:
+                d.cancel()
+
+        timer = self._reactor.callLater(_STOP_TIMEOUT, expire)
 
+        def stopped(result):
+            if timer.active():
+                timer.cancel()
+
+        return DeferredList(ds).addCallback(stopped)
+
+    def _announce(self, event=None):
+        self._announcing = True
+        self._last_announce = self._reactor.seconds()
+
+        d = self._announce_tiers(0, event)
+        d.addCallbacks(self._announced, self._announce_failed)
+        return d
+
+    def _announce_tiers(self, i, event):
+        # Announce to tier i, falling back to the tiers after it.  Returns a
+        # deferred which fires with the first tracker to respond.
+        d = self._announce_tier(self._tiers[i], event)
+        if i + 1 < len(self._tiers):
+            d.addErrback(lambda failure: self._announce_tiers(i + 1, event))
+        return d
+
+    def _announce_tier(self, tier, event):
+        # Announce to every tracker in the tier at once.  Returns a deferred
+        # which fires with the first tracker to respond, or fails when all
+        # of them have failed or none has responded within the tier timeout.
+        # Announces still outstanding at the tier timeout are cancelled, so
+        # that a dead UDP tracker isn't retried long after the tier has
+        # been given up on.
+        d = Deferred()
+        announces = []
+        pending = [len(tier)]
+        failures = [0]
+
+        def expire():
+            if not d.called:
+                d.errback(TrackerError("No tracker responded in time"))
+            for announce in announces:
+                announce.cancel()
+
+        timer = self._reactor.callLater(_TIER_TIMEOUT, expire)
+
+        def settled():
+            pending[0] -= 1
+            if pending[0] == 0 and timer.active():
+                timer.cancel()
+
+        def responded(result, tracker):
+            settled()
+            self._serve_waiting()
+            if not d.called:
+                tier.remove(tracker)
+                tier.insert(0, tracker)
+                d.callback(tracker)
+
+        def failed(failure, tracker):
+            settled()
+            if failure.check(CancelledError):
+                return
+            logger.info("Announce to {} failed: {}"
+                        .format(tracker.url, failure.value))
+            failures[0] += 1
+            if failures[0] == len(announces) and not d.called:
+                d.errback(failure)
+
+        trackers = list(tier)
+        for tracker in trackers:
+            announces.append(self._announce_to(tracker, event))
+        for announce, tracker in zip(announces, trackers):
+            announce.addCallbacks(responded, failed, callbackArgs=(tracker,),
+                                  errbackArgs=(tracker,))
+        return d
+
+    def _announce_to(self, tracker, event):
+        if tracker.url.startswith('udp://'):
+            d = self._announce_udp(tracker, event)
+        else:
+            d = self._announce_http(tracker, event)
+        return d.addCallback(self._process, tracker)
+
+    def _announce_http(self, tracker, event):
         params = {'info_hash': self._metainfo.info_hash,
                   'peer_id': self._peer_id,
                   'port': self._port,
-                  'uploaded': 0,
-                  'downloaded': 0,
-                  'left': sum([pair[1] for pair in self._metainfo.files]),
+                  'uploaded': self._client.uploaded(),
+                  'downloaded': self._client.downloaded(),
+                  'left': self._client.left(),
                   'compact': 1,
-                  'event': 'started'}
+                  'numwant': _NUMWANT,
+                  'key': "{:08x}".format(self._key)}
+        if event:
+            params['event'] = event
+        if tracker.tracker_id:
+            params['trackerid'] = tracker.tracker_id
+
+        separator = '&' if '?' in tracker.url else '?'
+        addr = tracker.url+separator+self._params_str(params)
+
+        def http_error(failure):
+            failure.trap(httptracker.HTTPTrackerError)
+            raise TrackerError(str(failure.value))
 
-        addr = self._metainfo.announce+"?"+self._params_str(params)
+        return (httptracker.shared_client(self._reactor).get(addr)
+                .addCallbacks(self._decode, http_error))
 
-        return getPage(addr).addCallbacks(self._decode, self._connect_error)
+    def _announce_udp(self, tracker, event):
+        def udp_error(failure):
+            failure.trap(udptracker.UDPTrackerError)
+            raise TrackerError(str(failure.value))
 
-    def _connect_error(self, failure):
-        raise TrackerError("Can't connect to the tracker at {}"
-                           .format(self._metainfo.announce))
+        client = udptracker.shared_client(self._reactor)
+        d = client.announce(tracker.url, self._metainfo.info_hash,
+                            self._peer_id, self._client.downloaded(),
+                            self._client.left(), self._client.uploaded(),
+                            event, self._key, _NUMWANT, self._port)
+        return d.addErrback(udp_error)
+
+    def _announced(self, tracker):
+        # The tracker which responded first sets the pace of announces,
+        # unless the TrackerProxy was stopped while it was announcing
+        self._announcing = False
+        if self._stopped:
+            return
+        self._started = True
+        self._interval = tracker.interval
+        self._min_interval = tracker.min_interval
+        self._schedule(self._interval *
+                       random.uniform(1 - _JITTER, 1 + _JITTER))
+        self._serve_waiting()
+
+    def _announce_failed(self, failure):
+        self._announcing = False
+        if self._stopped:
+            return
+        if not self._started:
+            return failure
+
+        logger.warning("Announce failed: {}".format(failure.value))
+        self._schedule(max(self._min_interval, _RETRY_INTERVAL))
+
+    def _schedule(self, delay):
+        # Arrange for the next announce to happen after the delay, replacing
+        # any announce that was already scheduled
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = self._reactor.callLater(delay, self._timer_event)
+
+    def _timer_event(self):
+        self._timer = None
+        if self._started and not self._stopped and not self._announcing:
+            self._announce()
+
+    def _request_more(self):
+        # Announce now if the minimum interval has passed.  Otherwise, bring
+        # the next announce forward to when the minimum interval will have
+        # passed.
+        if self._announcing or self._stopped or not self._started:
+            return
+
+        earliest = self._last_announce + self._min_interval
+        now = self._reactor.seconds()
+        if now >= earliest:
+            self._announce()
+        elif not self._timer or self._timer.getTime() > earliest:
+            self._schedule(earliest - now)
 
     def _decode(self, content):
-        response = bencode.bdecode(content)
+        try:
+            response = bencoding.decode(content)
+        except bencoding.BencodeError:
+            raise TrackerError("Invalid tracker response")
 
         if 'failure reason' in response:
             raise TrackerError("Failure reason: {}"
@@ -76,56 +414,73 @@ class TrackerProxy(object):
             print >> sys.stderr, ("Warning: {}"
                                   .format(response['warning message']))
 
+        return response
+
+    def _process(self, response, tracker):
         try:
-            self._min_interval = response.get('min interval', 0)
-            if 'tracker id' in response:
-                self._tracker_id = response['tracker id']
+            min_interval = response.get('min interval',
+                                        _DEFAULT_MIN_INTERVAL)
+            interval = response['interval']
 
-            self._interval = response['interval']
-            self._complete = response['complete']
-            self._incomplete = response['incomplete']
+            # The numbers of seeders and leechers are optional, and the last
+            # ones reported are kept when they are left out
+            complete = response.get('complete', self._complete)
+            incomplete = response.get('incomplete', self._incomplete)
 
-            if isinstance(response['peers'], list):
-                self._peers = response['peers']
+            # A tracker may send only IPv4 peers, only IPv6 peers or both
+            peers = response.get('peers', '')
+            if isinstance(peers, list):
+                peers = peeraddr.from_dicts(peers)
             else:
-                self._peers = []
-                peers = response['peers']
-                for offset in xrange(0, len(peers), 6):
-                    self._peers.append({'ip': "{}.{}.{}.{}"
-                                        .format(str(ord(peers[offset])),
-                                                str(ord(peers[offset+1])),
-                                                str(ord(peers[offset+2])),
-                                                str(ord(peers[offset+3]))),
-                                        'port': (ord(peers[offset+4])*256 +
-                                                 ord(peers[offset+5]))})
+                peers = peeraddr.decode_peers(peers)
+            peers.extend(peeraddr.decode_peers6(response.get('peers6', '')))
         except Exception:
             raise TrackerError("Invalid tracker response")
 
-        self._started = True
+        self._complete = complete
+        self._incomplete = incomplete
+        tracker.interval = interval
+        tracker.min_interval = min_interval
+        if 'tracker id' in response:
+            tracker.tracker_id = response['tracker id']
+        tracker.contacted = True
+
+        for peer in peers:
+            if peer not in self._queued:
+                self._queued.add(peer)
+                self._peers.append(peer)
+
+    def _take(self, n):
+        peers = self._peers[:n]
+        self._peers = self._peers[n:]
+        self._queued.difference_update(peers)
+        return peers
+
+    def _serve_waiting(self):
+        # Hand out newly received peers to get_peers() calls which have been
+        # waiting, in the order the calls were made
+        while self._waiting and self._peers:
+            n, d = self._waiting.pop(0)
+            d.callback(self._take(n))
 
     def get_peers(self, n):
         """
-        get_peers() takes a number and returns a deferred which fires when
-        that number of peer addresses are available.  The TrackerProxy may
-        need to request more peers from the tracker but for right now, it
-        triggers the callback immediately with whatever it has.
+        get_peers() takes a number and returns a deferred which fires with a
+        list of the compact records of up to that number of peers.  If the
+        TrackerProxy has no peers, the deferred fires once an announce
+        brings in more.  When the supply of peers runs low, an announce is
+        made as soon as the tracker allows it.
         """
         if not self._started:
             raise TrackerError("TrackerProxy not started")
 
-        self._n = n
-
-        def return_peers(ignored):
-            n = self._n
-            del self._n
-
-            if (len(self._peers) <= n):
-                n = len(self._peers)
+        d = Deferred()
+        if self._peers and not self._waiting:
+            d.callback(self._take(n))
+        else:
+            self._waiting.append((n, d))
 
-            peers = self._peers[:n]
-            self._peers = self._peers[n:]
-            return peers
+        if len(self._peers) < _NUMWANT / 2:
+            self._request_more()
 
-        d = Deferred().addCallback(return_peers)
-        d.callback(None)
         return d
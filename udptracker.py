@@ -0,0 +1,320 @@
+"""
+The UDPTrackerClient talks to trackers using the UDP tracker protocol (BEP 15)
+which needs far fewer packets and bytes than an HTTP announce.  A single
+client, listening on one UDP port, serves every torrent and tracker.  It is
+normally obtained with shared_client().
+
+Each request to a tracker is a transaction identified by a random
+transaction id.  Before announcing or scraping, the client must obtain a
+connection id from the tracker with a connect transaction.  A connection id
+may be used for a minute, so the client caches it for each tracker and
+concurrent requests to a tracker share a single connect transaction.  When
+no response arrives, a request is retransmitted after 15 * 2 ^ n seconds,
+where n starts at 0 and increases with each retransmission up to 8.  A new
+connection id is obtained first whenever the cached one has expired.
+
+announce() and scrape() return deferreds.  An announce fires with a
+dictionary shaped like a decoded HTTP tracker response, with 'interval',
+'complete', 'incomplete' and a compact 'peers' string.  A scrape fires with a
+dictionary mapping each info hash to a dictionary with 'complete',
+'downloaded' and 'incomplete' counts.  Both fail with a UDPTrackerError if
+the tracker reports an error, responds with something unexpected or never
+responds.  Their deferreds can be cancelled, which stops the request from
+being retransmitted, along with the connect transaction it is waiting on if
+no other request is waiting on it.
+"""
+
+import logging
+import random
+import struct
+import urlparse
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.protocol import DatagramProtocol
+
+logger = logging.getLogger('bt.udptracker')
+
+_PROTOCOL_ID = 0x41727101980
+
+_ACTION_CONNECT = 0
+_ACTION_ANNOUNCE = 1
+_ACTION_SCRAPE = 2
+_ACTION_ERROR = 3
+
+_EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+_BASE_TIMEOUT = 15
+_MAX_RETRANSMISSIONS = 8
+_CONNECTION_ID_LIFETIME = 60
+_ADDRESS_LIFETIME = 3600
+_MAX_SCRAPE = 74
+
+_client = None
+
+
+class UDPTrackerError(Exception):
+    pass
+
+
+def shared_client(reactor):
+    """
+    shared_client() returns the process-wide UDPTrackerClient, creating it
+    and starting it listening on an ephemeral port on first use.
+    """
+    global _client
+    if _client is None:
+        _client = UDPTrackerClient(reactor)
+        reactor.listenUDP(0, _client)
+    return _client
+
+
+class UDPTrackerClient(DatagramProtocol):
+    def __init__(self, reactor, base_timeout=_BASE_TIMEOUT,
+                 max_retransmissions=_MAX_RETRANSMISSIONS):
+        self._reactor = reactor
+        self._base_timeout = base_timeout
+        self._max_retransmissions = max_retransmissions
+
+        # _transactions maps each outstanding transaction id to a tuple of
+        # the tracker address, the function to call with the response and
+        # the timer for the retransmission timeout
+        self._transactions = {}
+
+        # _connections maps a tracker address to a tuple of its connection id
+        # and the time the connection id expires.  _connecting maps a
+        # tracker address to the deferreds waiting for a connection id which
+        # is being obtained, along with a list holding the transaction id of
+        # the connect request.
+        self._connections = {}
+        self._connecting = {}
+
+        # _addresses caches the IP address of each tracker host name along
+        # with the time the entry expires
+        self._addresses = {}
+
+    def _new_transaction_id(self):
+        while True:
+            transaction_id = random.getrandbits(32)
+            if transaction_id not in self._transactions:
+                return transaction_id
+
+    def _resolve(self, url):
+        # Returns a deferred which fires with the (ip, port) address of the
+        # tracker at the url
+        parsed = urlparse.urlparse(url)
+        if not parsed.hostname or not parsed.port:
+            return fail(UDPTrackerError("Invalid UDP tracker url {}"
+                                        .format(url)))
+
+        host, port = parsed.hostname, parsed.port
+        entry = self._addresses.get(host)
+        if entry and entry[1] > self._reactor.seconds():
+            return succeed((entry[0], port))
+
+        def resolved(ip):
+            self._addresses[host] = (ip, (self._reactor.seconds() +
+                                          _ADDRESS_LIFETIME))
+            return (ip, port)
+        return self._reactor.resolve(host).addCallback(resolved)
+
+    def _send(self, addr, transaction_id, packet, timeout, on_response,
+              on_timeout):
+        def expire():
+            del self._transactions[transaction_id]
+            on_timeout()
+
+        timer = self._reactor.callLater(timeout, expire)
+        self._transactions[transaction_id] = (addr, on_response, timer)
+        self.transport.write(packet, addr)
+
+    def _cancel(self, transaction_id):
+        # Forget an outstanding transaction so that it isn't retransmitted
+        entry = self._transactions.pop(transaction_id, None)
+        if entry:
+            entry[2].cancel()
+
+    def _timeout(self, n):
+        return self._base_timeout * 2**n
+
+    def _connection_id(self, addr, n):
+        # Returns a deferred which fires with a valid connection id for the
+        # tracker at addr.  Retransmissions of the connect request start at
+        # a timeout based on n.
+        entry = self._connections.get(addr)
+        if entry and entry[1] > self._reactor.seconds():
+            return succeed(entry[0])
+
+        d = Deferred(lambda d: self._stop_waiting(addr, d))
+        if addr in self._connecting:
+            self._connecting[addr][0].append(d)
+            return d
+
+        # current holds the transaction id of the outstanding connect request
+        current = [None]
+        self._connecting[addr] = ([d], current)
+
+        def finish(result, connection_id=None):
+            if connection_id is not None:
+                self._connections[addr] = (connection_id,
+                                           (self._reactor.seconds() +
+                                            _CONNECTION_ID_LIFETIME))
+            waiters, _ = self._connecting.pop(addr)
+            for waiter in waiters:
+                if connection_id is not None:
+                    waiter.callback(connection_id)
+                else:
+                    waiter.errback(result)
+
+        def attempt(n):
+            transaction_id = current[0] = self._new_transaction_id()
+            packet = struct.pack('>QII', _PROTOCOL_ID, _ACTION_CONNECT,
+                                 transaction_id)
+
+            def response(action, payload):
+                if action == _ACTION_CONNECT and len(payload) >= 8:
+                    (connection_id,) = struct.unpack('>Q', payload[:8])
+                    finish(None, connection_id)
+                else:
+                    finish(self._error(action, payload))
+
+            def timeout():
+                if n < self._max_retransmissions:
+                    attempt(n+1)
+                else:
+                    finish(UDPTrackerError("Tracker at {}:{} did not respond"
+                                           .format(*addr)))
+
+            self._send(addr, transaction_id, packet, self._timeout(n),
+                       response, timeout)
+
+        attempt(n)
+        return d
+
+    def _stop_waiting(self, addr, d):
+        # Stop the deferred waiting for a connection id, and give up on the
+        # connect transaction once nothing is waiting for it
+        entry = self._connecting.get(addr)
+        if entry and d in entry[0]:
+            entry[0].remove(d)
+            if not entry[0]:
+                del self._connecting[addr]
+                self._cancel(entry[1][0])
+
+    def _request(self, addr, action, body, parse):
+        # Sends a request which needs a connection id, retransmitting it as
+        # necessary.  Returns a deferred which fires with the response
+        # payload after it is parsed by the supplied function.  current
+        # holds the outstanding transaction id, if the request has been
+        # sent, and the deferred waiting for a connection id.
+        current = [None, None]
+
+        def cancel(d):
+            if current[0] is not None:
+                self._cancel(current[0])
+            if current[1] and not current[1].called:
+                current[1].cancel()
+
+        d = Deferred(cancel)
+
+        def attempt(n):
+            def send(connection_id):
+                transaction_id = current[0] = self._new_transaction_id()
+                packet = struct.pack('>QII', connection_id, action,
+                                     transaction_id) + body
+
+                def response(response_action, payload):
+                    if response_action != action:
+                        d.errback(self._error(response_action, payload))
+                        return
+                    try:
+                        result = parse(payload)
+                    except (struct.error, ValueError):
+                        d.errback(UDPTrackerError("Invalid response from "
+                                                  "tracker at {}:{}"
+                                                  .format(*addr)))
+                        return
+                    d.callback(result)
+
+                def timeout():
+                    if n < self._max_retransmissions:
+                        attempt(n+1)
+                    else:
+                        d.errback(UDPTrackerError("Tracker at {}:{} did not "
+                                                  "respond".format(*addr)))
+
+                self._send(addr, transaction_id, packet, self._timeout(n),
+                           response, timeout)
+
+            def failed(failure):
+                if not d.called:
+                    d.errback(failure)
+
+            current[0] = None
+            current[1] = self._connection_id(addr, n)
+            current[1].addCallbacks(send, failed)
+
+        attempt(0)
+        return d
+
+    def _error(self, action, payload):
+        if action == _ACTION_ERROR:
+            return UDPTrackerError("Failure reason: {}".format(payload))
+        return UDPTrackerError("Unexpected response action {}"
+                               .format(action))
+
+    def announce(self, url, info_hash, peer_id, downloaded, left, uploaded,
+                 event, key, numwant, port):
+        body = struct.pack('>20s20sQQQIIIiH', info_hash, peer_id, downloaded,
+                           left, uploaded, _EVENTS[event], 0, key, numwant,
+                           port)
+
+        def parse(payload):
+            interval, leechers, seeders = struct.unpack('>III', payload[:12])
+            return {'interval': interval,
+                    'incomplete': leechers,
+                    'complete': seeders,
+                    'peers': payload[12:]}
+
+        return (self._resolve(url)
+                .addCallback(self._request, _ACTION_ANNOUNCE, body, parse))
+
+    def scrape(self, url, info_hashes):
+        """
+        scrape() asks the tracker for the number of seeders, leechers and
+        completed downloads of each of the info hashes.  At most 74 info
+        hashes fit in one request.
+        """
+        if len(info_hashes) > _MAX_SCRAPE:
+            raise UDPTrackerError("At most {} info hashes can be scraped at "
+                                  "once".format(_MAX_SCRAPE))
+        body = ''.join(info_hashes)
+
+        def parse(payload):
+            stats = {}
+            for i, info_hash in enumerate(info_hashes):
+                seeders, completed, leechers = struct.unpack(
+                    '>III', payload[i*12:i*12+12])
+                stats[info_hash] = {'complete': seeders,
+                                    'downloaded': completed,
+                                    'incomplete': leechers}
+            return stats
+
+        return (self._resolve(url)
+                .addCallback(self._request, _ACTION_SCRAPE, body, parse))
+
+    def datagramReceived(self, data, addr):
+        if len(data) < 8:
+            return
+
+        action, transaction_id = struct.unpack('>II', data[:8])
+        if transaction_id not in self._transactions:
+            logger.debug("Unexpected transaction id from {}:{}".format(*addr))
+            return
+
+        expected_addr, on_response, timer = self._transactions[transaction_id]
+        if addr != expected_addr:
+            return
+
+        del self._transactions[transaction_id]
+        timer.cancel()
+        on_response(action, data[8:])